@@ -18,8 +18,8 @@ from django.http import JsonResponse
 from whoosh.searching import Results
 
 from biostar.accounts.models import Profile, User
-from . import auth, util, forms, tasks, search, views, const
-from .models import Post, Vote, Subscription
+from . import auth, util, forms, tasks, search, views, const, autocomplete, backends, counters, graph
+from .models import Post, Vote, Subscription, SimilarPost
 
 
 def ajax_msg(msg, status, **kwargs):
@@ -144,18 +144,18 @@ def drag_and_drop(request):
     if not (user.profile.is_moderator or post.author == user):
         return ajax_error(msg="Only moderators or the author can move posts.")
 
-    collect = set()
-    auth.walk_down_thread(parent=post, collect=collect)
-
-    if parent == post or (parent in collect) or parent.root != post.root:
-        return ajax_error(msg="Can not move post here.")
-
     if post.is_toplevel:
         return ajax_error(msg="Top level posts can not be moved.")
 
+    # The whole thread is read once to check the move.
+    thread = graph.ThreadGraph.load(root_id=post.root_id)
+    if not thread.can_move(post.id, parent.id):
+        return ajax_error(msg="Can not move post here.")
+
+    counters.moved(post, parent_id=parent.id, post_type=post_type)
     Post.objects.filter(uid=post.uid).update(type=post_type, parent=parent)
 
-    post.update_parent_counts()
+    auth.bump_thread(post.root_id)
     redir = post.get_absolute_url()
 
     return ajax_success(msg="success", redir=redir)
@@ -227,6 +227,20 @@ def validate_recaptcha(token):
     return False, "Invalid reCAPTCHA. Please try again."
 
 
+@ajax_error_wrapper(method="GET", login_required=False)
+def complete(request):
+    """
+    Return the post titles, tags and user handles starting with the query.
+    """
+    query = request.GET.get('query', '')
+    kind = request.GET.get('kind', '')
+    kinds = [kind] if kind in autocomplete.KINDS else autocomplete.KINDS
+
+    items = autocomplete.complete(query, limit=settings.AUTOCOMPLETE_LIMIT, kinds=kinds)
+
+    return ajax_success(msg="completions", items=items)
+
+
 @ajax_error_wrapper(method="GET", login_required=True)
 def most_recent_users(request):
 
@@ -458,6 +472,19 @@ def inplace_form(request):
     return ajax_success(msg="success", inplace_form=form)
 
 
+def get_similar(post):
+    """
+    Returns the precomputed similar threads of a post, in a single query.
+    """
+    query = SimilarPost.objects.filter(post=post).exclude(target__status=Post.DELETED)
+    query = query.exclude(target__spam=Post.SPAM).select_related("target__root").order_by("rank")
+    query = query[:settings.SIMILAR_FEED_COUNT]
+
+    results = [search.SearchResult(title=sim.target.title, content=sim.target.content,
+                                   url=sim.target.get_absolute_url(), uid=sim.target.uid) for sim in query]
+    return results
+
+
 def similar_posts(request, uid):
     """
     Return a feed populated with posts similar to the one in the request.
@@ -465,15 +492,18 @@ def similar_posts(request, uid):
 
     post = Post.objects.filter(uid=uid).first()
     if not post:
-        ajax_error(msg='Post does not exist.')
+        return ajax_error(msg='Post does not exist.')
+
+    # Precomputed with manage.py similar.
+    results = get_similar(post)
 
     cache_key = f"{const.SIMILAR_CACHE_KEY}-{post.uid}"
-    results = cache.get(cache_key)
+    results = results or cache.get(cache_key)
 
     if results is None:
         logger.info("Setting similar posts cache.")
 
-        results = search.whoosh_more_like_this(uid=post.uid)
+        results = backends.get_backend().more_like_this(uid=post.uid)
         # Set the results cache for 1 hour
         cache.set(cache_key, results, 3600)
 
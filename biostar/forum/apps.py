@@ -10,10 +10,14 @@ class ForumConfig(AppConfig):
     name = 'biostar.forum'
 
     def ready(self):
-        from . import signals
+        from . import signals, util
         # Triggered upon app initialization.
         post_migrate.connect(init_awards, sender=self)
 
+        if not util.is_cache_shared():
+            logger.warning(f"The {settings.SHARED_CACHE} cache is local to each process, "
+                           f"threads are not cached.")
+
 
 def init_awards(sender, **kwargs):
     "Initializes the badges"
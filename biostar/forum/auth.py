@@ -1,6 +1,9 @@
 import datetime
 import logging
 import hashlib
+import random
+import re
+import threading
 import urllib.parse
 from django.template import loader
 from django.conf import settings
@@ -10,15 +13,61 @@ from django.db import transaction
 from django.db.models import F, Q
 from django.utils.timezone import utc
 from django.core.cache import cache
+from taggit.models import Tag
 from biostar.accounts.models import Profile, Logger
-from . import util
+from . import util, pageviews, ledger, counters, graph, autocomplete
 from .const import *
-from .models import Post, Vote, PostView, Subscription
+from .models import Post, Vote, Subscription, Tombstone
 
 User = get_user_model()
 
 logger = logging.getLogger("engine")
 
+# Cached threads are keyed by a version for each thread.
+THREAD_VERSION_KEY = "THREAD_VERSION"
+
+# The uids and roots of the posts removed by delete_posts in this thread.
+DELETED = threading.local()
+
+# Marks the parts of a cached thread that depend on the user viewing it.
+OVERLAY_REGION = re.compile(r"<!--overlay:(\w+):(\w+)-->(.*?)<!--/overlay-->", re.DOTALL)
+OVERLAY_FIELD = re.compile(r"@@overlay:(\w+):(\w+)@@")
+
+
+def get_version(key):
+    """
+    Versions are kept in the shared cache, a change made by one worker invalidates the entries of all workers.
+    """
+    shared = util.shared_cache()
+    version = shared.get(key)
+    if version is None:
+        # Start from a random value so a cleared cache does not reuse versions of stale entries.
+        version = random.getrandbits(48)
+        if not shared.add(key, version, None):
+            # Another worker started the version first.
+            version = shared.get(key, version)
+    return version
+
+
+def bump_version(key):
+    shared = util.shared_cache()
+    try:
+        shared.incr(key)
+    except ValueError:
+        shared.set(key, random.getrandbits(48), None)
+
+
+def thread_version(root_id):
+    return get_version(f"{THREAD_VERSION_KEY}-{root_id}")
+
+
+def bump_thread(*root_ids):
+    """
+    Invalidates the cached threads.
+    """
+    for root_id in set(root_ids):
+        bump_version(f"{THREAD_VERSION_KEY}-{root_id}")
+
 
 def get_votes(user, root):
     store = {
@@ -90,46 +139,132 @@ def gravatar(user, size=80):
     return gravatar_url(email=email, style=style, size=size)
 
 
-def walk_down_thread(parent, collect=set()):
-    """
-    Recursively walk down a thread of posts starting from target
-    """
-
-    # Stop condition: post does not have a root or parent.
-    if (parent is None) or (parent.parent is None) or (parent.root is None):
-        return collect
-
-    # Get all children for this post, excluding itself.
-    children = Post.objects.filter(parent=parent).exclude(uid=parent.uid)
-
-    for child in children:
-        # Add child to list
-        collect.add(child)
-        # Get all children belonging to the current child.
-        walk_down_thread(parent=child, collect=collect)
-
-    return collect
-
-
 def create_subscription(post, user, sub_type=None, delete_exisiting=True):
     """
     Creates subscription to a post. Returns a list of subscriptions.
     """
+    existing = Subscription.objects.filter(post=post.root, user=user).first()
+
     # Drop all existing subscriptions for the user by default.
     if delete_exisiting:
         Subscription.objects.filter(post=post.root, user=user).delete()
         # Create new subscription to the user.
-        Subscription.objects.create(post=post.root, user=user, type=sub_type)
+        sub = Subscription.objects.create(post=post.root, user=user, type=sub_type)
     # Update an existing subscription type.
     else:
         sub, created = Subscription.objects.get_or_create(post=post.root, user=user)
         Subscription.objects.filter(pk=sub.pk).update(type=sub_type)
-
-    # Recompute post subscription.
-    subs_count = Subscription.objects.filter(post=post.root).exclude(type=Profile.NO_MESSAGES).count()
+        sub.type = sub_type
 
     # Update root subscription counts.
-    Post.objects.filter(pk=post.root.pk).update(subs_count=subs_count)
+    counters.subscription_changed(root_id=post.root_id, before=existing, after=sub)
+
+
+def bulk_subscribe(post, users):
+    """
+    Subscribes the users that do not follow the thread yet, all with one insert.
+    """
+    users = {user.id: user for user in users}
+    existing = Subscription.objects.filter(post_id=post.root_id, user_id__in=users)
+    existing = set(existing.values_list("user_id", flat=True))
+
+    now = util.now()
+    subs = [Subscription(post_id=post.root_id, user=user, type=Subscription.default_type(user),
+                         uid=util.get_uuid(limit=16), date=now)
+            for pk, user in users.items() if pk not in existing]
+    if not subs:
+        return
+
+    Subscription.objects.bulk_create(subs, ignore_conflicts=True)
+
+    # Rows subscribed concurrently were skipped, only the ones inserted here carry these uids.
+    inserted = Subscription.objects.filter(uid__in=[sub.uid for sub in subs]).only("type")
+    counters.subscriptions_added(root_id=post.root_id, subs=inserted)
+
+
+def sync_tags(post):
+    """
+    Makes the tags of a post match its tag value, only the tags that changed are written.
+    """
+    # Nothing to do when the tag value is the one the post was read with.
+    if post.tag_val == getattr(post, "loaded_tag_val", None):
+        return
+
+    names = set(post.parse_tags())
+    through = Post.tags.through
+    lookup = through.lookup_kwargs(post)
+
+    current = dict(through.objects.filter(**lookup).values_list("tag__name", "tag_id"))
+    added, removed = names - set(current), set(current) - names
+
+    if added:
+        # Create the missing tags in one statement.
+        tags = dict(Tag.objects.filter(name__in=added).values_list("name", "id"))
+        missing = [Tag(name=name) for name in added if name not in tags]
+        for tag in missing:
+            tag.slug = tag.slugify(tag.name)
+        Tag.objects.bulk_create(missing, ignore_conflicts=True)
+        tags = dict(Tag.objects.filter(name__in=added).values_list("name", "id"))
+
+        # Tags whose slug is taken get a numbered slug.
+        for name in added - set(tags):
+            tags[name] = Tag.objects.get_or_create(name=name)[0].id
+
+        through.objects.bulk_create([through(tag_id=tags[name], **lookup) for name in added])
+
+    if removed:
+        through.objects.filter(tag_id__in=[current[name] for name in removed], **lookup).delete()
+
+    post.loaded_tag_val = post.tag_val
+
+
+def add_tombstones(posts):
+    """
+    Queues posts for removal from the search index.
+    """
+    uids = posts.values_list("uid", flat=True)
+    Tombstone.objects.bulk_create([Tombstone(uid=uid) for uid in uids])
+
+
+def collect_deleted(post):
+    """
+    Collects a removed post while delete_posts runs. Returns False when no deletion is collected.
+    """
+    removed = getattr(DELETED, "posts", None)
+    if removed is None:
+        return False
+
+    removed.append((post.uid, post.root_id))
+    return True
+
+
+def delete_posts(posts):
+    """
+    Removes posts and their replies. The search index, the thread counts, the completions
+    and the cached threads are updated once for all of them.
+    """
+    if getattr(DELETED, "posts", None) is not None:
+        return posts.delete()
+
+    DELETED.posts = []
+    try:
+        result = posts.delete()
+        removed = DELETED.posts
+    finally:
+        DELETED.posts = None
+
+    if not removed:
+        return result
+
+    uids = [uid for uid, root_id in removed]
+    root_ids = {root_id for uid, root_id in removed}
+
+    Tombstone.objects.bulk_create([Tombstone(uid=uid) for uid in uids])
+    counters.recount(root_ids=root_ids)
+    autocomplete.COMPLETER.remove_many(autocomplete.POST, uids)
+    bump_thread(*root_ids)
+
+    return result
 
 
 def is_suspended(user):
@@ -139,46 +274,60 @@ def is_suspended(user):
     return False
 
 
-def post_tree(user, root):
+def thread_query(root, is_moderator=False):
     """
-    Populates a tree that contains all posts in the thread.
-
-    Answers sorted before comments.
+    Returns the posts in a thread other than the root, answers sorted before comments.
     """
-
     # Get all posts that belong to post root.
     query = Post.objects.filter(root=root).exclude(pk=root.id)
 
     query = query.select_related("lastedit_user__profile", "author__profile", "root__author__profile")
 
-    is_moderator = user.is_authenticated and user.profile.is_moderator
-
     # Only moderators
     if not is_moderator:
         query = query.exclude(status=Post.DELETED)
         # query = query.exclude(spam=Post.SPAM)
 
     # Apply the sort order to all posts in thread.
-    thread = query.order_by("type", "-accept_count", "-vote_count", "creation_date")
+    return query.order_by("type", "-accept_count", "-vote_count", "creation_date")
 
-    # Gather votes by the current user.
-    votes = get_votes(user=user, root=root)
 
-    # Shortcuts to each storage.
-    bookmarks, upvotes = votes[Vote.BOOKMARK], votes[Vote.UP]
+def user_state(user, is_moderator, post_id, author_id, is_toplevel, root_author_id, votes):
+    """
+    Returns the attributes of a post that depend on the user viewing it.
+    """
+    is_author = user.is_authenticated and user.id == author_id
+    is_root_author = user.is_authenticated and user.id == root_author_id
+
+    state = dict(
+        has_bookmark=int(post_id in votes[Vote.BOOKMARK]),
+        has_upvote=int(post_id in votes[Vote.UP]),
+        can_accept=not is_toplevel and (is_root_author or is_moderator),
+        can_moderate=is_moderator,
+        is_editable=is_author or is_moderator,
+    )
+    return state
 
-    # Build comments tree.
-    comment_tree = dict()
+
+def post_tree(user, root):
+    """
+    Populates a tree that contains all posts in the thread.
+
+    Answers sorted before comments.
+    """
+    is_moderator = user.is_authenticated and user.profile.is_moderator
+
+    thread = thread_query(root=root, is_moderator=is_moderator)
+
+    # Gather votes by the current user.
+    votes = get_votes(user=user, root=root)
 
     def decorate(post):
         # Mutates the elements! Not worth creating copies.
-        if post.is_comment:
-            comment_tree.setdefault(post.parent_id, []).append(post)
-        post.has_bookmark = int(post.id in bookmarks)
-        post.has_upvote = int(post.id in upvotes)
-        post.can_accept = not post.is_toplevel and (user == post.root.author or (user.is_authenticated and user.profile.is_moderator))
-        post.can_moderate = user.is_authenticated and user.profile.is_moderator
-        post.is_editable = user.is_authenticated and (user == post.author or (user.is_authenticated and user.profile.is_moderator))
+        state = user_state(user=user, is_moderator=is_moderator, post_id=post.id, author_id=post.author_id,
+                           is_toplevel=post.is_toplevel, root_author_id=root.author_id, votes=votes)
+        for name, value in state.items():
+            setattr(post, name, value)
         return post
 
     # Decorate the objects for easier access
@@ -187,12 +336,106 @@ def post_tree(user, root):
     # Decorate the root post
     root = decorate(root)
 
+    # Build comments tree.
+    comment_tree = graph.ThreadGraph.from_posts(root_id=root.id, posts=thread).comment_tree()
+
     # Select the answers from the thread.
     answers = [p for p in thread if p.type == Post.ANSWER]
 
     return root, comment_tree, answers, thread
 
 
+def overlay_region(name, uid, text):
+    return f"<!--overlay:{name}:{uid}-->{text}<!--/overlay-->"
+
+
+def overlay_field(name, uid):
+    return f"@@overlay:{name}:{uid}@@"
+
+
+def apply_overlay(html, states):
+    """
+    Fills in the parts of a cached thread that depend on the user, states are keyed by post uid.
+    """
+    def region(match):
+        name, uid, text = match.groups()
+        return text if states.get(uid, {}).get(name) else ''
+
+    def field(match):
+        name, uid = match.groups()
+        return str(states.get(uid, {}).get(name, 0))
+
+    html = OVERLAY_REGION.sub(region, html)
+    html = OVERLAY_FIELD.sub(field, html)
+    return html
+
+
+def build_thread(root, is_moderator, request):
+    """
+    Renders the answers and the comments of a thread for any user.
+    Returns the html of the answers, the html of the comments on the root
+    and the (uid, id, author id) of every post in the thread.
+    """
+    # Needs to be imported here to avoid circular imports.
+    from biostar.forum.templatetags.forum_tags import traverse_comments
+
+    thread = list(thread_query(root=root, is_moderator=is_moderator))
+
+    for post in thread:
+        # Tags rendering these posts leave markers in place of the user specific parts.
+        post.overlay = True
+
+    comment_tree = graph.ThreadGraph.from_posts(root_id=root.id, posts=thread).comment_tree()
+
+    body = loader.get_template("widgets/post_body.html")
+    answers = [p for p in thread if p.type == Post.ANSWER]
+    answers_html = ''.join(
+        f'<div class="ui vertical segment">{body.render(dict(post=post, tree=comment_tree, request=request))}</div>'
+        for post in answers)
+
+    comments_html = ''
+    if root.id in comment_tree:
+        comments_html = traverse_comments(request=request, post=root, tree=comment_tree,
+                                          template_name="widgets/comment_body.html")
+
+    posts = [(post.uid, post.id, post.author_id) for post in thread]
+
+    return answers_html, comments_html, posts
+
+
+def cached_thread(user, root, request):
+    """
+    Returns the decorated root, the html of its answers and of its comments.
+    The user independent html is cached until the thread changes, then the user specific parts are filled in.
+    """
+    is_moderator = user.is_authenticated and user.profile.is_moderator
+
+    # Moderators also see deleted posts.
+    key = f"THREAD-{root.id}-{int(is_moderator)}-{thread_version(root.id)}" if util.is_cache_shared() else None
+    value = cache.get(key) if key else None
+
+    if value is None:
+        value = build_thread(root=root, is_moderator=is_moderator, request=request)
+        if key:
+            cache.set(key, value, settings.THREAD_CACHE_SECS)
+
+    answers_html, comments_html, posts = value
+
+    votes = get_votes(user=user, root=root)
+    states = {uid: user_state(user=user, is_moderator=is_moderator, post_id=pid, author_id=author_id,
+                              is_toplevel=False, root_author_id=root.author_id, votes=votes)
+              for uid, pid, author_id in posts}
+
+    # The root post is rendered for each request.
+    state = user_state(user=user, is_moderator=is_moderator, post_id=root.id, author_id=root.author_id,
+                       is_toplevel=True, root_author_id=root.author_id, votes=votes)
+    for name, value in state.items():
+        setattr(root, name, value)
+    root.comments_html = apply_overlay(comments_html, states)
+
+    return root, apply_overlay(answers_html, states)
+
+
 def update_post_views(post, request, minutes=settings.POST_VIEW_MINUTES):
     "Views are updated per user session"
 
@@ -204,14 +447,9 @@ def update_post_views(post, request, minutes=settings.POST_VIEW_MINUTES):
     ip2 = '' if ip2.lower() == 'localhost' else ip2
     ip = ip1 or ip2 or '0.0.0.0'
 
-    now = util.now()
-    since = now - datetime.timedelta(minutes=minutes)
+    # One view per time interval from each IP address, written to the database in batches.
+    pageviews.record_view(post_id=post.pk, ip=ip, minutes=minutes)
 
-    # One view per time interval from each IP address.
-    if not PostView.objects.filter(ip=ip, post=post, date__gt=since).exists():
-        # Update the last time
-        PostView.objects.create(ip=ip, post=post, date=now)
-        Post.objects.filter(pk=post.pk).update(view_count=F('view_count') + 1)
     return post
 
 
@@ -233,31 +471,11 @@ def apply_vote(post, user, vote_type):
         change = 0
         return msg, vote, change
 
-    # Fetch user score
-    score = len(Vote.objects.filter(post__author=post.author).exclude(author=post.author))
-    # Update the user score.
-    Profile.objects.filter(user=post.author).update(score=score)
-
-    # Calculate counts for the current post
-    votes = list(Vote.objects.filter(post=post).exclude(author=post.author))
-    vote_count = len(votes)
-    bookcount = len(list(filter(lambda v: v.type == Vote.BOOKMARK, votes)))
-    accept_count = len(list(filter(lambda v: v.type == Vote.ACCEPT, votes)))
-
-    # Increment the post vote count.
-    Post.objects.filter(uid=post.uid).update(vote_count=vote_count)
-
-    # The thread vote count represents all votes in a thread
-    Post.objects.filter(uid=post.root.uid).update(thread_votecount=F('thread_votecount') + change)
+    # Update the author score and the vote counts.
+    ledger.apply_change(post=post, vote_type=vote_type, change=change)
 
-    # Increment the bookmark count.
-    if vote_type == Vote.BOOKMARK:
-        Post.objects.filter(uid=post.uid).update(book_count=bookcount)
-
-    # Handle accepted vote.
-    if vote_type == Vote.ACCEPT:
-        Post.objects.filter(uid=post.uid).update(accept_count=accept_count)
-        Post.objects.filter(uid=post.root.uid).update(accept_count=F('accept_count') + change)
+    # Threads show the vote counts.
+    bump_thread(post.root_id)
 
     return msg, vote, change
 
@@ -280,24 +498,18 @@ def delete_post(post, request):
 
     if delete_only:
         # Deleted posts can be undeleted by re-opening them.
+        counters.status_changed(post, status=Post.DELETED)
         Post.objects.filter(uid=post.uid).update(status=Post.DELETED)
+        add_tombstones(Post.objects.filter(uid=post.uid))
         url = post.root.get_absolute_url()
         messages.success(request, "Deleted post: %s" % post.title)
     # Remove post from the database with no trace.
     else:
         # This will remove the post. Redirect depends on the level of the post.
         url = "/" if post.is_toplevel else post.root.get_absolute_url()
-        post.delete()
+        delete_posts(Post.objects.filter(pk=post.pk))
         messages.success(request, "Removed post: %s" % post.title)
 
-    # Recompute answers count
-    if post.type == Post.ANSWER:
-        answer_count = Post.objects.filter(root=post.root, type=Post.ANSWER).count()
-        Post.objects.filter(pk=post.parent_id).update(answer_count=answer_count)
-
-    reply_count = Post.objects.filter(root=post.root).count()
-
-    Post.objects.filter(pk=post.root.id).update(reply_count=reply_count)
     log_action(user=request.user, log_text=f"Deleted post={post.uid}")
 
     return url
@@ -315,6 +527,10 @@ def handle_spam_post(post, user):
 
     # Label all posts by this users as spam.
     Post.objects.filter(author=post.author).update(spam=Post.SPAM)
+    root_ids = Post.objects.filter(author=post.author).values_list("root_id", flat=True)
+    counters.recount(root_ids=root_ids)
+    bump_thread(*root_ids)
+    add_tombstones(Post.objects.filter(author=post.author))
     log_action(user=user, log_text=f"Reported post={post.uid} as spam.")
     return url
 
@@ -325,6 +541,9 @@ def moderate_post(request, action, post, offtopic='', comment=None, dupes=[], pi
     now = datetime.datetime.utcnow().replace(tzinfo=utc)
     url = post.get_absolute_url()
 
+    # Every action may change what the thread shows.
+    bump_thread(root.id)
+
     if action == BUMP_POST:
         Post.objects.filter(uid=post.uid).update(lastedit_date=now, rank=now.timestamp(), last_contributor=request.user)
         messages.success(request, "Post bumped")
@@ -332,7 +551,10 @@ def moderate_post(request, action, post, offtopic='', comment=None, dupes=[], pi
         return url
 
     if action == OPEN_POST:
-        Post.objects.filter(uid=post.uid).update(status=Post.OPEN, spam=Post.NOT_SPAM)
+        # Re-opened posts are indexed again.
+        counters.status_changed(post, status=Post.OPEN, spam=Post.NOT_SPAM)
+        Post.objects.filter(uid=post.uid).update(status=Post.OPEN, spam=Post.NOT_SPAM, indexed=False)
+        Tombstone.objects.filter(uid=post.uid).delete()
         messages.success(request, f"Opened post: {post.title}")
         log_action(user=user, log_text=f"Opened post={post.uid}")
         return url
@@ -341,6 +563,7 @@ def moderate_post(request, action, post, offtopic='', comment=None, dupes=[], pi
         return delete_post(post=post, request=request)
 
     if action == MOVE_ANSWER:
+        counters.moved(post, parent_id=post.parent_id, post_type=Post.ANSWER)
         Post.objects.filter(uid=post.uid).update(type=Post.ANSWER)
         log_action(user=user, log_text=f"Moved post={post.uid} to answer. ")
         return url
@@ -350,8 +573,8 @@ def moderate_post(request, action, post, offtopic='', comment=None, dupes=[], pi
 
     if pid:
         parent = Post.objects.filter(uid=pid).first() or post.root
+        counters.moved(post, parent_id=parent.id, post_type=Post.COMMENT)
         Post.objects.filter(uid=post.uid).update(type=Post.COMMENT, parent=parent)
-        Post.objects.filter(uid=root.uid).update(reply_count=F("answer_count") - 1)
         messages.success(request, "Moved answer to comment")
         log_action(user=user, log_text=f"Moved post={post.uid} to comment.")
         return url
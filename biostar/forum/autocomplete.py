@@ -0,0 +1,241 @@
+"""
+Prefix completion for post titles, tag names and user handles.
+
+Each process keeps the entries in a sorted list and finds the matching range
+with a binary search. The best completions of prefixes that match many entries
+are kept until an entry under that prefix changes.
+"""
+import bisect
+import heapq
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.shortcuts import reverse
+from taggit.models import Tag
+
+from biostar.accounts.models import Profile
+from biostar.forum.models import Post
+from biostar.forum.search import url_maker
+
+logger = logging.getLogger("engine")
+
+POST, TAG, USER = "post", "tag", "user"
+KINDS = (POST, TAG, USER)
+
+# Only the start of long titles is used for completion.
+MAX_KEY_LEN = 100
+
+# Prefixes matching more entries than this keep their best completions.
+SCAN_LIMIT = 200
+
+# Sorts after any character that may follow a prefix.
+KEY_END = "\U0010ffff"
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())[:MAX_KEY_LEN]
+
+
+class Completer(object):
+    """
+    Weighted prefix completion over a sorted list of (key, kind, ident) tuples.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+        # Sorted (key, kind, ident) tuples.
+        self.keys = []
+
+        # The (key, label, weight) of each entry keyed by (kind, ident).
+        self.entries = {}
+
+        # The limit and best completions, keyed by prefix then by the kinds asked for.
+        self.top = {}
+
+        # When the entries were last read from the database.
+        self.built = None
+
+    def add(self, kind, ident, label, weight=0):
+        """
+        Adds or replaces an entry.
+        """
+        key = normalize(label)
+        with self.lock:
+            self.remove(kind, ident)
+            if not key:
+                return
+            bisect.insort(self.keys, (key, kind, ident))
+            self.entries[(kind, ident)] = (key, label, weight)
+            self.invalidate(key)
+
+    def remove(self, kind, ident):
+        with self.lock:
+            entry = self.entries.pop((kind, ident), None)
+            if entry is None:
+                return
+            key = entry[0]
+            idx = bisect.bisect_left(self.keys, (key, kind, ident))
+            if idx < len(self.keys) and self.keys[idx] == (key, kind, ident):
+                del self.keys[idx]
+            self.invalidate(key)
+
+    def remove_many(self, kind, idents):
+        """
+        Removes entries with one pass over the sorted keys.
+        """
+        with self.lock:
+            removed = {(kind, ident) for ident in idents if (kind, ident) in self.entries}
+            if not removed:
+                return
+            for item in removed:
+                self.invalidate(self.entries.pop(item)[0])
+            self.keys = [(key, kind, ident) for key, kind, ident in self.keys if (kind, ident) not in removed]
+
+    def invalidate(self, key):
+        # Drop the completions kept for every prefix of the key.
+        for end in range(len(key) + 1):
+            self.top.pop(key[:end], None)
+
+    def load(self, entries):
+        """
+        Replaces all entries with (kind, ident, label, weight) tuples.
+        """
+        keys, values = [], {}
+        for kind, ident, label, weight in entries:
+            key = normalize(label)
+            if key:
+                keys.append((key, kind, ident))
+                values[(kind, ident)] = (key, label, weight)
+        keys.sort()
+
+        with self.lock:
+            self.keys, self.entries, self.top = keys, values, {}
+            self.built = time.time()
+
+    def complete(self, prefix, limit=10, kinds=KINDS):
+        """
+        Returns the (kind, ident, label, weight) of the heaviest entries starting with the prefix.
+        """
+        prefix = normalize(prefix)
+        kinds = tuple(sorted(kinds))
+        if not prefix:
+            return []
+
+        with self.lock:
+            size, found = self.top.get(prefix, {}).get(kinds, (0, None))
+            if size >= limit:
+                return found[:limit]
+
+            lo = bisect.bisect_left(self.keys, (prefix,))
+            hi = bisect.bisect_left(self.keys, (prefix + KEY_END,), lo)
+
+            stream = (self.keys[idx][1:] for idx in range(lo, hi))
+            stream = (item for item in stream if item[0] in kinds)
+            best = heapq.nlargest(limit, stream, key=lambda item: self.entries[item][2])
+            found = [(kind, ident, *self.entries[(kind, ident)][1:]) for kind, ident in best]
+
+            if hi - lo > SCAN_LIMIT:
+                self.top.setdefault(prefix, {})[kinds] = (limit, found)
+
+            return found
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def post_entry(post):
+    return POST, post.uid, post.title, post.view_count
+
+
+def is_completed(post):
+    return post.is_toplevel and post.status == Post.OPEN and not post.is_spam
+
+
+def is_listed(profile):
+    return profile.state not in (Profile.BANNED, Profile.SUSPENDED, Profile.SPAMMER)
+
+
+def get_entries():
+    """
+    Reads the completion entries from the database.
+    """
+    posts = Post.objects.filter(is_toplevel=True, status=Post.OPEN).exclude(spam=Post.SPAM)
+    for uid, title, views in posts.values_list("uid", "title", "view_count").iterator():
+        yield POST, uid, title, views
+
+    count = Count('post', filter=Q(post__is_toplevel=True))
+    tags = Tag.objects.annotate(nitems=count).filter(nitems__gt=0)
+    for name, nitems in tags.values_list("name", "nitems").iterator():
+        yield TAG, name, name, nitems
+
+    users = Profile.objects.exclude(state__in=[Profile.BANNED, Profile.SUSPENDED, Profile.SPAMMER])
+    for uid, username, score in users.values_list("uid", "user__username", "score").iterator():
+        yield USER, uid, username, score
+
+
+# Completions served by this process.
+COMPLETER = Completer()
+
+
+def get_completer():
+    """
+    Returns the completer, reading it from the database when it is missing or too old.
+    Saves in other processes are picked up on the next rebuild.
+    """
+    built = COMPLETER.built
+    if built is None or time.time() - built > settings.AUTOCOMPLETE_REBUILD_SECS:
+        start = time.time()
+        COMPLETER.load(get_entries())
+        logger.info(f"Loaded {len(COMPLETER)} completions in {time.time() - start:.2f} seconds")
+
+    return COMPLETER
+
+
+def update_post(post):
+    """
+    Keeps the title and new tags of a saved post in the completer.
+    """
+    if COMPLETER.built is None:
+        return
+
+    if not is_completed(post):
+        COMPLETER.remove(POST, post.uid)
+        return
+
+    COMPLETER.add(*post_entry(post))
+    for name in post.parse_tags():
+        if (TAG, name) not in COMPLETER.entries:
+            COMPLETER.add(TAG, name, name, 1)
+
+
+def update_profile(profile):
+    """
+    Keeps the handle and score of a saved profile in the completer.
+    """
+    if COMPLETER.built is None:
+        return
+
+    if is_listed(profile):
+        COMPLETER.add(USER, profile.uid, profile.user.username, profile.score)
+    else:
+        COMPLETER.remove(USER, profile.uid)
+
+
+def complete(prefix, limit=10, kinds=KINDS):
+    """
+    Returns the completions for a prefix as dictionaries with the url of each entry.
+    """
+    tag_url = reverse("post_list")
+    urls = {POST: url_maker("post_view"), USER: url_maker("user_profile"),
+            TAG: lambda name: f"{tag_url}?tag={quote(name)}"}
+
+    found = get_completer().complete(prefix, limit=limit, kinds=kinds)
+    results = [dict(kind=kind, label=label, weight=weight, url=urls[kind](ident))
+               for kind, ident, label, weight in found]
+
+    return results
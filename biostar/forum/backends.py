@@ -0,0 +1,409 @@
+"""
+Search engines the forum can use, selected with the SEARCH_BACKEND setting.
+
+    whoosh      the index directory built by biostar.forum.search
+    database    full text search inside the database, an FTS5 table on SQLite
+                and a tsvector column with a GIN index on Postgres.
+"""
+import logging
+import math
+import re
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, CharField, Count, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+from biostar.forum import search, util
+from biostar.forum.models import Post, Tombstone
+
+logger = logging.getLogger("engine")
+
+
+class SearchBackend(object):
+    """
+    Operations a search engine provides to the forum.
+
+    Writers have the interface of a whoosh writer: update_document(**doc),
+    delete_by_term("uid", uid), commit(optimize=False) and cancel().
+    """
+    name = None
+
+    # Documents hold only the fields of the slim schema.
+    slim = False
+
+    def exists(self):
+        raise NotImplementedError
+
+    def writer(self):
+        raise NotImplementedError
+
+    def rebuild(self, procs=1, slim=None):
+        """
+        Replaces the content of the index with every searchable post. Returns (total, rate).
+        """
+        raise NotImplementedError
+
+    def search(self, query, fields=None, page=1, per_page=20, filters=None, cache=True):
+        """
+        Returns a SearchPage with the facet counts of all matches.
+        """
+        raise NotImplementedError
+
+    def more_like_this(self, uid, top=None):
+        """
+        Returns SearchResult objects for the top level posts similar to the post.
+        """
+        raise NotImplementedError
+
+    def facets(self, query, fields=None, filters=None):
+        return self.search(query=query, fields=fields, filters=filters, cache=False).facets
+
+    def index(self, posts):
+        """
+        Adds or replaces the documents of posts.
+        """
+        writer = self.writer()
+        try:
+            for doc in search.stream_documents(posts, slim=self.slim):
+                writer.update_document(**doc)
+            writer.commit()
+        except Exception:
+            writer.cancel()
+            raise
+
+    def delete(self, uids):
+        writer = self.writer()
+        for uid in uids:
+            writer.delete_by_term("uid", uid)
+        writer.commit()
+
+
+class WhooshBackend(SearchBackend):
+    """
+    The index directory managed by biostar.forum.search.
+    """
+    name = "whoosh"
+
+    @property
+    def slim(self):
+        return search.is_slim(search.init_index().schema)
+
+    def exists(self):
+        return search.index_exists()
+
+    def writer(self):
+        return search.init_index().writer()
+
+    def rebuild(self, procs=1, slim=None):
+        return search.rebuild_index(procs=procs, slim=slim)
+
+    def search(self, query, fields=None, page=1, per_page=20, filters=None, cache=True):
+        if cache:
+            return search.cached_search(query=query, fields=fields, page=page, per_page=per_page, filters=filters)
+
+        results, compact = search.run_search(query=query, fields=fields, page=page, per_page=per_page,
+                                             filters=filters)
+        return results
+
+    def more_like_this(self, uid, top=None):
+        return search.whoosh_more_like_this(uid=uid, top=top)
+
+
+# Columns of the database table holding each document field.
+FIELD_COLUMNS = dict(title="title", tags="tags", author="author", author_handle="author",
+                     author_uid="author", content="content")
+
+# Postgres keeps all fields in one vector, the weight label tells them apart.
+COLUMN_WEIGHTS = dict(title="A", tags="B", author="C", content="D")
+
+
+def query_terms(query):
+    """
+    Words of the query without stop words. The query language of whoosh is not supported.
+    """
+    terms = re.findall(r"\w+", query.lower())
+    terms = [term for term in terms if term not in search.STOP]
+    return list(dict.fromkeys(terms))
+
+
+class DatabaseWriter(object):
+    """
+    Collects changes to the database table and writes them in one transaction.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.docs = {}
+        self.deleted = set()
+
+    def update_document(self, **doc):
+        self.docs[doc['uid']] = doc
+        self.deleted.discard(doc['uid'])
+
+    def delete_by_term(self, fieldname, text):
+        self.docs.pop(text, None)
+        self.deleted.add(text)
+
+    def commit(self, optimize=False, **kwargs):
+        uids = list(self.docs) + list(self.deleted)
+        ids = dict(Post.objects.filter(uid__in=uids).values_list("uid", "id"))
+
+        with transaction.atomic():
+            # Removed posts that are gone from the database are not found by searches.
+            self.backend.remove([ids[uid] for uid in uids if uid in ids])
+            self.backend.store([(ids[uid], doc) for uid, doc in self.docs.items() if uid in ids])
+            if optimize:
+                self.backend.optimize()
+
+        self.cancel()
+
+    def cancel(self):
+        self.docs, self.deleted = {}, set()
+
+
+class DatabaseBackend(SearchBackend):
+    """
+    Full text search with the database engine. The table is created by a migration.
+    No index directory is needed and the writes are ordinary transactions, safe with many workers.
+    """
+    name = "database"
+    table = "forum_search"
+
+    @property
+    def vendor(self):
+        return connection.vendor
+
+    def exists(self):
+        return self.table in connection.introspection.table_names()
+
+    def writer(self):
+        return DatabaseWriter(backend=self)
+
+    def store(self, docs):
+        """
+        Inserts (post id, document) pairs.
+        """
+        if self.vendor == 'postgresql':
+            sql = f"""
+                INSERT INTO {self.table} (post_id, document) VALUES (%s,
+                    setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B') ||
+                    setweight(to_tsvector('simple', %s), 'C') || setweight(to_tsvector('english', %s), 'D'))
+                ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document
+                """
+        else:
+            sql = f"INSERT INTO {self.table} (rowid, title, tags, author, content) VALUES (%s, %s, %s, %s, %s)"
+
+        rows = [(pk, doc['title'], doc['tags'].replace(",", " "),
+                 f"{doc['author']} {doc['author_handle']} {doc['author_uid']}", doc['content']) for pk, doc in docs]
+
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+    def remove(self, ids):
+        column = "post_id" if self.vendor == 'postgresql' else "rowid"
+        with connection.cursor() as cursor:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                marks = ','.join(['%s'] * len(chunk))
+                cursor.execute(f"DELETE FROM {self.table} WHERE {column} IN ({marks})", chunk)
+
+    def optimize(self):
+        # Postgres relies on autovacuum.
+        if self.vendor == 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid NOT IN (SELECT id FROM forum_post)")
+            cursor.execute(f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+
+    def match(self, terms, fields):
+        """
+        Returns the sql and parameters selecting the ids of posts matching any of the terms.
+        """
+        columns = sorted({FIELD_COLUMNS[name] for name in fields if name in FIELD_COLUMNS})
+
+        # Fields without a column of their own search all columns.
+        columns = columns or sorted(COLUMN_WEIGHTS)
+
+        if self.vendor == 'postgresql':
+            weights = ''.join(sorted(COLUMN_WEIGHTS[column] for column in columns))
+            value = ' | '.join(f"{term}:{weights}" for term in terms)
+            sql = f"SELECT post_id FROM {self.table} WHERE document @@ to_tsquery('english', %s)"
+        else:
+            # Quotes inside an FTS5 string are doubled.
+            words = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+            value = f"{{{' '.join(columns)}}} : ({words})"
+            sql = f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s"
+
+        return sql, [value]
+
+    def ranked(self, terms, fields, limit):
+        """
+        Returns the ids of the posts that match the terms best.
+        """
+        sql, params = self.match(terms, fields)
+        if self.vendor == 'postgresql':
+            sql = f"{sql} ORDER BY ts_rank(document, to_tsquery('english', %s)) DESC LIMIT %s"
+            params = params + params + [limit]
+        else:
+            sql = f"{sql} ORDER BY rank LIMIT %s"
+            params = params + [limit]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self, procs=1, slim=None):
+        started = util.now()
+        start = time.time()
+
+        posts = Post.objects.exclude(root=None).exclude(status=Post.DELETED).exclude(spam=Post.SPAM)
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {self.table}")
+            self.index(posts)
+
+        Post.objects.exclude(root=None).filter(lastedit_date__lte=started).update(indexed=True)
+        Tombstone.objects.filter(date__lte=started).delete()
+
+        total = posts.count()
+        secs = time.time() - start
+        rate = total / secs if secs else total
+        logger.info(f"Rebuilt the database index with {total} posts in {secs:.1f} seconds")
+
+        return total, rate
+
+    def search(self, query, fields=None, page=1, per_page=20, filters=None, cache=True):
+        terms = query_terms(query)
+        if len(query) < settings.SEARCH_CHAR_MIN or not terms:
+            return search.SearchPage()
+
+        sql, params = self.match(terms, fields or search.DEFAULT_FIELDS)
+        posts = Post.objects.filter(id__in=RawSQL(sql, params))
+        if filters:
+            posts = posts.filter(get_filter(filters))
+
+        total = posts.count()
+        if not total:
+            return search.SearchPage()
+
+        # Out of range pages show the last page, as whoosh does.
+        pagecount = math.ceil(total / per_page)
+        pagenum = min(max(1, page), pagecount)
+        start = (pagenum - 1) * per_page
+
+        uids = list(posts.order_by("-lastedit_date").values_list("uid", flat=True)[start:start + per_page])
+        docs = search.hydrate(uids)
+
+        hits = []
+        for uid in filter(lambda uid: uid in docs, uids):
+            doc = docs[uid]
+            doc.update(score=0, highlights='')
+            hits.append(doc)
+
+        # Count the tags of the matches, not only the one filtered on.
+        matches = Post.objects.filter(id__in=posts.values("id")) if 'tag' in (filters or {}) else posts
+
+        return search.SearchPage(hits=hits, total=total, pagenum=pagenum, pagecount=pagecount,
+                                 facets=facet_counts(matches))
+
+    def more_like_this(self, uid, top=None):
+        top = top or settings.SIMILAR_FEED_COUNT
+        post = Post.objects.filter(uid=uid).first()
+        if not post:
+            return []
+
+        # Match the title and tags of the post against other threads.
+        terms = query_terms(f"{post.title} {post.tag_val.replace(',', ' ')}")
+        if not terms:
+            return []
+
+        ids = self.ranked(terms, fields=["title", "tags", "content"], limit=top * 3)
+        ids = [pk for pk in ids if pk != post.id]
+        found = dict(Post.objects.filter(id__in=ids, is_toplevel=True).values_list("id", "uid"))
+        uids = [found[pk] for pk in ids if pk in found][:top]
+
+        docs = search.hydrate(uids)
+        return [search.normalize_result(docs[uid]) for uid in uids if uid in docs]
+
+
+def get_filter(filters):
+    """
+    Returns a Q object with the facet filters of search.parse_filters.
+    """
+    query = Q()
+    if 'type' in filters:
+        query &= Q(type=filters['type'])
+    if 'tag' in filters:
+        query &= Q(tags__name=filters['tag'])
+    if 'created' in filters:
+        bounds = {name: (start, end) for name, start, end in search.date_buckets()}
+        start, end = bounds[filters['created']]
+        if start:
+            query &= Q(creation_date__gte=start)
+        if end:
+            query &= Q(creation_date__lt=end)
+    return query
+
+
+def facet_counts(posts):
+    """
+    Counts the posts by type, creation date bucket and tag, in the format of search.facet_counts.
+    """
+    types = posts.order_by().values_list("type").annotate(total=Count("id")).order_by("-total")
+
+    buckets = [When(creation_date__gte=start, then=Value(name)) for name, start, end in search.date_buckets()
+               if start]
+    bucket = Case(*buckets, default=Value(search.DATE_BUCKETS[-1][0]), output_field=CharField())
+    created = posts.order_by().annotate(bucket=bucket).values_list("bucket").annotate(total=Count("id"))
+    order = [name for name, days in search.DATE_BUCKETS]
+
+    tags = posts.order_by().exclude(tags=None).values_list("tags__name").annotate(total=Count("id"))
+    tags = tags.order_by("-total")[:settings.SEARCH_FACET_TAGS]
+
+    return dict(type=list(types), created=sorted(created, key=lambda item: order.index(item[0])),
+                tags=list(tags))
+
+
+BACKENDS = dict(whoosh=WhooshBackend, database=DatabaseBackend)
+
+
+def get_backend(name=None):
+    """
+    Returns the search backend with the given name, the one in the settings by default.
+    """
+    name = name or settings.SEARCH_BACKEND
+    return BACKENDS[name]()
+
+
+def benchmark(queries=None, repeat=3, per_page=20, names=None):
+    """
+    Rebuilds every backend from the database then runs the same queries against each one.
+    Returns the rebuild rate, the time per query and the overlap of the first page with whoosh.
+    """
+    queries = queries or search.sample_queries()
+    names = names or list(BACKENDS)
+    stats, pages = {}, {}
+
+    for name in names:
+        backend = get_backend(name)
+        total, rate = backend.rebuild()
+
+        start = time.time()
+        for step in range(repeat):
+            pages[name] = [backend.search(query, page=1, per_page=per_page, cache=False) for query in queries]
+        msecs = 1000 * (time.time() - start) / (repeat * len(queries)) if queries else 0
+
+        stats[name] = dict(total=total, rate=rate, msecs=msecs)
+
+    # Fraction of the first page shared with the whoosh results.
+    for name in names:
+        shared = []
+        for first, other in zip(pages.get("whoosh", []), pages[name]):
+            first, other = {hit['uid'] for hit in first}, {hit['uid'] for hit in other}
+            shared.append(len(first & other) / len(first | other) if first | other else 1)
+        stats[name]['overlap'] = sum(shared) / len(shared) if shared else 0
+
+    return stats
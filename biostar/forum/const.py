@@ -2,7 +2,7 @@
 BUMP_POST, OPEN_POST, TOGGLE_ACCEPT, MOVE_ANSWER, DUPLICATE, OFFTOPIC, DELETE, REPORT_SPAM = range(8)
 
 # Valid values for the order GET parameter.
-RANK, VIEWS, REPLIES = ("rank", "views", "replies")
+RANK, VIEWS, REPLIES, VIEWERS = ("rank", "views", "replies", "viewers")
 
 MYVOTES_CACHE_KEY = "MYVOTES"
 TAGS_CACHE_KEY = "TAGS"
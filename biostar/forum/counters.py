@@ -0,0 +1,151 @@
+"""
+Keeps the reply, answer, comment, subscription and accept counts of threads up to date.
+
+Changes to a thread are applied as increments. The counts are rebuilt from the
+posts, subscriptions and votes, for all threads at once, by recount().
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from biostar.forum.models import Post, Subscription, Vote
+
+logger = logging.getLogger("engine")
+
+
+def is_visible(post):
+    """
+    Deleted and spam posts are not counted.
+    """
+    return post.status != Post.DELETED and post.spam != Post.SPAM
+
+
+def is_counted(sub):
+    return sub is not None and sub.type != Subscription.NO_MESSAGES
+
+
+def apply_delta(root_id, parent_id, post_type, change):
+    """
+    Adds a reply of a given type to the root and the parent.
+    """
+    counts = dict(reply_count=F("reply_count") + change)
+    if post_type == Post.ANSWER:
+        counts.update(answer_count=F("answer_count") + change)
+    if post_type == Post.COMMENT:
+        counts.update(comment_count=F("comment_count") + change)
+    Post.objects.filter(pk=root_id).update(**counts)
+
+    # Other parents count their direct replies only.
+    if parent_id != root_id:
+        counts.pop("answer_count", None)
+        Post.objects.filter(pk=parent_id).update(**counts)
+
+
+def created(post):
+    if post.pk != post.root_id and is_visible(post):
+        apply_delta(post.root_id, post.parent_id, post.type, +1)
+
+
+def removed(post):
+    if post.pk != post.root_id and is_visible(post):
+        apply_delta(post.root_id, post.parent_id, post.type, -1)
+
+
+def status_changed(post, status=None, spam=None):
+    """
+    Counts a post whose status or spam label is about to change. The post holds the current values.
+    """
+    if post.pk == post.root_id:
+        return
+
+    status = post.status if status is None else status
+    spam = post.spam if spam is None else spam
+    change = int(status != Post.DELETED and spam != Post.SPAM) - int(is_visible(post))
+    if change:
+        apply_delta(post.root_id, post.parent_id, post.type, change)
+
+
+@transaction.atomic
+def moved(post, parent_id, post_type):
+    """
+    Counts a post that is about to get a new parent or type. The post holds the current values.
+    """
+    if post.pk == post.root_id or not is_visible(post):
+        return
+
+    apply_delta(post.root_id, post.parent_id, post.type, -1)
+    apply_delta(post.root_id, parent_id, post_type, +1)
+
+
+def subscription_changed(root_id, before, after):
+    """
+    Counts the change from one subscription to another, either may be None.
+    """
+    change = int(is_counted(after)) - int(is_counted(before))
+    if change:
+        Post.objects.filter(pk=root_id).update(subs_count=F("subs_count") + change)
+
+
+def subscriptions_added(root_id, subs):
+    """
+    Counts new subscriptions to a thread.
+    """
+    change = sum(int(is_counted(sub)) for sub in subs)
+    if change:
+        Post.objects.filter(pk=root_id).update(subs_count=F("subs_count") + change)
+
+
+@transaction.atomic
+def subscriptions_removed(subs):
+    """
+    Counts subscriptions that are about to be deleted, by thread.
+    """
+    counted = subs.exclude(type=Subscription.NO_MESSAGES).order_by().values("post_id")
+    for row in counted.annotate(total=Count("pk")):
+        Post.objects.filter(pk=row["post_id"]).update(subs_count=F("subs_count") - row["total"])
+
+
+def grouped(query, key, outer="pk"):
+    """
+    The number of rows in the query that match the outer row on the key, zero when none do.
+    """
+    query = query.filter(**{key: OuterRef(outer)}).order_by().values(key)
+    query = query.annotate(total=Count("pk")).values("total")
+    return Coalesce(Subquery(query, output_field=IntegerField()), 0)
+
+
+@transaction.atomic
+def recount(root_ids=None):
+    """
+    Rebuilds the counts of the threads with the given roots, of all threads when none are given.
+    Returns the number of posts that were updated.
+    """
+    posts = Post.objects.all()
+    if root_ids is not None:
+        posts = posts.filter(root_id__in=set(root_ids))
+
+    visible = Post.objects.exclude(status=Post.DELETED).exclude(spam=Post.SPAM)
+    replies = visible.exclude(pk=F("root_id"))
+    subs = Subscription.objects.exclude(type=Subscription.NO_MESSAGES)
+
+    # Votes on their own posts do not count.
+    accepts = Vote.objects.filter(type=Vote.ACCEPT).exclude(author=F("post__author"))
+
+    # The root counts cover the whole thread.
+    roots = posts.filter(pk=F("root_id"))
+    nroots = roots.update(reply_count=grouped(replies, "root"),
+                          answer_count=grouped(replies.filter(type=Post.ANSWER), "root"),
+                          comment_count=grouped(replies.filter(type=Post.COMMENT), "root"),
+                          subs_count=grouped(subs, "post"),
+                          accept_count=grouped(accepts, "post__root"))
+
+    # Other posts count their direct replies.
+    others = posts.exclude(pk=F("root_id"))
+    nothers = others.update(reply_count=grouped(replies, "parent"),
+                            answer_count=0,
+                            comment_count=grouped(replies.filter(type=Post.COMMENT), "parent"),
+                            accept_count=grouped(accepts, "post"))
+
+    return nroots + nothers
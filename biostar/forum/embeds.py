@@ -0,0 +1,121 @@
+"""
+Embedded tweets are fetched in the background and kept in the database.
+
+Posts are saved with a placeholder link in place of each embed that is not
+known yet. A task fetches the missing embeds and puts them into the html.
+Embeds stay marked in the html, the cleanup command retries failed embeds and
+refreshes expired ones with refresh_posts().
+"""
+import logging
+import re
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+
+from biostar.forum import util
+from biostar.forum.models import Post, Embed
+
+logger = logging.getLogger("engine")
+
+# A placeholder in the html of a post.
+EMBED_REGION = re.compile(r"<!--embed:(?P<url>[^>]+?)-->(?P<text>.*?)<!--/embed-->", re.DOTALL)
+
+
+# Marks the start of an embed in the html of a post.
+EMBED_START = "<!--embed:"
+
+
+def region(url, html):
+    return f'{EMBED_START}{url}-->{html}<!--/embed-->'
+
+
+def placeholder(url):
+    return region(url, f'<a href="{url}">{url}</a>')
+
+
+def cached(urls):
+    """
+    Returns the html of the embeds that have not expired, keyed by url. Failed embeds have no html.
+    """
+    embeds = Embed.objects.filter(url__in=urls, expires__gt=util.now())
+    return dict(embeds.values_list("url", "html"))
+
+
+def fetch(url):
+    """
+    Returns the html of an embedded tweet, an empty string when it can not be fetched.
+    """
+    try:
+        response = requests.get(settings.TWITTER_OEMBED_URL, params=dict(url=url), timeout=settings.EMBED_TIMEOUT)
+        response.raise_for_status()
+        return response.json().get('html') or ''
+    except Exception as exc:
+        logger.warning(f"Error fetching embed {url}: {exc}")
+        return ''
+
+
+def resolve(urls):
+    """
+    Returns the html of each url, fetching the embeds that are missing or expired.
+    """
+    urls = set(urls)
+    found = cached(urls)
+
+    for url in urls - set(found):
+        html = fetch(url)
+        now = util.now()
+        secs = settings.EMBED_CACHE_SECS if html else settings.EMBED_RETRY_SECS
+        Embed.objects.update_or_create(url=url, defaults=dict(html=html, date=now,
+                                                              expires=now + timedelta(seconds=secs)))
+        found[url] = html
+
+    return found
+
+
+def patch(html, embeds):
+    """
+    Replaces the placeholders that have an embed.
+    """
+    def replace(match):
+        url = match.group("url")
+        return region(url, embeds[url]) if embeds.get(url) else match.group(0)
+
+    return EMBED_REGION.sub(replace, html)
+
+
+def has_placeholders(html):
+    return bool(html) and EMBED_REGION.search(html) is not None
+
+
+def refresh_posts():
+    """
+    Resolves the embeds of every post that has some. Placeholders whose failed fetch
+    has expired are fetched again, as are the expired embeds. Returns the number of posts updated.
+    """
+    posts = Post.objects.filter(html__contains=EMBED_START).values_list("id", flat=True)
+    return sum(resolve_post(post_id) for post_id in posts.iterator())
+
+
+def resolve_post(post_id):
+    """
+    Fetches the embeds of a post and puts them into its html. Returns True when the html changed.
+    """
+    # Needs to be imported here to avoid circular imports.
+    from biostar.forum import auth
+
+    post = Post.objects.filter(id=post_id).only("id", "root_id", "html").first()
+    if not post or not has_placeholders(post.html):
+        return False
+
+    embeds = resolve(match.group("url") for match in EMBED_REGION.finditer(post.html))
+    html = patch(post.html, embeds)
+    if html == post.html:
+        return False
+
+    # Edits saved while fetching win over the patched html.
+    updated = Post.objects.filter(id=post.id, html=post.html).update(html=html)
+    if updated:
+        auth.bump_thread(post.root_id)
+
+    return bool(updated)
@@ -8,7 +8,7 @@ from snowpenguin.django.recaptcha2.fields import ReCaptchaField
 from snowpenguin.django.recaptcha2.widgets import ReCaptchaWidget
 from biostar.accounts.models import User
 from .models import Post
-from biostar.forum import models, auth
+from biostar.forum import models, auth, graph
 
 from .const import *
 
@@ -234,8 +234,11 @@ class PostModForm(forms.Form):
         if not parent and pid:
             raise forms.ValidationError(f"Parent id: {pid} does not exist.")
 
-        if parent and parent.root != self.post.root:
+        if parent and parent.root_id != self.post.root_id:
             raise forms.ValidationError(f"Parent does not share the same root.")
 
+        if parent and not graph.ThreadGraph.load(root_id=self.post.root_id).can_move(self.post.id, parent.id):
+            raise forms.ValidationError(f"Post can not be moved below itself.")
+
         return self.cleaned_data
 
@@ -0,0 +1,114 @@
+"""
+The parent and child links of the posts in a thread.
+
+A thread is read with a single query and walked in memory, to check where posts
+may be moved and to group the comments under their parents.
+"""
+import logging
+from collections import defaultdict
+
+from biostar.forum.models import Post
+
+logger = logging.getLogger("engine")
+
+
+class ThreadGraph(object):
+    """
+    Adjacency of the posts in one thread built from (id, parent_id, type, status) rows.
+    """
+
+    def __init__(self, root_id, rows, posts=None):
+        self.root_id = root_id
+
+        # The parent, type and status of each post keyed by post id.
+        self.parents, self.types, self.statuses = {}, {}, {}
+
+        # The ids of the replies to each post in the order the rows came in.
+        self.children = defaultdict(list)
+
+        # The post objects keyed by id, when the graph was built from posts.
+        self.posts = posts or {}
+
+        for pk, parent_id, post_type, status in rows:
+            self.parents[pk] = parent_id
+            self.types[pk] = post_type
+            self.statuses[pk] = status
+            # The root is its own parent.
+            if pk != parent_id:
+                self.children[parent_id].append(pk)
+
+    @classmethod
+    def load(cls, root_id):
+        """
+        Reads the graph of a thread with one query.
+        """
+        rows = Post.objects.filter(root_id=root_id).values_list("id", "parent_id", "type", "status")
+        return cls(root_id=root_id, rows=rows)
+
+    @classmethod
+    def from_posts(cls, root_id, posts):
+        """
+        Builds the graph of posts that were already read.
+        """
+        posts = {post.id: post for post in posts}
+        rows = [(post.id, post.parent_id, post.type, post.status) for post in posts.values()]
+        return cls(root_id=root_id, rows=rows, posts=posts)
+
+    def __contains__(self, pk):
+        return pk in self.parents
+
+    def __len__(self):
+        return len(self.parents)
+
+    def descendants(self, pk):
+        """
+        Returns the ids of all replies below a post.
+        """
+        found, stack = set(), list(self.children.get(pk, []))
+        while stack:
+            child = stack.pop()
+            if child in found:
+                continue
+            found.add(child)
+            stack.extend(self.children.get(child, []))
+        return found
+
+    def ancestors(self, pk):
+        """
+        Returns the ids of the posts above a post, from its parent up to the root.
+        """
+        found, seen = [], {pk}
+        parent = self.parents.get(pk)
+        while parent is not None and parent not in seen:
+            found.append(parent)
+            seen.add(parent)
+            parent = self.parents.get(parent)
+        return found
+
+    def depth(self, pk):
+        """
+        The number of posts above a post, zero for the root.
+        """
+        return len(self.ancestors(pk))
+
+    def creates_cycle(self, pk, parent_id):
+        """
+        True when a post would end up below itself with the given parent.
+        """
+        return parent_id == pk or parent_id in self.descendants(pk)
+
+    def can_move(self, pk, parent_id):
+        """
+        Posts other than the root may move under any post of the thread that is not below them.
+        """
+        return pk in self and parent_id in self and pk != self.root_id and not self.creates_cycle(pk, parent_id)
+
+    def comment_tree(self):
+        """
+        Returns the comment objects keyed by parent id, needs a graph built from posts.
+        """
+        tree = dict()
+        for pk, post in self.posts.items():
+            if self.types[pk] == Post.COMMENT:
+                tree.setdefault(self.parents[pk], []).append(post)
+        return tree
@@ -0,0 +1,102 @@
+"""
+Keeps the scores of users and the vote counts of posts up to date with increments.
+
+Each change to a score is appended to a ledger. The scores and vote counts are
+checked against aggregates of the votes, and repaired with the same aggregates,
+by reconcile(). The accept counts are rebuilt by counters.recount().
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from biostar.accounts.models import Profile
+from biostar.forum import counters
+from biostar.forum.models import Post, Vote, ScoreChange
+
+logger = logging.getLogger("engine")
+
+# Corrections inserted by each statement when repairing scores.
+BATCH_SIZE = 500
+
+
+def apply_change(post, vote_type, change):
+    """
+    Applies an added (+1) or removed (-1) vote by a user other than the author.
+    """
+    Profile.objects.filter(user_id=post.author_id).update(score=F('score') + change)
+    ScoreChange.objects.create(user_id=post.author_id, post=post, vote_type=vote_type, change=change)
+
+    counts = dict(vote_count=F('vote_count') + change)
+    if vote_type == Vote.BOOKMARK:
+        counts.update(book_count=F('book_count') + change)
+    if vote_type == Vote.ACCEPT:
+        counts.update(accept_count=F('accept_count') + change)
+    Post.objects.filter(pk=post.pk).update(**counts)
+
+    # The thread counts cover all votes in the thread.
+    counts = dict(thread_votecount=F('thread_votecount') + change)
+    if vote_type == Vote.ACCEPT and post.root_id != post.pk:
+        counts.update(accept_count=F('accept_count') + change)
+    Post.objects.filter(pk=post.root_id).update(**counts)
+
+
+def counted_votes():
+    # Votes on their own posts do not count.
+    return Vote.objects.exclude(author=F("post__author"))
+
+
+def score_drift():
+    """
+    Returns the profiles whose score differs from the votes, annotated with the expected score.
+    """
+    expected = counters.grouped(counted_votes(), "post__author", outer="user_id")
+    return Profile.objects.annotate(expected=expected).exclude(score=F("expected"))
+
+
+def count_drift():
+    """
+    Returns the posts whose vote counts differ from the votes. Only roots keep the thread vote count.
+    """
+    votes = counted_votes()
+    posts = Post.objects.annotate(expected_votes=counters.grouped(votes, "post"),
+                                  expected_books=counters.grouped(votes.filter(type=Vote.BOOKMARK), "post"),
+                                  expected_thread=counters.grouped(votes, "post__root"))
+    wrong = ~Q(vote_count=F("expected_votes")) | ~Q(book_count=F("expected_books"))
+    wrong |= Q(pk=F("root_id")) & ~Q(thread_votecount=F("expected_thread"))
+    return posts.filter(wrong)
+
+
+def reconcile(fix=False):
+    """
+    Compares the scores and post vote counts with the votes. Repairs them when fix is set.
+    Returns the number of profiles and posts that were wrong.
+
+    The accept counts are rebuilt with the reply counts by counters.recount().
+    """
+    scores, counts = score_drift(), count_drift()
+
+    if not fix:
+        return scores.count(), counts.count()
+
+    with transaction.atomic():
+        return repair(scores, counts)
+
+
+def repair(scores, counts):
+    # Each repaired score is recorded in the ledger.
+    corrections = [ScoreChange(user_id=user_id, change=expected - score)
+                   for user_id, score, expected in scores.values_list("user_id", "score", "expected")]
+    ScoreChange.objects.bulk_create(corrections, batch_size=BATCH_SIZE)
+
+    votes = counted_votes()
+    profiles = Profile.objects.filter(user_id__in=[change.user_id for change in corrections])
+    profiles.update(score=counters.grouped(votes, "post__author", outer="user_id"))
+
+    # The drifted posts are updated with the same aggregates.
+    posts = Post.objects.filter(pk__in=list(counts.values_list("pk", flat=True)))
+    nposts = posts.update(vote_count=counters.grouped(votes, "post"),
+                          book_count=counters.grouped(votes.filter(type=Vote.BOOKMARK), "post"))
+    posts.filter(pk=F("root_id")).update(thread_votecount=counters.grouped(votes, "post__root"))
+
+    return len(corrections), nposts
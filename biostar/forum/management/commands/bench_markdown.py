@@ -0,0 +1,53 @@
+import logging
+import time
+
+import bleach
+
+from django.core.management.base import BaseCommand
+
+from biostar.forum.models import Post
+
+logger = logging.getLogger('engine')
+
+
+def timed(func, texts, rounds):
+    """
+    Returns the best renders per second of a function over the texts, and the html of the last round.
+    """
+    best, html = 0, []
+    for step in range(rounds):
+        start = time.perf_counter()
+        html = [func(text) for text in texts]
+        best = max(best, len(texts) / max(time.perf_counter() - start, 1e-9))
+    return best, html
+
+
+class Command(BaseCommand):
+    help = 'Measure markdown renders per second over the most recent posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help="Number of posts to render.")
+        parser.add_argument('--rounds', type=int, default=3, help="Times each post is rendered.")
+
+    def handle(self, *args, **options):
+        # Needs to be imported here to avoid circular imports.
+        from biostar.utils import markdown
+
+        texts = list(Post.objects.order_by("-id").values_list("content", flat=True)[:options['count']])
+        fresh, reused = markdown.benchmark(texts, rounds=options['rounds'])
+
+        logger.info(f"Rendered {len(texts)} posts: {fresh:.0f} per second with a new parser for each post, "
+                    f"{reused:.0f} per second with the reused parser")
+
+        def two_pass(text):
+            # Bodies used to be cleaned on save and again in the parser.
+            return markdown.parse(bleach.clean(text, attributes={'a': ['href', 'title', 'name']}), sanatize=True)
+
+        def one_pass(text):
+            return markdown.parse(markdown.sanitize(text), sanatize=False)
+
+        before, _ = timed(two_pass, texts, rounds=options['rounds'])
+        after, _ = timed(one_pass, texts, rounds=options['rounds'])
+
+        logger.info(f"Sanitized and rendered {len(texts)} posts: {before:.0f} per second in two passes, "
+                    f"{after:.0f} per second in one pass")
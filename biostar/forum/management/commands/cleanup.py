@@ -1,11 +1,13 @@
 
 import logging
 from datetime import datetime, timedelta
+from django.conf import settings
 from django.db.models import Count
 from django.core.management.base import BaseCommand
 from biostar.accounts.models import Message, User
+from biostar.forum import auth, embeds
 from biostar.forum.util import now
-from biostar.forum.models import PostView, Post
+from biostar.forum.models import ViewSketch, Post, Embed
 
 logger = logging.getLogger('engine')
 
@@ -13,17 +15,27 @@ logger = logging.getLogger('engine')
 MAX_MSG = 100
 
 
-def prune_data(weeks=10, days=1):
+def prune_data(weeks=10):
 
     # Delete spam
     spam_posts = Post.objects.filter(spam=Post.SPAM)
     logger.info(f"Deleting {spam_posts.count()} spam posts")
-    spam_posts.delete()
+    auth.delete_posts(spam_posts)
 
-    past_days = now() - timedelta(days=days)
-    post_views = PostView.objects.filter(date__lt=past_days)
-    logger.info(f"Deleting {post_views.count()} post views")
-    post_views.delete()
+    # The all time sketches have no day and are kept.
+    past_days = now().date() - timedelta(days=settings.VIEW_SKETCH_DAYS)
+    sketches = ViewSketch.objects.filter(day__lt=past_days)
+    logger.info(f"Deleting {sketches.count()} daily view sketches")
+    sketches.delete()
+
+    # Retry failed embeds and refresh the expired ones still shown in posts.
+    updated = embeds.refresh_posts()
+    logger.info(f"Updated the embeds of {updated} posts")
+
+    # Expired embeds no post shows any more.
+    expired = Embed.objects.filter(expires__lt=now())
+    logger.info(f"Deleting {expired.count()} expired embeds")
+    expired.delete()
 
     # Reduce overall messages.
     weeks_since = now() - timedelta(weeks=weeks)
@@ -44,7 +56,8 @@ class Command(BaseCommand):
     help = """Delete the following: 
               - posts marked as spam
               - messages older then 10 weeks
-              - PostView objects within the last day 
+              - daily view sketches older than VIEW_SKETCH_DAYS
+              - expired embeds, after retrying and refreshing those shown in posts
               - too many messages in a users inbox
            """
 
@@ -1,15 +1,49 @@
 
 import logging
+import os
+import time
 from typing import Any
 
 from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from biostar.forum.models import Post
 from django.conf import settings
-from biostar.forum import search
+from biostar.forum import search, backends
 
 logger = logging.getLogger('engine')
 
 
+def benchmark_documents(limit=10000):
+    """
+    Compares the queries and time needed to build documents one post at a time
+    with building them in chunks. Returns a dictionary of measurements.
+    """
+    posts = Post.objects.exclude(root=None).order_by("id")[:limit]
+
+    # The original path: several queries for every post.
+    collector = search.DocumentCollector()
+    start = time.time()
+    with CaptureQueriesContext(connection) as single:
+        for post in posts:
+            search.add_index(post=post, writer=collector)
+    single_secs = time.time() - start
+
+    # The chunked path.
+    start = time.time()
+    with CaptureQueriesContext(connection) as chunked:
+        docs = list(search.stream_documents(posts))
+    chunked_secs = time.time() - start
+
+    total = len(docs)
+    scale = 10000 / total if total else 0
+    same = sum(1 for old, new in zip(collector.docs, docs) if old == new)
+
+    return dict(total=total, identical=same,
+                single_queries=len(single) * scale, single_secs=single_secs * scale,
+                chunked_queries=len(chunked) * scale, chunked_secs=chunked_secs * scale)
+
+
 class Command(BaseCommand):
     help = 'Create search index for the forum app.'
 
@@ -19,6 +53,25 @@ class Command(BaseCommand):
         parser.add_argument('--remove', action='store_true', default=False, help="Removes the existing index.")
         parser.add_argument('--report', action='store_true', default=False, help="Reports on the content of the index.")
         parser.add_argument('--index', type=int, default=0, help="How many posts to index")
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                            help="Rebuilds the entire index from the database.")
+        parser.add_argument('--procs', type=int, default=os.cpu_count() or 1,
+                            help="Number of processes used to rebuild the index.")
+        parser.add_argument('--schema', choices=['full', 'slim'], default=None,
+                            help="Schema used when rebuilding, migrates the index when it changes.")
+        parser.add_argument('--compare', action='store_true', default=False,
+                            help="Compares the size and search latency of the full and slim schemas.")
+        parser.add_argument('--backend', choices=list(backends.BACKENDS), default=None,
+                            help="Search backend to update, the SEARCH_BACKEND setting by default.")
+        parser.add_argument('--drain', action='store_true', default=False,
+                            help="Removes deleted posts from the index and optimizes it.")
+        parser.add_argument('--benchmark', type=int, default=0,
+                            help="Compares building documents one by one and in chunks for this many posts.")
+        parser.add_argument('--follow', action='store_true', default=False,
+                            help="Keeps indexing new and edited posts as they appear.")
+        parser.add_argument('--batch', type=int, default=settings.BATCH_INDEXING_SIZE,
+                            help="How many posts to read at a time when following.")
+        parser.add_argument('--sleep', type=float, default=1, help="Seconds to wait between polls when following.")
 
     def handle(self, *args, **options):
 
@@ -28,12 +81,21 @@ class Command(BaseCommand):
         remove = options['remove']
         report = options['report']
         index = options['index']
+        follow = options['follow']
+        rebuild = options['rebuild']
+        backend = backends.get_backend(options['backend'])
 
         # Sets the un-indexed flags to false on all posts.
         if reset:
             logger.info(f"Setting indexed field to false on all post.")
             Post.objects.filter(indexed=True).exclude(root=None).update(indexed=False)
 
+        # Replace the index with one built from all posts.
+        if rebuild:
+            slim = options['schema'] == 'slim' if options['schema'] else None
+            total, rate = backend.rebuild(procs=options['procs'], slim=slim)
+            logger.info(f"Indexed {total} posts at {rate:.0f} posts per second")
+
         # Index a limited number yet unindexed posts
         if index:
 
@@ -41,7 +103,7 @@ class Command(BaseCommand):
             start_count = Post.objects.filter(indexed=False).exclude(root=None).count()
             logger.info(f"Starting with {start_count} unindexed posts")
 
-            posts = Post.objects.filter(indexed=False).exclude(root=None)[:index]
+            posts = search.indexable(Post.objects.filter(indexed=False))[:index]
             target_count = len(posts)
 
             logger.info(f"Indexing {target_count} posts")
@@ -62,3 +124,32 @@ class Command(BaseCommand):
         if report:
             search.print_info()
 
+        # Remove posts queued for deletion.
+        if options['drain']:
+            removed = search.drain_tombstones(optimize=True, backend=backend)
+            logger.info(f"Removed {removed} posts from the index")
+
+        # Measure the cost of building search documents.
+        if options['benchmark']:
+            stats = benchmark_documents(limit=options['benchmark'])
+            logger.info('-' * 20)
+            logger.info(f"{stats['total']} posts, {stats['identical']} identical documents")
+            logger.info("Per 10k posts\tqueries\tseconds")
+            logger.info(f"One by one\t{stats['single_queries']:.0f}\t{stats['single_secs']:.2f}")
+            logger.info(f"Chunked\t{stats['chunked_queries']:.0f}\t{stats['chunked_secs']:.2f}")
+            logger.info('-' * 20)
+
+        # Measure the full and slim schemas.
+        if options['compare']:
+            stats = search.compare_schemas()
+            logger.info('-' * 20)
+            logger.info("Schema\tposts\tkbytes\tmsecs per page")
+            for name, value in stats.items():
+                logger.info(f"{name}\t{value['total']}\t{value['size'] / 1024:.0f}\t{value['msecs']:.2f}")
+            logger.info('-' * 20)
+
+        # Continuously index posts flagged as unindexed.
+        if follow:
+            indexer = search.IncrementalIndexer(batch_size=options['batch'], backend=backend)
+            indexer.follow(sleep=options['sleep'])
+
@@ -0,0 +1,22 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from biostar.forum import ledger
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Check the user scores and the post vote counts against the votes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', default=False,
+                            help="Repair the scores and counts that are wrong.")
+
+    def handle(self, *args, **options):
+        fix = options['fix']
+        scores, counts = ledger.reconcile(fix=fix)
+
+        action = "Repaired" if fix else "Found"
+        logger.info(f"{action} wrong scores for {scores} users and wrong vote counts for {counts} posts")
@@ -0,0 +1,15 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from biostar.forum import counters
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the reply, answer, comment, subscription and accept counts of every thread.'
+
+    def handle(self, *args, **options):
+        nposts = counters.recount()
+        logger.info(f"Recounted {nposts} posts")
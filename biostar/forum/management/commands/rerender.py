@@ -0,0 +1,22 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Render the html of every post again, after the markdown rules change.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of rendering processes, one per CPU by default.")
+        parser.add_argument('--batch', type=int, default=500,
+                            help="Posts read and written at a time.")
+
+    def handle(self, *args, **options):
+        # Needs to be imported here to avoid circular imports.
+        from biostar.utils import markdown
+
+        changed = markdown.rerender(workers=options['workers'], batch_size=options['batch'])
+        logger.info(f"Rendered all posts, {changed} changed")
@@ -7,7 +7,8 @@ from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from biostar.forum.models import Post
-from biostar.forum.search import preform_search, whoosh_more_like_this
+from biostar.forum.search import preform_search, whoosh_more_like_this, cache_stats
+from biostar.forum import backends
 
 logger = logging.getLogger('engine')
 
@@ -71,6 +72,8 @@ class Command(BaseCommand):
         parser.add_argument('-l', '--limit', type=int, default=10,
                             help="Print limited amount of results.")
         parser.add_argument('-vr', '--verbose', type=int, default=1, help="Verbosity level of the report.")
+        parser.add_argument('--benchmark', action='store_true', default=False,
+                            help="Rebuilds every search backend and times the same queries against each.")
 
     def handle(self, *args, **options):
         logger.info(f"Database: {settings.DATABASE_NAME}. Index : {settings.INDEX_DIR}")
@@ -80,6 +83,16 @@ class Command(BaseCommand):
         limit = options['limit']
         verbosity = options['verbose']
 
+        # Compare the search backends on the same queries.
+        if options['benchmark']:
+            stats = backends.benchmark()
+            print('-' * 20)
+            print("Backend\tposts\tposts/sec\tmsecs/query\toverlap")
+            for name, value in stats.items():
+                print(f"{name}\t{value['total']}\t{value['rate']:.0f}\t{value['msecs']:.2f}\t{value['overlap']:.2f}")
+            print('-' * 20)
+            return
+
         # Preform a more like this search for a given uid
         if uid:
             post = Post.objects.filter(uid=uid).first()
@@ -99,4 +112,10 @@ class Command(BaseCommand):
         logger.info(f"Query: {query}")
         print_results(results=results, limit=limit, query=query, verbosity=verbosity, finish_time=finish)
 
+        # Hit rate of the search results cache used by the search page.
+        stats = cache_stats()
+        print(f"Cache hits\t{stats['hits']}")
+        print(f"Cache misses\t{stats['misses']}")
+        print(f"Cache hit rate\t{stats['rate']:.2%}")
+
 
@@ -0,0 +1,22 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from biostar.forum import similar
+
+logger = logging.getLogger('engine')
+
+
+class Command(BaseCommand):
+    help = 'Precompute the similar posts shown next to each thread.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=settings.SIMILAR_FEED_COUNT,
+                            help="How many similar posts to store per thread.")
+        parser.add_argument('--incremental', action='store_true', default=False,
+                            help="Only rewrite the threads edited since the last run and their neighbours.")
+
+    def handle(self, *args, **options):
+        total = similar.compute_similar(top=options['top'], incremental=options['incremental'])
+        logger.info(f"Updated similar posts for {total} threads")
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.3 on 2026-10-18 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0007_remove_close'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid', models.CharField(db_index=True, max_length=32)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.3 on 2026-10-18 04:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0008_tombstone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarPost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(default=0)),
+                ('rank', models.IntegerField(default=0)),
+                ('date', models.DateTimeField(auto_now=True, db_index=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar', to='forum.Post')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forum.Post')),
+            ],
+            options={
+                'index_together': {('post', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+import logging
+
+from django.db import migrations, OperationalError
+
+logger = logging.getLogger("engine")
+
+# Full text table used by the database search backend.
+SQLITE_CREATE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS forum_search
+USING fts5(title, tags, author, content, tokenize='porter unicode61')
+"""
+
+POSTGRES_CREATE = [
+    """
+    CREATE TABLE IF NOT EXISTS forum_search (
+        post_id integer PRIMARY KEY REFERENCES forum_post (id) ON DELETE CASCADE,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS forum_search_document ON forum_search USING GIN (document)",
+]
+
+
+def create_table(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            schema_editor.execute(SQLITE_CREATE)
+        except OperationalError as exc:
+            logger.warning(f"SQLite full text search is not available: {exc}")
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_CREATE:
+            schema_editor.execute(sql)
+
+
+def drop_table(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute("DROP TABLE IF EXISTS forum_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0009_similarpost'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_table, drop_table),
+    ]
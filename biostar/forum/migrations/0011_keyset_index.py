@@ -0,0 +1,17 @@
+# Generated by Django 3.0.3 on 2026-10-18 04:24
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0010_search_table'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='post',
+            index_together={('is_toplevel', 'rank', 'id')},
+        ),
+    ]
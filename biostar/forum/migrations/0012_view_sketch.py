@@ -0,0 +1,60 @@
+# Generated by Django 3.0.3 on 2026-10-18 04:32
+
+from itertools import groupby
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from biostar.forum import sketch
+
+# Sketches inserted by each statement.
+BATCH_SIZE = 500
+
+
+def build_sketches(apps, schema_editor):
+    """
+    Builds the all time sketch of each post from the addresses that viewed it.
+    """
+    PostView = apps.get_model('forum', 'PostView')
+    ViewSketch = apps.get_model('forum', 'ViewSketch')
+
+    rows = PostView.objects.order_by('post_id').values_list('post_id', 'ip').iterator()
+    batch = []
+    for post_id, views in groupby(rows, key=lambda row: row[0]):
+        registers = sketch.empty()
+        for _, ip in views:
+            sketch.add(registers, ip or '')
+        batch.append(ViewSketch(post_id=post_id, day=None, data=bytes(registers),
+                                viewers=sketch.estimate(registers)))
+        if len(batch) >= BATCH_SIZE:
+            ViewSketch.objects.bulk_create(batch)
+            batch = []
+
+    ViewSketch.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0011_keyset_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True, null=True)),
+                ('data', models.BinaryField()),
+                ('viewers', models.IntegerField(db_index=True, default=0)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sketches', to='forum.Post')),
+            ],
+            options={
+                'unique_together': {('post', 'day')},
+            },
+        ),
+        migrations.RunPython(build_sketches, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='PostView',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.3 on 2026-10-18 04:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forum', '0012_view_sketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoreChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vote_type', models.IntegerField(choices=[(0, 'Upvote'), (4, 'Empty'), (1, 'DownVote'), (2, 'Bookmark'), (3, 'Accept')], null=True)),
+                ('change', models.IntegerField(default=0)),
+                ('date', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('post', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='forum.Post')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='score_changes', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
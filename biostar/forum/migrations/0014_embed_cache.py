@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2026-10-18 04:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0013_score_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Embed',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=500, unique=True)),
+                ('html', models.TextField(blank=True, default='')),
+                ('date', models.DateTimeField()),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
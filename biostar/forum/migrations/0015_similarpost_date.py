@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0014_embed_cache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='similarpost',
+            name='date',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
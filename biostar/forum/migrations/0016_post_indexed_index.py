@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2026-10-18 06:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0015_similarpost_date'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='indexed',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
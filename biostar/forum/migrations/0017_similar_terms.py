@@ -0,0 +1,38 @@
+# Generated by Django 3.0.3 on 2026-10-18 05:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum', '0016_post_indexed_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermCounts',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='forum.Post')),
+                ('data', models.TextField(default='{}')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TermFrequency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100, unique=True)),
+                ('threads', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TermWeight',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=100)),
+                ('weight', models.FloatField(default=0)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forum.Post')),
+            ],
+        ),
+    ]
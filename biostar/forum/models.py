@@ -1,11 +1,9 @@
 import logging
 
-import bleach
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
 from django.db import models
-from django.db.models import Q
 from django.shortcuts import reverse
 from taggit.managers import TaggableManager
 
@@ -75,7 +73,7 @@ class Post(models.Model):
     rank = models.FloatField(default=0, blank=True, db_index=True)
 
     # This post has been indexed by the search engine.
-    indexed = models.BooleanField(default=False)
+    indexed = models.BooleanField(default=False, db_index=True)
 
     # Used for efficiency
     #is_public_toplevel = models.BooleanField(default=False)
@@ -143,6 +141,18 @@ class Post(models.Model):
     # Unique id for the post.
     uid = models.CharField(max_length=32, unique=True, db_index=True)
 
+    class Meta:
+        # Cursor pages of the post listing seek along this index.
+        index_together = [("is_toplevel", "rank", "id")]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        post = super(Post, cls).from_db(db, field_names, values)
+        # Tags are synced and the body rendered only when they change.
+        loaded = dict(zip(field_names, values))
+        post.loaded_tag_val, post.loaded_content = loaded.get("tag_val"), loaded.get("content")
+        return post
+
     def parse_tags(self):
         return [tag.lower() for tag in self.tag_val.split(",") if tag]
 
@@ -196,9 +206,13 @@ class Post(models.Model):
         self.lastedit_date = util.now()
         self.last_contributor = self.lastedit_user
 
-        # Sanitize the post body.
-        self.content = bleach.clean(self.content, attributes=markdown.ALLOWED_ATTRIBUTES)
-        self.html = markdown.parse(self.content, post=self)
+        # Sanitize the post body once, the renderer keeps the sanitized html as it is.
+        self.content = markdown.sanitize(self.content)
+
+        # Render the body only when it changed.
+        if not self.html or self.content != getattr(self, "loaded_content", None):
+            self.html = markdown.parse(self.content, post=self, sanatize=False)
+            self.loaded_content = self.content
         self.tag_val = self.tag_val.replace(' ', '')
         # Default tags
         self.tag_val = self.tag_val or "tag1,tag2"
@@ -215,27 +229,6 @@ class Post(models.Model):
     def __str__(self):
         return "%s: %s (pk=%s)" % (self.get_type_display(), self.title, self.pk)
 
-    def update_parent_counts(self):
-        """
-        Update the counts for the parent and root
-        """
-
-        descendants = Post.objects.filter(root=self.root).exclude(Q(pk=self.root.pk) | Q(status=Post.DELETED)
-                                                                  | Q(spam=Post.SPAM))
-        answer_count = descendants.filter(type=Post.ANSWER).count()
-        comment_count = descendants.filter(type=Post.COMMENT).count()
-        reply_count = descendants.count()
-        # Update the root reply, answer, and comment counts.
-        Post.objects.filter(pk=self.root.pk).update(reply_count=reply_count, answer_count=answer_count,
-                                                    comment_count=comment_count)
-
-        children = Post.objects.filter(parent=self.parent).exclude(pk=self.parent.pk)
-        com_count = children.filter(type=Post.COMMENT).count()
-
-        # Update parent reply, answer, and comment counts.
-        Post.objects.filter(pk=self.parent.pk, is_toplevel=False).update(comment_count=com_count, answer_count=0,
-                                                                         reply_count=children.count())
-
     @property
     def css(self):
         # Used to simplify CSS rendering.
@@ -280,14 +273,109 @@ class Vote(models.Model):
         super(Vote, self).save(*args, **kwargs)
 
 
-class PostView(models.Model):
+class ScoreChange(models.Model):
+    """
+    Append only record of the changes to the score of a user.
+    Corrections made when reconciling the scores have no post or vote type.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="score_changes", on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, null=True, on_delete=models.SET_NULL)
+    vote_type = models.IntegerField(choices=Vote.TYPE_CHOICES, null=True)
+    change = models.IntegerField(default=0)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Score change: {self.user_id}, {self.change:+d}"
+
+
+class ViewSketch(models.Model):
+    """
+    Approximate set of the addresses that viewed a post on a day, or ever when the day is not set.
+    """
+    post = models.ForeignKey(Post, related_name="sketches", on_delete=models.CASCADE)
+    day = models.DateField(null=True, db_index=True)
+
+    # The registers of a HyperLogLog sketch.
+    data = models.BinaryField()
+
+    # The estimated number of unique viewers.
+    viewers = models.IntegerField(default=0, db_index=True)
+
+    class Meta:
+        unique_together = [("post", "day")]
+
+
+class Embed(models.Model):
     """
-    Keeps track of post views based on IP address.
+    The html of an embedded link. Links that could not be fetched have no html.
     """
-    ip = models.GenericIPAddressField(default='', null=True, blank=True)
-    post = models.ForeignKey(Post, related_name="post_views", on_delete=models.CASCADE)
+    url = models.CharField(max_length=500, unique=True)
+    html = models.TextField(default='', blank=True)
+    date = models.DateTimeField()
+
+    # Fetched again after this date.
+    expires = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Embed: {self.url}"
+
+
+class Tombstone(models.Model):
+    """
+    Queues a post to be removed from the search index.
+    """
+    uid = models.CharField(max_length=32, db_index=True)
     date = models.DateTimeField(auto_now_add=True)
 
+    def __str__(self):
+        return f"Tombstone: {self.uid}"
+
+
+class SimilarPost(models.Model):
+    """
+    A precomputed similar thread, ranked by score.
+    """
+    post = models.ForeignKey(Post, related_name="similar", on_delete=models.CASCADE)
+    target = models.ForeignKey(Post, related_name="+", on_delete=models.CASCADE)
+    score = models.FloatField(default=0)
+    rank = models.IntegerField(default=0)
+
+    # When the computation started, set by compute_similar.
+    date = models.DateTimeField(db_index=True)
+
+    class Meta:
+        index_together = [("post", "rank")]
+
+    def __str__(self):
+        return f"{self.post_id} similar to {self.target_id}: {self.score:.3f}"
+
+
+class TermCounts(models.Model):
+    """
+    The weighted term counts of a thread when its similar posts were last computed.
+    """
+    post = models.OneToOneField(Post, primary_key=True, related_name="+", on_delete=models.CASCADE)
+
+    # The counts as a json object keyed by term.
+    data = models.TextField(default='{}')
+
+
+class TermWeight(models.Model):
+    """
+    A term of the TF-IDF vector of a thread, read back to find the threads sharing a term.
+    """
+    post = models.ForeignKey(Post, related_name="+", on_delete=models.CASCADE)
+    term = models.CharField(max_length=100, db_index=True)
+    weight = models.FloatField(default=0)
+
+
+class TermFrequency(models.Model):
+    """
+    The number of threads a term is found in.
+    """
+    term = models.CharField(max_length=100, unique=True)
+    threads = models.IntegerField(default=0)
+
 
 class Subscription(models.Model):
     "Connects a post to a user"
@@ -310,16 +398,24 @@ class Subscription(models.Model):
         # Set the date to current time if missing.
         self.date = self.date or util.now()
         self.uid = self.uid or util.get_uuid(limit=16)
-        type_map = {Profile.NO_MESSAGES: self.NO_MESSAGES,
-                    Profile.EMAIL_MESSAGE: self.EMAIL_MESSAGE,
-                    Profile.LOCAL_MESSAGE: self.LOCAL_MESSAGE,
-                    Profile.DEFAULT_MESSAGES: self.LOCAL_MESSAGE}
 
         if self.type is None:
-            self.type = type_map.get(self.user.profile.message_prefs, self.NO_MESSAGES)
+            self.type = self.default_type(self.user)
 
         super(Subscription, self).save(*args, **kwargs)
 
+    @staticmethod
+    def default_type(user):
+        """
+        The subscription type that follows the message preferences of the user.
+        """
+        type_map = {Profile.NO_MESSAGES: Subscription.NO_MESSAGES,
+                    Profile.EMAIL_MESSAGE: Subscription.EMAIL_MESSAGE,
+                    Profile.LOCAL_MESSAGE: Subscription.LOCAL_MESSAGE,
+                    Profile.DEFAULT_MESSAGES: Subscription.LOCAL_MESSAGE}
+
+        return type_map.get(user.profile.message_prefs, Subscription.NO_MESSAGES)
+
     @staticmethod
     def get_sub(post, user):
         sub = Subscription.objects.filter(post=post, user=user).first()
@@ -0,0 +1,276 @@
+"""
+Counts post views in memory and writes the summed counts to the database every few seconds.
+
+Repeated views of a post from an IP address are dropped by the buffer of each worker,
+counting a view costs no query and no cache round trip. A visitor whose requests reach
+several workers may be counted once by each of them.
+
+The wsgi workers also flush their buffer from a thread, so an idle worker does not hold
+on to its views, and once more when they exit.
+
+The addresses that viewed a post are also added to daily and all time sketches
+that estimate the number of unique viewers.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, When, F, Q, Sum, Value, IntegerField
+
+from biostar.forum import sketch, util
+from biostar.forum.models import Post, ViewSketch
+
+logger = logging.getLogger("engine")
+
+# Posts updated by each statement when flushing the views.
+FLUSH_BATCH = 250
+
+# How long the most viewed posts are cached.
+TOP_VIEWED_SECS = 60 * 5
+
+# Posts whose sketches are merged for each of the most viewed posts.
+TOP_VIEWED_CANDIDATES = 3
+
+
+class ViewBuffer(object):
+    """
+    Views added since the last flush keyed by post id, and the sketches keyed by post id and day.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.sketches = {}
+        self.seen = {}
+        self.flushed = time.time()
+
+    def is_new(self, post_id, viewer, secs):
+        """
+        Returns True unless the viewer was seen on the post in the last secs, then marks it as seen.
+        """
+        key, now = (post_id, viewer), time.time()
+        with self.lock:
+            if self.seen.get(key, 0) > now:
+                return False
+            self.seen[key] = now + secs
+        return True
+
+    def add(self, post_id, viewer, day, count=1):
+        with self.lock:
+            self.counts[post_id] += count
+            sketch.add(self.sketches.setdefault((post_id, day), sketch.empty()), viewer)
+
+    def take(self):
+        """
+        Returns the views and the sketches and starts again from empty.
+        """
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+            sketches, self.sketches = self.sketches, {}
+            self.flushed = now = time.time()
+
+            # Forget the viewers whose repeats are counted again.
+            self.seen = {key: expires for key, expires in self.seen.items() if expires > now}
+
+        return counts, sketches
+
+    def restore(self, counts=None, sketches=None):
+        with self.lock:
+            self.counts.update(counts or {})
+            for key, registers in (sketches or {}).items():
+                self.sketches[key] = sketch.merge(self.sketches.get(key), registers)
+
+    def is_due(self, secs):
+        return bool(self.counts) and time.time() - self.flushed >= secs
+
+
+# The views counted by this process.
+BUFFER = ViewBuffer()
+
+# Set by the wsgi workers, each worker then also flushes its views from a thread.
+FLUSH_THREAD = False
+
+# The id of the process that started the flusher thread.
+FLUSHER_PID = None
+
+
+def record_view(post_id, ip, minutes=settings.POST_VIEW_MINUTES):
+    """
+    Counts a view unless the IP address viewed the post in the last minutes.
+    Returns True when the view was counted.
+    """
+    if not BUFFER.is_new(post_id, viewer=ip, secs=minutes * 60):
+        return False
+
+    BUFFER.add(post_id, viewer=ip, day=util.now().date())
+    start_flusher()
+
+    if BUFFER.is_due(settings.VIEW_FLUSH_SECS):
+        flush()
+
+    return True
+
+
+def run_flusher():
+    while True:
+        time.sleep(settings.VIEW_FLUSH_SECS)
+        if not BUFFER.is_due(settings.VIEW_FLUSH_SECS):
+            continue
+        try:
+            flush()
+        except Exception as exc:
+            logger.error(f"Error flushing post views: {exc}")
+        finally:
+            # The connection of this thread is not closed at the end of a request.
+            connection.close()
+
+
+def start_flusher():
+    """
+    Starts the thread that flushes the views of an idle worker, once in each process.
+    Threads do not survive the fork of the workers, the thread is started by the first view.
+    """
+    global FLUSHER_PID
+
+    pid = os.getpid()
+    if not FLUSH_THREAD or FLUSHER_PID == pid:
+        return
+
+    with BUFFER.lock:
+        if FLUSHER_PID == pid:
+            return
+        FLUSHER_PID = pid
+
+    threading.Thread(target=run_flusher, name="view-flusher", daemon=True).start()
+
+
+def write_counts(items):
+    """
+    Adds (post id, views) pairs to the view counts. Returns the number written.
+    """
+    done = 0
+    try:
+        for start in range(0, len(items), FLUSH_BATCH):
+            batch = items[start:start + FLUSH_BATCH]
+            delta = Case(*[When(id=post_id, then=Value(count)) for post_id, count in batch],
+                         default=Value(0), output_field=IntegerField())
+            Post.objects.filter(id__in=[post_id for post_id, _ in batch]).update(view_count=F('view_count') + delta)
+            done += len(batch)
+    except Exception as exc:
+        logger.error(f"Error writing post views: {exc}")
+
+    return done
+
+
+@transaction.atomic
+def write_sketches(sketches):
+    """
+    Merges sketches keyed by (post id, day) into the stored daily and all time sketches.
+    """
+    # Each day also goes into the all time sketch of the post.
+    merged = {}
+    for (post_id, day), registers in sketches.items():
+        for key in ((post_id, day), (post_id, None)):
+            merged[key] = sketch.merge(merged.get(key), registers)
+
+    post_ids = {post_id for post_id, day in merged}
+    days = {day for post_id, day in merged if day}
+
+    stored = ViewSketch.objects.select_for_update().filter(post_id__in=post_ids)
+    stored = stored.filter(Q(day__in=days) | Q(day=None))
+    stored = {(row.post_id, row.day): row for row in stored}
+
+    updated, created = [], []
+    for (post_id, day), registers in merged.items():
+        row = stored.get((post_id, day))
+        if row:
+            registers = sketch.merge(row.data, registers)
+            row.data, row.viewers = bytes(registers), sketch.estimate(registers)
+            updated.append(row)
+        else:
+            created.append(ViewSketch(post_id=post_id, day=day, data=bytes(registers),
+                                      viewers=sketch.estimate(registers)))
+
+    ViewSketch.objects.bulk_update(updated, ["data", "viewers"], batch_size=FLUSH_BATCH)
+    ViewSketch.objects.bulk_create(created, batch_size=FLUSH_BATCH)
+
+
+def flush():
+    """
+    Adds the buffered views to the post view counts and sketches. Returns the number of posts updated.
+    """
+    counts, sketches = BUFFER.take()
+    if not counts and not sketches:
+        return 0
+
+    items = list(counts.items())
+    done = write_counts(items)
+
+    # Keep what was not written for the next flush.
+    if done < len(items):
+        BUFFER.restore(counts=dict(items[done:]))
+
+    try:
+        write_sketches(sketches)
+    except Exception as exc:
+        # Another worker may have created the same sketch, merging is repeated on the next flush.
+        BUFFER.restore(sketches=sketches)
+        logger.error(f"Error writing view sketches: {exc}")
+
+    return done
+
+
+def since(days):
+    return util.now().date() - datetime.timedelta(days=days - 1)
+
+
+def unique_viewers(post_id, days=None):
+    """
+    Returns the approximate number of unique viewers of a post in the last days, or ever.
+    """
+    if days is None:
+        row = ViewSketch.objects.filter(post_id=post_id, day=None).first()
+        return row.viewers if row else 0
+
+    data = ViewSketch.objects.filter(post_id=post_id, day__gte=since(days)).values_list("data", flat=True)
+    return sketch.estimate(sketch.merge(*data))
+
+
+def top_viewed(days=None, limit=100):
+    """
+    Returns the ids of the posts with the most unique viewers in the last days, or ever.
+    Windows longer than the days kept by the daily sketches use the all time sketches.
+    """
+    if days and days > settings.VIEW_SKETCH_DAYS:
+        days = None
+
+    key = f"TOP-VIEWED-{days}-{limit}"
+    found = cache.get(key)
+    if found is not None:
+        return found
+
+    if days is None:
+        rows = ViewSketch.objects.filter(day=None).order_by("-viewers")[:limit]
+        found = list(rows.values_list("post_id", flat=True))
+    else:
+        # The sum of the daily viewers bounds the unique viewers from above,
+        # only the posts with the highest sums have their sketches merged.
+        daily = ViewSketch.objects.filter(day__gte=since(days))
+        candidates = daily.values("post_id").annotate(total=Sum("viewers")).order_by("-total")
+        candidates = candidates.values_list("post_id", flat=True)[:limit * TOP_VIEWED_CANDIDATES]
+
+        merged = {}
+        rows = daily.filter(post_id__in=list(candidates)).values_list("post_id", "data")
+        for post_id, data in rows.iterator():
+            merged[post_id] = sketch.merge(merged.get(post_id), data)
+        ranked = sorted(merged.items(), key=lambda item: sketch.estimate(item[1]), reverse=True)
+        found = [post_id for post_id, registers in ranked[:limit]]
+
+    cache.set(key, found, TOP_VIEWED_SECS)
+    return found
@@ -1,22 +1,38 @@
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import re
+import shutil
+import tempfile
+import threading
 import time
+from datetime import timedelta
 from itertools import count, islice
 from collections import defaultdict
 
 # Postgres specific queries should go into separate module.
 from django.conf import settings
-from whoosh import writing
+from django.core.cache import cache
+from django.db import connections
+from django.shortcuts import reverse
+from whoosh import sorting, writing
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.writing import AsyncWriter
-from whoosh.searching import Results
+from whoosh.searching import Results, ResultsPage
 
 from whoosh.qparser import MultifieldParser, OrGroup
 from whoosh.analysis import STOP_WORDS
-from whoosh.index import create_in, open_dir, exists_in
-from whoosh.fields import ID, TEXT, KEYWORD, Schema, BOOLEAN, NUMERIC, DATETIME
+from whoosh.index import create_in, open_dir, exists_in, LockError
+from whoosh.fields import ID, TEXT, KEYWORD, Schema, BOOLEAN, NUMERIC, DATETIME, STORED
+from whoosh.columns import VarBytesListColumn
+from whoosh.query import And, Term, DateRange
+from whoosh.util.times import datetime_to_long
 
-from biostar.forum.models import Post
+from biostar.accounts.models import Profile
+from biostar.forum.models import Post, Tombstone
+from biostar.forum import util
 
 logger = logging.getLogger('biostar')
 
@@ -24,6 +40,9 @@ logger = logging.getLogger('biostar')
 STOP = ['there', 'where', 'who'] + [w for w in STOP_WORDS]
 STOP = set(STOP)
 
+# Fields searched when none are specified.
+DEFAULT_FIELDS = ['tags', 'title', 'author', 'author_uid', 'author_handle']
+
 
 def timer_func():
     """
@@ -83,9 +102,138 @@ class SearchResult(object):
         return self.total
 
 
+class SearcherPool(object):
+    """
+    Process wide pool that keeps index searchers open between requests.
+
+    A searcher is replaced when the index generation changes after a commit.
+    Searchers are reference counted, a stale searcher gets closed
+    once the last request that acquired it releases it.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+
+        # The current (index, searcher, generation) keyed by index location.
+        self.current = {}
+
+        # Number of requests using a searcher, keyed by the searcher id.
+        self.refs = defaultdict(int)
+
+        # Replaced searchers still in use, keyed by the searcher id.
+        self.stale = {}
+
+    @staticmethod
+    def generation(ix):
+        """
+        Identifies the state of the index on disk.
+        The directory inode changes when the index is removed or swapped.
+        """
+        try:
+            inode = os.stat(settings.INDEX_DIR).st_ino
+            return inode, ix.latest_generation()
+        except Exception as exc:
+            logger.info(f"Index generation not found: {exc}")
+            return None
+
+    def reset(self):
+        # Child processes must not share searchers with the parent.
+        self.current, self.stale = {}, {}
+        self.refs = defaultdict(int)
+        self.pid = os.getpid()
+
+    def retire(self, key):
+        """
+        Removes the current searcher for an index location.
+        """
+        ix, searcher, gen = self.current.pop(key)
+        sid = id(searcher)
+        if self.refs.get(sid):
+            self.stale[sid] = searcher
+        else:
+            searcher.close()
+
+    def acquire(self):
+        """
+        Returns an open searcher for the latest version of the index.
+        Returns None when the index does not exist.
+        """
+        key = (settings.INDEX_DIR, settings.INDEX_NAME)
+
+        with self.lock:
+
+            if self.pid != os.getpid():
+                self.reset()
+
+            entry = self.current.get(key)
+            if entry:
+                ix, searcher, gen = entry
+                latest = self.generation(ix)
+
+                # Index has not changed since the searcher was opened.
+                if latest and latest == gen:
+                    self.refs[id(searcher)] += 1
+                    return searcher
+
+                self.retire(key)
+
+            if not index_exists():
+                return None
+
+            ix = open_dir(dirname=settings.INDEX_DIR, indexname=settings.INDEX_NAME)
+            gen = self.generation(ix)
+            searcher = ix.searcher()
+
+            self.current[key] = (ix, searcher, gen)
+            self.refs[id(searcher)] += 1
+            logger.info(f"Opened searcher for index generation={gen}")
+
+            return searcher
+
+    def generation_of(self, searcher):
+        """
+        Returns the index generation a searcher was opened for.
+        """
+        with self.lock:
+            for ix, current, gen in self.current.values():
+                if current is searcher:
+                    return gen
+        return None
+
+    def release(self, searcher):
+        """
+        Returns a searcher to the pool, closes it if stale and unused.
+        """
+        with self.lock:
+            sid = id(searcher)
+            self.refs[sid] -= 1
+            if self.refs[sid] > 0:
+                return
+            self.refs.pop(sid, None)
+            if sid in self.stale:
+                self.stale.pop(sid).close()
+
+    def close_all(self):
+        """
+        Closes every searcher held by the pool.
+        """
+        with self.lock:
+            for key in list(self.current):
+                self.retire(key)
+            for searcher in self.stale.values():
+                searcher.close()
+            self.reset()
+
+
+# Searchers shared by all requests handled in this process.
+POOL = SearcherPool()
+
+
 def close(r):
-    # Ensure the searcher object gets closed.
-    r.searcher.close() if isinstance(r, Results) else None
+    # Release the searcher back into the pool.
+    r = r.results if isinstance(r, ResultsPage) else r
+    POOL.release(r.searcher) if isinstance(r, Results) else None
     return
 
 
@@ -143,7 +291,190 @@ def add_index(post, writer):
                            lastedit_user_is_moderator=post.lastedit_user.profile.is_moderator)
 
 
-def get_schema():
+# Post fields needed to build a search document.
+DOCUMENT_FIELDS = ["id", "uid", "title", "type", "content", "creation_date", "lastedit_date", "tag_val",
+                   "is_toplevel", "rank", "vote_count", "reply_count", "view_count", "thread_votecount",
+                   "author_id", "lastedit_user_id", "root_id"]
+
+# Profile fields needed to build a search document.
+PROFILE_FIELDS = ["user_id", "uid", "name", "score", "role", "state", "user__username", "user__email",
+                  "user__is_staff", "user__is_superuser"]
+
+
+def url_maker(name):
+    """
+    Returns a function that fills in the uid of a view url. Calls reverse() only once.
+    """
+    marker = "uid-marker"
+    pattern = reverse(name, kwargs=dict(uid=marker))
+    return lambda uid: pattern.replace(marker, uid)
+
+
+def build_documents(rows, slim=False):
+    """
+    Builds the search documents for a chunk of post rows selected with DOCUMENT_FIELDS.
+
+    Authors, editors and roots of the chunk are fetched with one query each.
+    """
+    user_ids = {row['author_id'] for row in rows} | {row['lastedit_user_id'] or row['author_id'] for row in rows}
+    root_ids = {row['root_id'] for row in rows}
+
+    profiles = Profile.objects.filter(user_id__in=user_ids).values(*PROFILE_FIELDS)
+    profiles = {profile['user_id']: profile for profile in profiles}
+
+    roots = Post.objects.filter(id__in=root_ids).values("id", "uid", "answer_count", "accept_count")
+    roots = {root['id']: root for root in roots}
+
+    post_url, profile_url = url_maker("post_view"), url_maker("user_profile")
+    type_display = dict(Post.TYPE_CHOICES)
+
+    def is_moderator(profile):
+        return (profile['role'] in (Profile.MODERATOR, Profile.MANAGER) or profile['user__is_staff']
+                or profile['user__is_superuser'])
+
+    docs = []
+    for row in rows:
+        author = profiles[row['author_id']]
+        editor = profiles[row['lastedit_user_id'] or row['author_id']]
+        root = roots[row['root_id']]
+
+        url = post_url(root['uid'])
+        url = url if row['is_toplevel'] else f"{url}#{row['uid']}"
+
+        doc = dict(title=row['title'], url=url,
+                   type_display=type_display.get(row['type']),
+                   content_length=len(row['content']),
+                   type=row['type'],
+                   creation_date=row['creation_date'],
+                   lastedit_date=row['lastedit_date'],
+                   lastedit_user=editor['name'],
+                   lastedit_user_email=author['user__email'],
+                   lastedit_user_score=author['score'],
+                   lastedit_user_uid=author['uid'],
+                   lastedit_user_url=profile_url(editor['uid']),
+                   content=row['content'],
+                   tags=row['tag_val'],
+                   is_toplevel=row['is_toplevel'],
+                   rank=row['rank'], uid=row['uid'],
+                   vote_count=row['vote_count'],
+                   reply_count=row['reply_count'],
+                   view_count=row['view_count'],
+                   author_handle=author['user__username'],
+                   author=author['name'],
+                   answer_count=root['answer_count'],
+                   root_has_accepted=bool(root['accept_count']),
+                   author_email=author['user__email'],
+                   author_score=author['score'],
+                   thread_votecount=row['thread_votecount'],
+                   author_uid=author['uid'],
+                   author_url=profile_url(author['uid']),
+                   author_is_moderator=is_moderator(author),
+                   author_is_suspended=author['state'] == Profile.SUSPENDED,
+                   lastedit_user_is_suspended=editor['state'] == Profile.SUSPENDED,
+                   lastedit_user_is_moderator=is_moderator(editor))
+        docs.append(slim_document(doc) if slim else doc)
+
+    return docs
+
+
+def stream_documents(posts, size=None, slim=False):
+    """
+    Generates search documents for a queryset of posts, reading it in fixed size chunks.
+    """
+    size = size or settings.BATCH_INDEXING_SIZE
+    rows = posts.values(*DOCUMENT_FIELDS).iterator(chunk_size=size)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            break
+        yield from build_documents(chunk, slim=slim)
+
+
+class DocumentCollector(object):
+    """
+    Stands in for an index writer, keeps the documents in a list.
+    """
+
+    def __init__(self):
+        self.docs = []
+
+    def update_document(self, **kwargs):
+        self.docs.append(kwargs)
+
+
+class TagsField(KEYWORD):
+    """
+    Comma separated tags. The tags of each document are also kept in a column
+    so that they can be counted while searching.
+    """
+
+    def __init__(self, stored=False):
+        super(TagsField, self).__init__(stored=stored, commas=True)
+        self.column_type = VarBytesListColumn()
+
+    def to_column_value(self, value):
+        tags = [tag.strip() for tag in value.split(",")]
+        return [self.to_bytes(tag) for tag in tags if tag]
+
+
+# Document fields kept in a slim index.
+SLIM_FIELDS = ["uid", "title", "content", "tags", "author", "author_handle", "author_uid", "is_toplevel",
+               "type", "lastedit_date", "creation_date", "rank", "vote_count", "reply_count", "view_count",
+               "thread_votecount"]
+
+
+def slim_document(doc):
+    """
+    Reduces a search document to the fields of the slim schema.
+    """
+    slim = {name: doc[name] for name in SLIM_FIELDS}
+    slim['snippet'] = doc['content'][:settings.SNIPPET_LENGTH]
+    return slim
+
+
+def get_slim_schema():
+    """
+    Schema that stores only the uid, the sort keys and a snippet.
+    Text fields are searchable but the results are read from the database.
+    """
+    analyzer = StemmingAnalyzer(stoplist=STOP)
+    schema = Schema(uid=ID(stored=True, unique=True),
+                    title=TEXT(analyzer=analyzer),
+                    content=TEXT(analyzer=analyzer),
+                    tags=TagsField(),
+                    author=TEXT(),
+                    author_handle=TEXT(),
+                    author_uid=ID(),
+                    snippet=STORED(),
+                    is_toplevel=BOOLEAN(stored=True),
+                    type=NUMERIC(stored=True, sortable=True),
+                    lastedit_date=DATETIME(sortable=True),
+                    creation_date=DATETIME(sortable=True),
+                    rank=NUMERIC(sortable=True),
+                    vote_count=NUMERIC(sortable=True),
+                    reply_count=NUMERIC(sortable=True),
+                    view_count=NUMERIC(sortable=True),
+                    thread_votecount=NUMERIC(sortable=True))
+    return schema
+
+
+def schema_signature(schema):
+    """
+    Field names and types of a schema, used to tell when the index needs a new schema.
+    """
+    return sorted((name, type(field).__name__, type(field.column_type).__name__, field.stored)
+                  for name, field in schema.items())
+
+
+def is_slim(schema):
+    return "snippet" in schema
+
+
+def get_schema(slim=None):
+    slim = settings.SLIM_INDEX if slim is None else slim
+    if slim:
+        return get_slim_schema()
+
     analyzer = StemmingAnalyzer(stoplist=STOP)
     schema = Schema(title=TEXT(stored=True, analyzer=analyzer, sortable=True),
                     url=ID(stored=True),
@@ -151,7 +482,7 @@ def get_schema():
                     thread_votecount=NUMERIC(stored=True, sortable=True),
                     vote_count=NUMERIC(stored=True, sortable=True),
                     content=TEXT(stored=True, analyzer=analyzer, sortable=True),
-                    tags=KEYWORD(stored=True, commas=True),
+                    tags=TagsField(stored=True),
                     is_toplevel=BOOLEAN(stored=True),
                     author_is_moderator=BOOLEAN(stored=True),
                     lastedit_user_is_moderator=BOOLEAN(stored=True),
@@ -175,21 +506,53 @@ def get_schema():
                     reply_count=NUMERIC(stored=True, sortable=True),
                     view_count=NUMERIC(stored=True, sortable=True),
                     answer_count=NUMERIC(stored=True, sortable=True),
-                    uid=ID(stored=True),
+                    uid=ID(stored=True, unique=True),
                     type=NUMERIC(stored=True, sortable=True),
                     type_display=TEXT(stored=True))
     return schema
 
 
-def init_index():
+def new_index_dir():
+    """
+    Creates an empty directory for an index next to the live index location.
+    """
+    parent, name = os.path.split(settings.INDEX_DIR)
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{name}.", dir=parent)
+
+
+def ensure_index_dir():
+    """
+    The live index location is a symbolic link to the directory of the current index.
+    Creates the link and the directory when neither exists.
+    """
+    if os.path.lexists(settings.INDEX_DIR):
+        return
+    os.symlink(new_index_dir(), settings.INDEX_DIR)
+
+
+def remove_index():
+    """
+    Deletes the live index and the directory it points to.
+    """
+    path = settings.INDEX_DIR
+    if os.path.islink(path):
+        target = os.path.realpath(path)
+        os.remove(path)
+        shutil.rmtree(target, ignore_errors=True)
+    elif os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def init_index(slim=None):
     # Initialize a new index or return an already existing one.
 
     if index_exists():
         ix = open_dir(dirname=settings.INDEX_DIR, indexname=settings.INDEX_NAME)
     else:
         # Ensure index directory exists.
-        os.makedirs(settings.INDEX_DIR, exist_ok=True)
-        ix = create_in(dirname=settings.INDEX_DIR, schema=get_schema(), indexname=settings.INDEX_NAME)
+        ensure_index_dir()
+        ix = create_in(dirname=settings.INDEX_DIR, schema=get_schema(slim), indexname=settings.INDEX_NAME)
 
     return ix
 
@@ -201,9 +564,11 @@ def print_info():
     ix = init_index()
 
     counter = defaultdict(int)
-    for index, fields in enumerate(ix.searcher().all_stored_fields()):
-        key = fields['type_display']
-        counter[key] += 1
+    type_display = dict(Post.TYPE_CHOICES)
+    with ix.searcher() as searcher:
+        for index, fields in enumerate(searcher.all_stored_fields()):
+            key = type_display.get(fields['type'])
+            counter[key] += 1
 
     total = 0
     print('-' * 20)
@@ -214,6 +579,13 @@ def print_info():
     print(f"{total} total posts")
 
 
+def indexable(posts):
+    """
+    Deleted and spam posts are kept out of the index.
+    """
+    return posts.exclude(root=None).exclude(status=Post.DELETED).exclude(spam=Post.SPAM)
+
+
 def index_posts(posts, overwrite=False):
     """
     Create or update a search index of posts.
@@ -225,12 +597,12 @@ def index_posts(posts, overwrite=False):
 
     elapsed, progress = timer_func()
     total = posts.count()
-    stream = islice(zip(count(1), posts), None)
+    stream = zip(count(1), stream_documents(posts, slim=is_slim(ix.schema)))
 
     # Loop through posts and add to index
-    for step, post in stream:
+    for step, doc in stream:
         progress(step, total=total, msg="posts indexed")
-        add_index(post=post, writer=writer)
+        writer.update_document(**doc)
 
     # Commit to index
     if overwrite:
@@ -252,7 +624,7 @@ def crawl(reindex=False, overwrite=False, limit=1000):
         Post.objects.filter(indexed=True).exclude(root=None).update(indexed=False)
 
     # Index a limited number of posts at one time.
-    posts = Post.objects.exclude(root=None, indexed=False)[:limit]
+    posts = indexable(Post.objects.exclude(root=None, indexed=False))[:limit]
 
     try:
         # Add post to search index.
@@ -267,19 +639,565 @@ def crawl(reindex=False, overwrite=False, limit=1000):
     return
 
 
-def preform_whoosh_search(query, fields=None, page=None, per_page=20, **kwargs):
+def partition(procs, chunks=4):
+    """
+    Splits the primary keys of indexable posts into contiguous ranges.
+    Makes more ranges than processes so that workers stay busy.
+    """
+    ids = Post.objects.exclude(root=None).order_by("id").values_list("id", flat=True)
+    first, last = ids.first(), ids.last()
+    if first is None:
+        return []
+
+    size = max(1, (last - first + 1) // (procs * chunks) + 1)
+    bounds = [(start, min(start + size - 1, last)) for start in range(first, last + 1, size)]
+    return bounds
+
+
+def rebuild_part(args):
+    """
+    Builds a separate index for posts with primary keys in a range.
+    Runs in a worker process, returns the index directory and the number of posts added.
+    """
+    (start, end), dirname, slim = args
+
+    os.makedirs(dirname, exist_ok=True)
+    ix = create_in(dirname=dirname, schema=get_schema(slim), indexname=settings.INDEX_NAME)
+    writer = ix.writer(limitmb=256)
+
+    posts = indexable(Post.objects.filter(id__gte=start, id__lte=end))
+
+    total = 0
+    for doc in stream_documents(posts, slim=slim):
+        writer.update_document(**doc)
+        total += 1
+
+    writer.commit()
+
+    return dirname, total
+
+
+def swap_index(dirname):
+    """
+    Points the live index location at a new index directory.
+
+    The link is replaced with a rename, which is atomic: searches open either the old
+    or the new index, never a missing one. Searchers notice the change of the directory inode.
+    """
+    path = checkpoint_path()
+    if os.path.exists(path):
+        shutil.copy(path, dirname)
+
+    target = new_index_dir()
+    os.replace(dirname, target)
+
+    live = settings.INDEX_DIR
+    if os.path.islink(live):
+        old = os.path.realpath(live)
+    else:
+        # An index created as a plain directory is moved aside once, before the first link.
+        old = f"{live}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(live):
+            os.rename(live, old)
+
+    link = f"{target}.link"
+    os.symlink(target, link)
+    os.replace(link, live)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def rebuild_index(procs=1, slim=None):
+    """
+    Rebuilds the entire index from the database using multiple processes.
+
+    Posts are split by primary key ranges, each range is indexed into a temporary index.
+    The temporary indexes are merged into a new generation of the live index that replaces
+    the old content in one commit. Searches keep using the old generation until then.
+
+    Changing the schema, or between the full and the slim schema, builds the index
+    in a new directory that is swapped with the live one.
+    """
+    slim = settings.SLIM_INDEX if slim is None else slim
+    started = util.now()
+    start = time.time()
+
+    bounds = partition(procs=procs)
+    ensure_index_dir()
+    tmpdir = tempfile.mkdtemp(prefix=f"{settings.INDEX_NAME}-rebuild-",
+                              dir=os.path.dirname(settings.INDEX_DIR))
+    tasks = [(bound, os.path.join(tmpdir, f"part-{idx}"), slim) for idx, bound in enumerate(bounds)]
+
+    logger.info(f"Rebuilding index with {len(tasks)} ranges in {procs} processes")
+
+    try:
+        if procs > 1:
+            # Each worker opens its own database connection.
+            connections.close_all()
+            with multiprocessing.Pool(procs) as pool:
+                parts = list(pool.imap_unordered(rebuild_part, tasks))
+        else:
+            parts = list(map(rebuild_part, tasks))
+
+        total = sum(count for dirname, count in parts)
+        secs = time.time() - start
+        logger.info(f"Built {total} posts in {secs:.1f} seconds")
+
+        # Merge the parts and replace the content of the live index in a single commit.
+        ix = init_index(slim=slim)
+        migrate = schema_signature(ix.schema) != schema_signature(get_schema(slim))
+        if migrate:
+            logger.info(f"Migrating the index to the current {'slim' if slim else 'full'} schema")
+            newdir = os.path.join(tmpdir, "migrated")
+            os.makedirs(newdir)
+            ix = create_in(dirname=newdir, schema=get_schema(slim), indexname=settings.INDEX_NAME)
+
+        writer = ix.writer(limitmb=256)
+        for dirname, count in parts:
+            with open_dir(dirname=dirname, indexname=settings.INDEX_NAME).reader() as reader:
+                writer.add_reader(reader)
+        writer.commit(mergetype=writing.CLEAR)
+
+        if migrate:
+            swap_index(newdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # Posts edited during the rebuild stay flagged for the incremental indexer.
+    Post.objects.exclude(root=None).filter(lastedit_date__lte=started).update(indexed=True)
+
+    # The new index does not contain posts removed before the rebuild started.
+    Tombstone.objects.filter(date__lte=started).delete()
+
+    secs = time.time() - start
+    rate = total / secs if secs else total
+    logger.info(f"Rebuilt index with {total} posts in {secs:.1f} seconds ({rate:.0f} posts per second)")
+
+    return total, rate
+
+
+def index_size(dirname):
+    return sum(os.path.getsize(os.path.join(dirname, name)) for name in os.listdir(dirname))
+
+
+def sample_queries(limit=20):
+    """
+    Picks the longest word from the titles of the top ranked threads.
+    """
+    titles = Post.objects.filter(is_toplevel=True).exclude(status=Post.DELETED).order_by("-rank")
+    titles = titles.values_list("title", flat=True)[:limit]
+    words = [re.findall(r"\w+", title.lower()) for title in titles]
+    return [max(terms, key=len) for terms in words if terms]
+
+
+def compare_schemas(queries=None, repeat=3, per_page=20):
+    """
+    Builds a full and a slim index from the database, then compares their size on disk
+    and the time needed to produce a page of search results with each one.
+    """
+    queries = queries or sample_queries()
+    bounds = partition(procs=1, chunks=1)
+    if not (bounds and queries):
+        return {}
+
+    tmpdir = tempfile.mkdtemp(prefix=f"{settings.INDEX_NAME}-compare-")
+    stats = {}
+    try:
+        for name, slim in (("full", False), ("slim", True)):
+            dirname, total = rebuild_part((bounds[0], os.path.join(tmpdir, name), slim))
+            ix = open_dir(dirname=dirname, indexname=settings.INDEX_NAME)
+            parser = MultifieldParser(fieldnames=DEFAULT_FIELDS, schema=ix.schema, group=OrGroup)
+
+            start = time.time()
+            with ix.searcher() as searcher:
+                for step in range(repeat):
+                    for query in queries:
+                        results = searcher.search_page(parser.parse(query), pagenum=1, pagelen=per_page,
+                                                       sortedby=["lastedit_date"], reverse=True, terms=True)
+                        page_hits(results)
+            msecs = 1000 * (time.time() - start) / (repeat * len(queries))
+
+            stats[name] = dict(total=total, size=index_size(dirname), msecs=msecs)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return stats
+
+
+def checkpoint_path():
+    return os.path.join(settings.INDEX_DIR, f"{settings.INDEX_NAME}.checkpoint")
+
+
+def read_checkpoint():
+    """
+    Returns the last post id committed by the incremental indexer.
+    """
+    path = checkpoint_path()
+    if not os.path.isfile(path):
+        return 0
+    try:
+        data = json.load(open(path))
+        return int(data.get('last_id', 0))
+    except Exception as exc:
+        logger.error(f"Invalid checkpoint {path}: {exc}")
+        return 0
+
+
+def write_checkpoint(last_id, total=0):
+    """
+    Stores the progress of the incremental indexer next to the index.
+    """
+    ensure_index_dir()
+    path = checkpoint_path()
+    data = dict(last_id=last_id, total=total, date=util.now().isoformat())
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as fp:
+        json.dump(data, fp)
+    # Rename is atomic, a crash never leaves a partial checkpoint.
+    os.replace(tmp, path)
+
+
+def is_searchable(row):
+    # Deleted and spam posts are kept out of the index.
+    return row['status'] != Post.DELETED and row['spam'] != Post.SPAM
+
+
+def next_tombstones(last_id=0, limit=None):
+    """
+    Returns the next batch of (id, uid) pairs queued for removal from the index.
+    """
+    limit = limit or settings.BATCH_INDEXING_SIZE
+    tombstones = Tombstone.objects.filter(id__gt=last_id).order_by("id").values_list("id", "uid")
+    return list(tombstones[:limit])
+
+
+def drain_tombstones(optimize=False, backend=None):
+    """
+    Removes every queued post from the index. Returns the number of posts removed.
+    """
+    # Needs to be imported here to avoid circular imports.
+    from biostar.forum.backends import get_backend
+
+    backend = backend or get_backend()
+    if not backend.exists():
+        return 0
+
+    writer = backend.writer()
+    last_id, total = 0, 0
+    try:
+        tombstones = next_tombstones()
+        while tombstones:
+            for pk, uid in tombstones:
+                writer.delete_by_term("uid", uid)
+            last_id = tombstones[-1][0]
+            total += len(tombstones)
+            tombstones = next_tombstones(last_id=last_id)
+        writer.commit(optimize=optimize)
+    except Exception:
+        writer.cancel()
+        raise
+
+    Tombstone.objects.filter(id__lte=last_id).delete()
+    logger.info(f"Removed {total} posts from the index")
+
+    return total
+
+
+class IncrementalIndexer(object):
+    """
+    Adds posts with the indexed flag turned off to the search index as they appear,
+    and removes posts queued as tombstones.
+
+    Posts are read in batches ordered by primary key. The documents are kept in memory
+    until enough posts accumulate or enough time passes, then a writer is opened, the
+    documents are written and committed. The index is only locked while committing,
+    crawls, tombstone drains and rebuilds may run while the indexer follows.
+
+    Committed posts have their flag turned on, so each commit starts reading from
+    the first post again: only new and edited posts are left, found through the index
+    on the flag. The index segments are optimized every INDEX_OPTIMIZE_SECS seconds.
+    """
+
+    def __init__(self, batch_size=None, commit_size=None, commit_secs=None, optimize_secs=None, backend=None):
+        # Needs to be imported here to avoid circular imports.
+        from biostar.forum.backends import get_backend
+
+        self.batch_size = batch_size or settings.BATCH_INDEXING_SIZE
+        self.commit_size = commit_size or settings.INDEX_COMMIT_SIZE
+        self.commit_secs = commit_secs or settings.INDEX_SECS_INTERVAL
+        self.optimize_secs = optimize_secs or settings.INDEX_OPTIMIZE_SECS
+        self.backend = backend or get_backend()
+        self.slim = self.backend.slim
+
+        # Posts read but not committed yet, their documents and the uids to delete.
+        self.pending = []
+        self.pending_uids = set()
+        self.documents = []
+        self.deletes = set()
+        # Posts edited after this time need to be indexed again.
+        self.since = None
+        # Posts up to this id are pending.
+        self.last_id = 0
+
+        # Tombstones read but not committed yet.
+        self.tombstones = []
+        self.last_tombstone = 0
+
+        self.last_commit = self.last_optimize = time.time()
+        self.total = 0
+
+    def next_batch(self):
+        fields = DOCUMENT_FIELDS + ["status", "spam"]
+        posts = Post.objects.filter(indexed=False, id__gt=self.last_id).exclude(root=None)
+        posts = posts.order_by("id").values(*fields)[:self.batch_size]
+        return list(posts)
+
+    def remove(self):
+        """
+        Queues the next batch of tombstones for deletion from the index.
+        """
+        tombstones = next_tombstones(last_id=self.last_tombstone, limit=self.batch_size)
+        if not tombstones:
+            return 0
+
+        uids = {uid for pk, uid in tombstones}
+
+        # Deletes only apply to committed documents, pending documents of removed posts are dropped.
+        if uids & self.pending_uids:
+            self.documents = [doc for doc in self.documents if doc['uid'] not in uids]
+
+        self.deletes.update(uids)
+        self.tombstones.extend(pk for pk, uid in tombstones)
+        self.last_tombstone = tombstones[-1][0]
+
+        return len(tombstones)
+
+    def poll(self):
+        """
+        Reads the next batch of unindexed posts and commits when enough changes accumulate.
+        Returns the number of posts and tombstones that were read.
+        """
+        started = util.now()
+        posts = self.next_batch()
+
+        if posts:
+            # Posts that became deleted or spam are removed instead.
+            self.deletes.update(post['uid'] for post in posts if not is_searchable(post))
+            self.documents.extend(build_documents(list(filter(is_searchable, posts)), slim=self.slim))
+
+            self.pending.extend(post['id'] for post in posts)
+            self.pending_uids.update(post['uid'] for post in posts)
+            self.last_id = posts[-1]['id']
+            self.since = self.since or started
+
+        removed = self.remove()
+
+        changes = len(self.pending) + len(self.tombstones)
+        if changes and (changes >= self.commit_size or time.time() - self.last_commit >= self.commit_secs):
+            self.commit()
+
+        return len(posts) + removed
+
+    def write(self, optimize=False):
+        """
+        Writes the pending documents and deletes with a writer opened for this commit.
+        Returns False when another writer holds the index.
+        """
+        try:
+            writer = self.backend.writer()
+        except LockError:
+            logger.warning("The index is locked by another writer, committing later")
+            return False
+
+        try:
+            for uid in self.deletes:
+                writer.delete_by_term("uid", uid)
+            for doc in self.documents:
+                writer.update_document(**doc)
+            writer.commit(optimize=optimize)
+        except Exception:
+            writer.cancel()
+            raise
+
+        return True
+
+    def commit(self):
+        """
+        Commits the pending changes and saves the checkpoint.
+        """
+        optimize = time.time() - self.last_optimize >= self.optimize_secs
+
+        if self.documents or self.deletes:
+            if not self.write(optimize=optimize):
+                return
+            if optimize:
+                logger.info("Optimized the index")
+                self.last_optimize = time.time()
+
+        # Posts edited while being indexed keep the flag off.
+        if self.pending:
+            Post.objects.filter(id__in=self.pending, lastedit_date__lte=self.since).update(indexed=True)
+            self.total += len(self.pending)
+            logger.info(f"Committed {len(self.pending)} posts to the index")
+            write_checkpoint(last_id=max(self.pending), total=self.total)
+
+        if self.tombstones:
+            Tombstone.objects.filter(id__in=self.tombstones).delete()
+            logger.info(f"Removed {len(self.tombstones)} posts from the index")
+
+        self.reset()
+        self.last_commit = time.time()
+
+    def reset(self):
+        self.pending, self.pending_uids, self.since = [], set(), None
+        self.documents, self.deletes, self.tombstones = [], set(), []
+        # Committed posts are flagged, the next batch starts from the first unindexed post.
+        self.last_id = 0
+
+    def cancel(self):
+        self.reset()
+
+    def follow(self, sleep=1):
+        """
+        Polls for unindexed posts until interrupted.
+        """
+        logger.info(f"Following unindexed posts, last committed id={read_checkpoint()}")
+        try:
+            while True:
+                changes = self.poll()
+                # Wait for new posts once all batches are read.
+                if changes < self.batch_size:
+                    time.sleep(sleep)
+        except KeyboardInterrupt:
+            logger.info("Stopped following unindexed posts")
+            self.commit()
+        except Exception as exc:
+            logger.error(f"Error updating index: {exc}")
+            self.cancel()
+            raise
+
+
+# Creation date buckets and the age in days where each one ends.
+DATE_BUCKETS = [("week", 7), ("month", 30), ("year", 365), ("older", None)]
+
+
+def date_buckets():
+    """
+    Returns the name, start and end date of each creation date bucket, newest first.
+    """
+    now = util.now()
+    buckets, end = [], None
+    for name, days in DATE_BUCKETS:
+        start = now - timedelta(days=days) if days else None
+        buckets.append((name, start, end))
+        end = start
+    return buckets
+
+
+def get_facets(schema):
+    """
+    Facets counted while searching, from the sortable columns of the index.
+    """
+    # The creation date column holds microseconds, compared to the start of each bucket.
+    starts = [(name, datetime_to_long(start) if start else None) for name, start, end in date_buckets()]
+
+    def bucket(value):
+        for name, start in starts:
+            if start is None or value >= start:
+                return name
+
+    created = sorting.TranslateFacet(bucket, sorting.FieldFacet("creation_date"))
+    created.maptype = sorting.Count
+
+    facets = dict(type=sorting.FieldFacet("type", maptype=sorting.Count), created=created)
+
+    # Indexes built before the tags column existed would need a scan of every tag.
+    if schema["tags"].column_type:
+        facets['tags'] = sorting.FieldFacet("tags", allow_overlap=True, maptype=sorting.Count)
+
+    return facets
+
+
+def parse_filters(params):
+    """
+    Returns the valid facet filters found in the request parameters.
+    """
+    filters = dict()
+
+    ptype = params.get('type', '')
+    if ptype.isdigit() and int(ptype) in dict(Post.TYPE_CHOICES):
+        filters['type'] = int(ptype)
+
+    tag = params.get('tag', '').strip()
+    if tag:
+        filters['tag'] = tag
+
+    created = params.get('created', '')
+    if created in dict(DATE_BUCKETS):
+        filters['created'] = created
+
+    return filters
+
+
+def get_filter(filters):
+    """
+    Returns a query that narrows the results to the selected facets.
+    """
+    terms = []
+    if 'type' in filters:
+        terms.append(Term("type", filters['type']))
+    if 'tag' in filters:
+        terms.append(Term("tags", filters['tag']))
+    if 'created' in filters:
+        bounds = {name: (start, end) for name, start, end in date_buckets()}
+        start, end = bounds[filters['created']]
+        terms.append(DateRange("creation_date", start, end, endexcl=True))
+
+    return And(terms) if terms else None
+
+
+def facet_counts(results):
+    """
+    Returns the (value, count) pairs of each facet, the most frequent first.
+    Creation date buckets are ordered by age.
+    """
+    results = results.results if isinstance(results, ResultsPage) else results
+    counts = dict()
+    for name in results.facet_names():
+        groups = results.groups(name).items()
+        groups = [(key.decode("utf-8") if isinstance(key, bytes) else key, value) for key, value in groups]
+        counts[name] = sorted(groups, key=lambda item: item[1], reverse=True)
+
+    order = [name for name, days in DATE_BUCKETS]
+    counts['created'] = sorted(counts.get('created', []), key=lambda item: order.index(item[0]))
+    counts['tags'] = counts.get('tags', [])[:settings.SEARCH_FACET_TAGS]
+
+    return counts
+
+
+def preform_whoosh_search(query, fields=None, page=None, per_page=20, facets=False, filters=None, **kwargs):
     """
         Query the indexed, looking for a match in the specified fields.
         Results a tuple of results and an open searcher object.
+        The searcher belongs to the pool, release it with close() when done.
+        Facet counts are collected in the same pass when facets is True.
         """
 
+    if len(query) < settings.SEARCH_CHAR_MIN:
+        return []
+
     # Do not preform search if the index does not exist.
-    if not index_exists() or len(query) < settings.SEARCH_CHAR_MIN:
+    searcher = POOL.acquire()
+    if searcher is None:
         return []
 
-    fields = fields or ['tags', 'title', 'author', 'author_uid', 'author_handle']
-    ix = init_index()
-    searcher = ix.searcher()
+    fields = fields or DEFAULT_FIELDS
+
+    if facets:
+        kwargs.update(groupedby=get_facets(searcher.schema))
+
+    if filters:
+        kwargs.update(filter=get_filter(filters))
 
     # profile_score = FieldFacet("author_score", reverse=True)
     # post_type = FieldFacet("type")
@@ -295,7 +1213,7 @@ def preform_whoosh_search(query, fields=None, page=None, per_page=20, **kwargs):
     # sort_by = sort_by or [post_type, rank, thread, default, profile_score]
     # sort_by = [lastedit_date]
 
-    parser = MultifieldParser(fieldnames=fields, schema=ix.schema, group=orgroup).parse(query)
+    parser = MultifieldParser(fieldnames=fields, schema=searcher.schema, group=orgroup).parse(query)
     if page:
         # Return a pagenated version of the results.
 
@@ -321,39 +1239,238 @@ def preform_whoosh_search(query, fields=None, page=None, per_page=20, **kwargs):
     return results
 
 
-def whoosh_more_like_this(uid):
+class SearchPage(object):
     """
-    Return posts similar to the uid given.
+    A page of search results that can be cached.
+    Each result is a dictionary of stored fields with the score and highlights added.
     """
 
-    results = preform_whoosh_search(query=uid, fields=['uid'])
+    def __init__(self, hits=None, total=0, pagenum=1, pagecount=1, facets=None):
+        self.hits = hits or []
+        self.facets = facets or {}
+        self.total = total
+        self.pagenum = pagenum
+        self.pagecount = pagecount
 
-    if isinstance(results, list) or not len(results):
-        return SearchResult()
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+    def is_last_page(self):
+        return self.pagenum >= self.pagecount
+
+
+SEARCH_CACHE_PREFIX = "SEARCH"
+SEARCH_HITS_KEY = f"{SEARCH_CACHE_PREFIX}-HITS"
+SEARCH_MISSES_KEY = f"{SEARCH_CACHE_PREFIX}-MISSES"
+
+
+def normalize_query(query):
+    """
+    Returns the form of a query used in cache keys, with the whitespace collapsed.
+    Words are kept as typed: the title, tag and author fields keep stop words and
+    tags are matched case sensitively, so other changes could return other hits.
+    """
+    return ' '.join(query.split())
+
+
+def search_cache_key(query, fields, page, per_page, generation, filters=None):
+    filters = ','.join(f"{name}={value}" for name, value in sorted((filters or {}).items()))
+    value = f"{query}|{','.join(fields)}|{page}|{per_page}|{generation}|{filters}"
+    digest = hashlib.md5(value.encode("utf-8")).hexdigest()
+    return f"{SEARCH_CACHE_PREFIX}-{digest}"
+
+
+def count_lookup(hit):
+    # Counters are kept in the cache so that all workers share them.
+    key = SEARCH_HITS_KEY if hit else SEARCH_MISSES_KEY
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def cache_stats():
+    """
+    Returns the number of hits, misses and the hit rate of the search cache.
+    """
+    hits = cache.get(SEARCH_HITS_KEY, 0)
+    misses = cache.get(SEARCH_MISSES_KEY, 0)
+    total = hits + misses
+    rate = hits / total if total else 0
+    return dict(hits=hits, misses=misses, rate=rate)
+
+
+def cached_search(query, fields=None, page=1, per_page=20, filters=None):
+    """
+    Returns a SearchPage for the query, served from the cache when possible.
+    Filters narrow the results to facet values, see parse_filters.
+
+    Cache keys contain the index generation, a commit invalidates earlier entries.
+    Entries hold (uid, score, highlights) tuples, the stored fields are read back from the index.
+    """
+    fields = fields or DEFAULT_FIELDS
+    query = query.strip()
+
+    if len(query) < settings.SEARCH_CHAR_MIN:
+        return SearchPage()
+
+    searcher = POOL.acquire()
+    if searcher is None:
+        return SearchPage()
 
-    results = results[0].more_like_this("content", top=settings.SIMILAR_FEED_COUNT)
-    # Filter results for toplevel posts.
-    results = filter(lambda p: p['is_toplevel'] is True, results)
+    try:
+        # Queries that only differ in whitespace share an entry.
+        generation = POOL.generation_of(searcher)
+        key = search_cache_key(normalize_query(query), fields, page, per_page, generation, filters=filters)
+        entry = cache.get(key)
+        count_lookup(hit=entry is not None)
+
+        if entry is None:
+            return search_and_cache(key=key, query=query, fields=fields, page=page, per_page=per_page,
+                                    filters=filters)
+
+        total, pagenum, pagecount, compact, facets = entry
+        uids = [uid for uid, score, highlights in compact]
+        if is_slim(searcher.schema):
+            docs = hydrate(uids)
+        else:
+            docs = {uid: searcher.document(uid=uid) for uid in uids}
+
+        hits = []
+        for uid, score, highlights in compact:
+            doc = docs.get(uid)
+            if doc:
+                doc.update(score=score, highlights=highlights)
+                hits.append(doc)
+
+        return SearchPage(hits=hits, total=total, pagenum=pagenum, pagecount=pagecount, facets=facets)
+    finally:
+        POOL.release(searcher)
+
+
+def hydrate(uids):
+    """
+    Reads the documents for hits of a slim index from the database with a single query.
+    Returns the documents keyed by uid, posts missing from the database are left out.
+    """
+    posts = Post.objects.filter(uid__in=uids).select_related("root", "author__profile", "lastedit_user__profile")
+    collector = DocumentCollector()
+    for post in posts:
+        add_index(post, collector)
+    return {doc['uid']: doc for doc in collector.docs}
+
+
+def hit_fields(hits):
+    """
+    Returns the stored fields of the hits keyed by uid, read from the database for a slim index.
+    """
+    if hits and is_slim(hits[0].searcher.schema):
+        return hydrate([hit['uid'] for hit in hits])
+    return {hit['uid']: hit.fields() for hit in hits}
+
+
+def page_hits(results):
+    """
+    Returns the documents of a page of results in ranked order, with the score and highlights added,
+    and the compact (uid, score, highlights) version stored in the cache.
+    """
+    hits = list(results)
+    docs = hit_fields(hits)
+
+    found, compact = [], []
+    for hit in hits:
+        doc = docs.get(hit['uid'])
+        if doc is None:
+            continue
+        highlights = hit.highlights("content", text=doc['content'])
+        compact.append((hit['uid'], hit.score, highlights))
+        doc.update(score=hit.score, highlights=highlights)
+        found.append(doc)
+
+    return found, compact
+
+
+def run_search(query, fields=None, page=1, per_page=20, filters=None):
+    """
+    Returns a SearchPage with facet counts and the compact version of its hits.
+    """
+    results = preform_whoosh_search(query=query, fields=fields or DEFAULT_FIELDS, page=page, per_page=per_page,
+                                    facets=True, filters=filters)
+    if isinstance(results, list) or not len(results):
+        close(results)
+        return SearchPage(), []
 
-    final_results = list(map(normalize_result, results))
-    if isinstance(results, Results):
-        # Ensure searcher object gets closed.
+    try:
+        hits, compact = page_hits(results)
+        facets = facet_counts(results)
+        total, pagenum, pagecount = results.total, results.pagenum, results.pagecount
+    finally:
         close(results)
 
+    return SearchPage(hits=hits, total=total, pagenum=pagenum, pagecount=pagecount, facets=facets), compact
+
+
+def search_and_cache(key, query, fields, page, per_page, filters=None):
+    """
+    Runs the search and stores a compact version of the results in the cache.
+    """
+    page, compact = run_search(query=query, fields=fields, page=page, per_page=per_page, filters=filters)
+    if not compact:
+        return page
+
+    entry = (page.total, page.pagenum, page.pagecount, compact, page.facets)
+    cache.set(key, entry, settings.SEARCH_CACHE_SECS)
+
+    return page
+
+
+def whoosh_more_like_this(uid, top=None):
+    """
+    Return posts similar to the uid given.
+    """
+    top = top or settings.SIMILAR_FEED_COUNT
+
+    hits = preform_whoosh_search(query=uid, fields=['uid'])
+
+    if isinstance(hits, list) or not len(hits):
+        close(hits)
+        return SearchResult()
+
+    try:
+        # Slim indexes do not store the content.
+        text = None
+        if is_slim(hits.searcher.schema):
+            text = Post.objects.filter(uid=uid).values_list("content", flat=True).first() or ''
+
+        results = hits[0].more_like_this("content", text=text, top=top)
+        # Filter results for toplevel posts.
+        results = list(filter(lambda p: p['is_toplevel'] is True, results))
+        docs = hit_fields(results)
+        final_results = [normalize_result(docs[hit['uid']]) for hit in results if hit['uid'] in docs]
+    finally:
+        # Similar posts are read from the same searcher.
+        close(hits)
+
     return final_results
 
 
 def preform_search(query, fields=None, db_search=False):
-    fields = fields or ['tags', 'title', 'author', 'author_uid', 'author_handle']
+    fields = fields or DEFAULT_FIELDS
 
     results = preform_whoosh_search(query=query, fields=fields)
     if isinstance(results, list) or not len(results):
+        close(results)
         return SearchResult()
 
     # Ensure returned results types stay consistent.
-    final_results = list(map(normalize_result, results))
-    if isinstance(results, Results):
-        # Ensure searcher object gets closed.
-        close(results)
+    docs = hit_fields(list(results))
+    final_results = [normalize_result(docs[hit['uid']]) for hit in results if hit['uid'] in docs]
+
+    # Release the searcher back into the pool.
+    close(results)
 
     return final_results
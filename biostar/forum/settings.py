@@ -36,8 +36,63 @@ SEARCH_CHAR_MIN = 1
 # Number of results to display per page.
 SEARCH_RESULTS_PER_PAGE = 50
 
+# Search engine used by the forum: whoosh or database (SQLite FTS5, Postgres full text search).
+SEARCH_BACKEND = "whoosh"
+
+# Number of tags shown in the search facets.
+SEARCH_FACET_TAGS = 20
+
+# Seconds before the title, tag and user completions are read again from the database.
+AUTOCOMPLETE_REBUILD_SECS = 60 * 10
+
+# Number of completions returned for a prefix.
+AUTOCOMPLETE_LIMIT = 10
+
+# The default cache is kept in the memory of each process. The shared cache is seen by every
+# worker and the spooler, and outlives restarts. It holds the versions of the cached listings
+# and threads and is read on every cache hit. Files serve the workers of one host,
+# point it at memcached or redis when the workers run on several hosts.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.abspath(os.path.join(MEDIA_ROOT, '..', 'cache')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# The cache alias used for state that all processes must agree on.
+SHARED_CACHE = "shared"
+
+# How long search results are cached, commits to the index invalidate them earlier.
+SEARCH_CACHE_SECS = 60 * 60
+
+# How long post listings rendered for anonymous users are cached. Each process keeps its own
+# entries and post changes do not invalidate them, changes show up within this time.
+LISTING_CACHE_SECS = 60
+
+# How long the rendered answers and comments of a thread are cached, changes to the thread invalidate them earlier.
+THREAD_CACHE_SECS = 60 * 15
+
+# How long markdown rendered in templates is cached, keyed by the hash of the text.
+MARKDOWN_CACHE_SECS = 60 * 60
+
 BATCH_INDEXING_SIZE = 1000
 
+# Number of posts added before the incremental indexer commits.
+INDEX_COMMIT_SIZE = 5000
+
+# Seconds between optimizing the index segments.
+INDEX_OPTIMIZE_SECS = 60 * 60 * 24
+
+# New indexes store only uids, sort keys and a snippet, results are read from the database.
+SLIM_INDEX = False
+
+# Number of characters stored as a snippet in a slim index.
+SNIPPET_LENGTH = 300
+
 # Add another context processor to first template.
 TEMPLATES[0]['OPTIONS']['context_processors'] += [
     'biostar.forum.context.forum'
@@ -105,6 +160,22 @@ WSGI_APPLICATION = 'biostar.wsgi.application'
 # Time between two accesses from the same IP to qualify as a different view.
 POST_VIEW_MINUTES = 7
 
+# Seconds between writing the buffered post views to the database.
+VIEW_FLUSH_SECS = 5
+
+# Days that the daily unique viewer sketches are kept for.
+VIEW_SKETCH_DAYS = 7
+
+# The oEmbed endpoint that returns the html of embedded tweets.
+TWITTER_OEMBED_URL = "https://publish.twitter.com/oembed"
+
+# Seconds to wait for an embed before giving up.
+EMBED_TIMEOUT = 5
+
+# How long fetched embeds are kept, and how long to wait before fetching a failed embed again.
+EMBED_CACHE_SECS = 60 * 60 * 24 * 30
+EMBED_RETRY_SECS = 60 * 60
+
 COUNT_INTERVAL_WEEKS = 10000
 
 # This flag is used flag situation where a data migration is in progress.
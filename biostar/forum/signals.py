@@ -1,11 +1,10 @@
 import logging
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from taggit.models import Tag
 from django.db.models import F, Q
 from biostar.accounts.models import Profile, Message, User
-from .models import Post, Award, Subscription
-from . import tasks, auth, util
+from .models import Post, Award, Subscription, Tombstone
+from . import tasks, auth, util, autocomplete, counters, embeds
 
 
 logger = logging.getLogger("biostar")
@@ -34,7 +33,7 @@ def ban_user(sender, instance, created, **kwargs):
     if instance.state == Profile.BANNED:
         # Delete all posts by this users
         #print(Post.objects.filter(author=instance.user).thread_users)
-        Post.objects.filter(author=instance.user).delete()
+        auth.delete_posts(Post.objects.filter(author=instance.user))
         #print(Post.objects.filter(author=instance))
         # Remove all 'lastedit user' flags
         # posts = Post.objects.filter(lastedit_user=instance.user)
@@ -44,7 +43,9 @@ def ban_user(sender, instance, created, **kwargs):
         # Delete all awards by the user.
         Award.objects.filter(user=instance.user).delete()
 
-        Subscription.objects.filter(user=instance.user).delete()
+        subs = Subscription.objects.filter(user=instance.user)
+        counters.subscriptions_removed(subs)
+        subs.delete()
         # Take out any personal information user added.
         #Profile.objects.filter(uid=instance.uid).update(text='')
 
@@ -52,16 +53,37 @@ def ban_user(sender, instance, created, **kwargs):
         Message.objects.filter(Q(sender=instance.user) | Q(recipient=instance.user)).delete()
 
 
+@receiver(post_save, sender=Profile)
+def complete_profile(sender, instance, **kwargs):
+    """
+    Keep user handles in the autocomplete up to date.
+    """
+    autocomplete.update_profile(instance)
+
+
+@receiver(post_delete, sender=Post)
+def remove_post(sender, instance, **kwargs):
+    """
+    Queue removed posts to be deleted from the search index.
+    """
+    # Posts removed by auth.delete_posts are handled once for the whole batch.
+    if auth.collect_deleted(instance):
+        return
+
+    Tombstone.objects.create(uid=instance.uid)
+    counters.removed(instance)
+    autocomplete.COMPLETER.remove(autocomplete.POST, instance.uid)
+    auth.bump_thread(instance.root_id)
+
+
 @receiver(post_save, sender=Post)
 def finalize_post(sender, instance, created, **kwargs):
 
     # Determine the root of the post.
     root = instance.root if instance.root is not None else instance
 
-    # Add tags
-    instance.tags.clear()
-    tags = [Tag.objects.get_or_create(name=name)[0] for name in instance.parse_tags()]
-    instance.tags.add(*tags)
+    # Add and remove the tags that changed.
+    auth.sync_tags(instance)
 
     # Update last contributor, last editor, and last edit date to the thread
     Post.objects.filter(uid=root.uid).update(lastedit_user=instance.lastedit_user,
@@ -103,7 +125,7 @@ def finalize_post(sender, instance, created, **kwargs):
 
         # Save the instance.
         instance.save()
-        instance.update_parent_counts()
+        counters.created(instance)
 
         # Bump the root rank when a new descendant is added.
         Post.objects.filter(uid=instance.root.uid).update(rank=util.now().timestamp())
@@ -120,6 +142,16 @@ def finalize_post(sender, instance, created, **kwargs):
     # Ensure posts get re-indexed after being edited.
     Post.objects.filter(uid=instance.uid).update(indexed=False)
 
+    # Fetch the new embeds in the background. New posts are saved twice, the second save schedules it.
+    if not created and embeds.has_placeholders(instance.html):
+        tasks.resolve_embeds.spool(post_id=instance.id)
+
+    # Complete the new title and tags.
+    autocomplete.update_post(instance)
+
+    # Cached threads show the new post and counts.
+    auth.bump_thread(instance.root_id)
+
     # Exclude current authors from receiving messages from themselves
     subs = subs.exclude(Q(type=Subscription.NO_MESSAGES) | Q(user=instance.author))
     extra_context = dict(post=instance)
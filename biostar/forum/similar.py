@@ -0,0 +1,249 @@
+"""
+Precomputes similar threads with TF-IDF vectors over titles, tags and content.
+"""
+import json
+import logging
+import math
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Max
+from whoosh.analysis import StemmingAnalyzer
+
+from biostar.forum.models import Post, SimilarPost, TermCounts, TermWeight, TermFrequency
+from biostar.forum import util
+from biostar.forum.search import STOP
+
+logger = logging.getLogger("engine")
+
+# Same analysis as the search index.
+ANALYZER = StemmingAnalyzer(stoplist=STOP)
+
+# Title and tag terms count more than content terms.
+TITLE_WEIGHT, TAGS_WEIGHT = 3, 3
+
+# Only the highest weighted terms of a thread are compared.
+MAX_TERMS = 50
+
+# Terms found in more than this fraction of threads are ignored.
+MAX_DF = 0.1
+
+# Longer terms, such as pasted sequences, are skipped.
+MAX_LENGTH = 100
+
+
+def tokenize(text):
+    return [token.text for token in ANALYZER(text or '') if len(token.text) <= MAX_LENGTH]
+
+
+def get_threads():
+    """
+    Threads that may be shown as similar posts.
+    """
+    query = Post.objects.filter(is_toplevel=True).exclude(status=Post.DELETED).exclude(spam=Post.SPAM)
+    return query
+
+
+def term_counts(title, tag_val, content):
+    counts = Counter(tokenize(content))
+    for term in tokenize(title):
+        counts[term] += TITLE_WEIGHT
+    for term in tokenize(tag_val.replace(",", " ")):
+        counts[term] += TAGS_WEIGHT
+    return counts
+
+
+def weigh(terms, freqs, total):
+    """
+    Returns the normalized TF-IDF vector of the term counts of a thread.
+    """
+    weights = {term: (1 + math.log(tf)) * math.log(total / max(freqs[term], 1)) for term, tf in terms.items()}
+    top = sorted(weights.items(), key=lambda item: item[1], reverse=True)[:MAX_TERMS]
+    norm = math.sqrt(sum(w * w for term, w in top)) or 1
+    return {term: w / norm for term, w in top if w > 0}
+
+
+def build_vectors(counts):
+    """
+    Returns normalized TF-IDF vectors keyed by post id, and the number of threads each term is found in.
+    The counts are the term counts of each thread keyed by post id.
+    """
+    freqs = Counter()
+    for terms in counts.values():
+        freqs.update(terms.keys())
+
+    total = len(counts)
+    vectors = {pk: weigh(terms, freqs, total) for pk, terms in counts.items()}
+
+    return vectors, freqs
+
+
+def build_postings(vectors, freqs):
+    """
+    Inverted index from a term to the (id, weight) of the threads containing it.
+    """
+    limit = max(2, MAX_DF * len(vectors))
+    postings = defaultdict(list)
+    for pk, vector in vectors.items():
+        for term, weight in vector.items():
+            if freqs[term] <= limit:
+                postings[term].append((pk, weight))
+    return postings
+
+
+def score_threads(pk, vectors, postings):
+    """
+    Returns the cosine similarity of a thread to every thread sharing a term with it, keyed by id.
+    """
+    scores = defaultdict(float)
+    for term, weight in vectors.get(pk, {}).items():
+        for other, other_weight in postings.get(term, []):
+            if other != pk:
+                scores[other] += weight * other_weight
+    return scores
+
+
+def find_similar(pk, vectors, postings, top):
+    """
+    Returns the top (id, score) pairs with the highest cosine similarity.
+    """
+    scores = score_threads(pk, vectors, postings)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top]
+    return best
+
+
+def last_run():
+    return SimilarPost.objects.aggregate(date=Max("date"))['date']
+
+
+def store_terms(counts, vectors):
+    """
+    Stores the term counts and the vectors of the threads, read back by incremental runs.
+    """
+    TermCounts.objects.bulk_create([TermCounts(post_id=pk, data=json.dumps(terms)) for pk, terms in counts.items()],
+                                   batch_size=1000)
+    weights = [TermWeight(post_id=pk, term=term, weight=weight)
+               for pk, vector in vectors.items() for term, weight in vector.items()]
+    TermWeight.objects.bulk_create(weights, batch_size=1000)
+
+
+def store_freqs(freqs):
+    """
+    Replaces the number of threads the terms are found in.
+    """
+    TermFrequency.objects.filter(term__in=list(freqs)).delete()
+    found = [TermFrequency(term=term, threads=count) for term, count in freqs.items() if count > 0]
+    TermFrequency.objects.bulk_create(found, batch_size=1000)
+
+
+def get_freqs(terms):
+    return Counter(dict(TermFrequency.objects.filter(term__in=list(terms)).values_list("term", "threads")))
+
+
+def compute_all(top, started):
+    """
+    Builds the vectors of every thread and stores the similar threads of each.
+    Returns the ids of the threads updated.
+    """
+    rows = get_threads().values_list("id", "title", "tag_val", "content").iterator()
+    counts = {pk: term_counts(title, tag_val, content) for pk, title, tag_val, content in rows}
+    vectors, freqs = build_vectors(counts)
+    postings = build_postings(vectors, freqs)
+    targets = sorted(vectors)
+
+    similar = []
+    for pk in targets:
+        for rank, (other, score) in enumerate(find_similar(pk, vectors, postings, top=top)):
+            similar.append(SimilarPost(post_id=pk, target_id=other, score=score, rank=rank, date=started))
+
+    with transaction.atomic():
+        for model in (SimilarPost, TermCounts, TermWeight, TermFrequency):
+            model.objects.all().delete()
+        SimilarPost.objects.bulk_create(similar, batch_size=1000)
+        store_terms(counts, vectors)
+        store_freqs(freqs)
+
+    return targets
+
+
+def compute_changed(top, started, since):
+    """
+    Builds the vectors of the threads edited or removed since the last run and stores the
+    similar threads of the changed threads and of their neighbours: those that listed a changed
+    thread before and those sharing a term with a changed thread now.
+    The stored vectors and term frequencies of the other threads are reused.
+    Returns the ids of the threads updated.
+    """
+    threads = get_threads()
+    rows = threads.filter(lastedit_date__gt=since).values_list("id", "title", "tag_val", "content")
+    counts = {pk: term_counts(title, tag_val, content) for pk, title, tag_val, content in rows}
+    removed = set(TermCounts.objects.exclude(post__in=threads).values_list("post_id", flat=True))
+    changed = set(counts) | removed
+
+    # The terms the threads had at the last run no longer count.
+    old = TermCounts.objects.filter(post_id__in=changed).values_list("data", flat=True)
+    delta = Counter()
+    for data in old:
+        delta.subtract(json.loads(data).keys())
+    for terms in counts.values():
+        delta.update(terms.keys())
+
+    freqs = get_freqs(delta)
+    freqs.update(delta)
+    total = threads.count()
+    limit = max(2, MAX_DF * total)
+    vectors = {pk: weigh(terms, freqs, total) for pk, terms in counts.items()}
+
+    with transaction.atomic():
+        listed = set(SimilarPost.objects.filter(target_id__in=changed).values_list("post_id", flat=True))
+
+        for model in (TermCounts, TermWeight):
+            model.objects.filter(post_id__in=changed).delete()
+        store_terms(counts, vectors)
+        store_freqs({term: freqs[term] for term, change in delta.items() if change})
+
+        # Threads sharing a rare term with a changed thread.
+        rare = {term for vector in vectors.values() for term in vector if freqs[term] <= limit}
+        near = set(TermWeight.objects.filter(term__in=rare).values_list("post_id", flat=True))
+        targets = (set(counts) | listed | near) - removed
+
+        # The stored vectors of the neighbours and the threads sharing their terms.
+        stored = TermWeight.objects.filter(post_id__in=targets - set(counts))
+        for pk, term, weight in stored.values_list("post_id", "term", "weight"):
+            vectors.setdefault(pk, {})[term] = weight
+        terms = {term for pk in targets for term in vectors.get(pk, {})}
+        freqs.update(get_freqs(terms - set(freqs)))
+        rare = {term for term in terms if freqs[term] <= limit}
+        postings = defaultdict(list)
+        for term, pk, weight in TermWeight.objects.filter(term__in=rare).values_list("term", "post_id", "weight"):
+            postings[term].append((pk, weight))
+
+        similar = []
+        for pk in sorted(targets):
+            for rank, (other, score) in enumerate(find_similar(pk, vectors, postings, top=top)):
+                similar.append(SimilarPost(post_id=pk, target_id=other, score=score, rank=rank, date=started))
+
+        SimilarPost.objects.filter(post_id__in=targets | removed).delete()
+        SimilarPost.objects.bulk_create(similar, batch_size=1000)
+
+    return sorted(targets)
+
+
+def compute_similar(top=10, incremental=False):
+    """
+    Stores the top similar threads for every thread. Returns the number of threads updated.
+
+    In incremental mode only the threads edited since the last run and their neighbours
+    get their lists rewritten, the vectors of the other threads are read back from the last run.
+    """
+    started = util.now()
+    since = last_run() if incremental else None
+
+    if since and TermCounts.objects.exists():
+        targets = compute_changed(top=top, started=started, since=since)
+    else:
+        targets = compute_all(top=top, started=started)
+
+    logger.info(f"Computed similar posts for {len(targets)} threads")
+
+    return len(targets)
@@ -0,0 +1,65 @@
+"""
+HyperLogLog sketches that estimate the number of distinct items added to them.
+
+A sketch is a byte string of registers. Sketches of different sets are merged by
+keeping the largest value of each register.
+"""
+import hashlib
+import math
+
+# The first bits of the hash select the register, 2 ** 8 registers give estimates within about 6%.
+PRECISION = 8
+REGISTERS = 1 << PRECISION
+
+# Bits of the hash left to count the leading zeros in.
+HASH_BITS = 64
+REST_BITS = HASH_BITS - PRECISION
+
+ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+
+
+def empty():
+    return bytearray(REGISTERS)
+
+
+def add(registers, item):
+    """
+    Adds an item to the registers in place.
+    """
+    digest = hashlib.blake2b(str(item).encode("utf-8"), digest_size=HASH_BITS // 8).digest()
+    value = int.from_bytes(digest, "big")
+
+    index = value >> REST_BITS
+    rest = value & ((1 << REST_BITS) - 1)
+
+    # Position of the first set bit in the rest of the hash.
+    rank = REST_BITS - rest.bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+    return registers
+
+
+def merge(*sketches):
+    """
+    Returns the registers of the union of the sketches.
+    """
+    registers = empty()
+    for sketch in sketches:
+        registers = bytearray(map(max, registers, sketch or bytes(REGISTERS)))
+    return registers
+
+
+def estimate(registers):
+    """
+    Returns the approximate number of distinct items added to the registers.
+    """
+    total = sum(2.0 ** -value for value in registers)
+    value = ALPHA * REGISTERS * REGISTERS / total
+
+    # Small counts are estimated from the registers still empty.
+    zeros = registers.count(0)
+    if value <= 2.5 * REGISTERS and zeros:
+        value = REGISTERS * math.log(REGISTERS / zeros)
+
+    return int(round(value))
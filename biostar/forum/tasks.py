@@ -18,12 +18,23 @@ def created_post(pid):
     message(f"Created post={pid}")
 
 
+@spool(pass_arguments=True)
+def resolve_embeds(post_id):
+    from biostar.forum import embeds
+
+    embeds.resolve_post(post_id)
+
+
 
 #
 # This timer leads to problems as described in
 #
 # https://github.com/unbit/uwsgi/issues/1369
 #
+# Run the incremental indexer as a separate process instead:
+#
+# python manage.py index --follow
+#
 
 # #@timer(secs=180)
 # def update_index(*args):
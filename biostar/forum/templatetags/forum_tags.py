@@ -15,6 +15,7 @@ from taggit.models import Tag
 from django import template, forms
 from django.db.models import Count
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from django.core.paginator import Paginator
 from django.shortcuts import reverse
@@ -35,6 +36,7 @@ register = template.Library()
 ICON_MAP = dict(
     rank="list ol icon",
     views="eye icon",
+    viewers="users icon",
     replies="comments icon",
     votes="thumbs up icon",
     all='calendar plus icon',
@@ -107,12 +109,48 @@ def pages_search(context, results):
     next_page = results.pagenum + 1 if not results.is_last_page() else results.pagenum
     request = context['request']
     query = request.GET.get('query', '')
+
+    # Keep the selected facets when changing pages.
+    params = request.GET.copy()
+    params.pop('page', None)
+
     context = dict(results=results, previous_page=previous_page, query=query,
-                   next_page=next_page)
+                   next_page=next_page, params=params.urlencode())
 
     return context
 
 
+@register.inclusion_tag('widgets/search_facets.html', takes_context=True)
+def search_facets(context, results):
+    """
+    Links that narrow the search results to a facet value, or remove the selected one.
+    """
+    request = context['request']
+    type_display = dict(Post.TYPE_CHOICES)
+    created_display = dict(week="Past week", month="Past month", year="Past year", older="Older")
+
+    facets = [("type", "type", "Type", type_display), ("created", "created", "Created", created_display),
+              ("tags", "tag", "Tags", {})]
+
+    groups = []
+    for name, param, label, display in facets:
+        items = []
+        for value, total in results.facets.get(name, []):
+            params = request.GET.copy()
+            params.pop('page', None)
+            active = params.get(param) == str(value)
+            if active:
+                params.pop(param)
+            else:
+                params[param] = value
+            url = f"{reverse('post_search')}?{params.urlencode()}"
+            items.append(dict(name=display.get(value, value), count=total, active=active, url=url))
+        if items:
+            groups.append(dict(label=label, items=items))
+
+    return dict(groups=groups)
+
+
 @register.simple_tag
 def post_type_display(post_type):
     mapper = dict(Post.TYPE_CHOICES)
@@ -537,7 +575,7 @@ def get_wording(filtered, prefix="Sort by:", default=""):
     """
 
     display = dict(all="all time", week="this week", month="this month",
-                   year="this year", rank="Rank", views="Views", today="today",
+                   year="this year", rank="Rank", views="Views", viewers="Viewers", today="today",
                    replies="replies", votes="Votes", visit="recent visit",
                    reputation="reputation", joined="date joined", activity="activity level",
                    rsent="oldest to newest ", sent="newest to oldest",
@@ -716,6 +754,11 @@ def boxclass(post=None, uid=None):
 @register.simple_tag(takes_context=True)
 def render_comments(context, tree, post, template_name='widgets/comment_body.html'):
     request = context["request"]
+
+    # Comments already rendered from the thread cache.
+    if getattr(post, "comments_html", None) is not None:
+        return mark_safe(post.comments_html)
+
     if post.id in tree:
         text = traverse_comments(request=request, post=post, tree=tree, template_name=template_name)
 
@@ -770,6 +813,19 @@ def top_level_only(attrs, new=False):
         return None
     return attrs
 
+def render_markdown(text, sanatize=True, escape=True):
+    """
+    Renders and linkifies markdown. Renders are cached by the hash of the text.
+    """
+    key = markdown.render_key(text, sanatize, escape)
+    html = cache.get(key)
+    if html is None:
+        html = markdown.parse(text, sanatize=sanatize, escape=escape)
+        html = bleach.linkify(html, callbacks=[top_level_only], skip_tags=['pre'])
+        cache.set(key, html, settings.MARKDOWN_CACHE_SECS)
+    return html
+
+
 @register.simple_tag
 def markdown_file(pattern):
     """
@@ -786,8 +842,7 @@ def markdown_file(pattern):
 
     try:
 
-        html = markdown.parse(text, sanatize=False, escape=False)
-        html = bleach.linkify(html, callbacks=[top_level_only], skip_tags=['pre'])
+        html = render_markdown(text, sanatize=False, escape=False)
         html = mark_safe(html)
     except Exception as e:
         html = f"Markdown rendering exception"
@@ -795,14 +850,12 @@ def markdown_file(pattern):
     return html
 
 class MarkDownNode(template.Node):
-    CALLBACKS = [ top_level_only ]
     def __init__(self, nodelist):
         self.nodelist = nodelist
 
     def render(self, context):
         text = self.nodelist.render(context)
-        text = markdown.parse(text)
-        text = bleach.linkify(text, callbacks=self.CALLBACKS, skip_tags=['pre'])
+        text = render_markdown(text)
         return text
 
 @register.tag('markdown')
@@ -821,3 +874,48 @@ def markdown_tag(parser, token):
     # need to do this otherwise we get big fail
     parser.delete_first_token()
     return MarkDownNode(nodelist)
+
+
+class OverlayNode(template.Node):
+    def __init__(self, post, name, nodelist):
+        self.post = post
+        self.name = name
+        self.nodelist = nodelist
+
+    def render(self, context):
+        post = self.post.resolve(context)
+
+        # Posts rendered for the thread cache mark the region, it is kept or dropped for each user later.
+        if getattr(post, "overlay", False):
+            return auth.overlay_region(self.name, post.uid, self.nodelist.render(context))
+
+        return self.nodelist.render(context) if getattr(post, self.name, False) else ''
+
+
+@register.tag('overlay')
+def overlay_tag(parser, token):
+    """
+    Shows a block of a post that depends on the user viewing it.
+    Syntax::
+            {% overlay post "is_editable" %}
+            Shown when post.is_editable is true.
+            {% endoverlay %}
+    """
+    try:
+        tag_name, post, name = token.split_contents()
+    except ValueError:
+        raise template.TemplateSyntaxError("overlay tag requires a post and an attribute name")
+
+    nodelist = parser.parse(('endoverlay',))
+    parser.delete_first_token()
+    return OverlayNode(parser.compile_filter(post), name.strip("'\""), nodelist)
+
+
+@register.simple_tag
+def overlay_value(post, name):
+    """
+    Returns a value of a post that depends on the user viewing it.
+    """
+    if getattr(post, "overlay", False):
+        return auth.overlay_field(name, post.uid)
+    return getattr(post, name, 0)
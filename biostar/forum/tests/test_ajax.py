@@ -5,7 +5,7 @@ from django.urls import reverse
 
 from biostar.accounts.models import User, Profile
 
-from biostar.forum import models, views, auth, forms, const, ajax
+from biostar.forum import models, views, auth, forms, const, ajax, autocomplete
 from biostar.utils.helpers import fake_request
 from biostar.forum.util import get_uuid
 
@@ -150,3 +150,30 @@ class PostTest(TestCase):
 
 
 
+
+    def test_complete(self):
+        """
+        Test prefix completion of titles, tags and handles.
+        """
+        # Read the completions from the test database.
+        autocomplete.COMPLETER.built = None
+
+        url = reverse('ajax_complete')
+        request = fake_request(url=url, data=dict(query="te"), user=self.owner, method='GET')
+        response = ajax.complete(request)
+        self.process_response(response)
+
+        labels = [item['label'] for item in json.loads(response.content)['items']]
+        self.assertIn(self.post.title, labels)
+        self.assertIn(self.owner.username, labels)
+
+        # Saved posts are completed without a rebuild, the most viewed first.
+        post = models.Post.objects.create(title="Testing completions", author=self.owner, content="Test",
+                                          type=models.Post.QUESTION, tag_val="completed", view_count=10)
+        found = autocomplete.complete("TEST")
+        self.assertEqual(found[0]['label'], post.title)
+        self.assertEqual(autocomplete.complete("comp", kinds=[autocomplete.TAG])[0]['label'], "completed")
+
+        post.status = models.Post.DELETED
+        post.save()
+        self.assertNotIn(post.title, [item['label'] for item in autocomplete.complete("test")])
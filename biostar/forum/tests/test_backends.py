@@ -0,0 +1,145 @@
+import logging
+import os
+
+from django.test import TestCase, override_settings
+from django.conf import settings
+
+from biostar.forum import models, search, backends
+from biostar.accounts.models import User
+
+logger = logging.getLogger('engine')
+
+__MODULE_DIR = os.path.dirname(models.__file__)
+TEST_ROOT = os.path.join(__MODULE_DIR, 'tests')
+TEST_INDEX_DIR = os.path.join(TEST_ROOT, "index")
+TEST_INDEX_NAME = "backends"
+
+
+@override_settings(INDEX_DIR=TEST_INDEX_DIR, INDEX_NAME=TEST_INDEX_NAME)
+class BackendConformanceTest(TestCase):
+    """
+    The same behaviour is expected from every search backend.
+    """
+
+    def setUp(self):
+        logger.setLevel(logging.WARNING)
+        self.owner = User.objects.create(username="conformance", first_name="Conformance", email="tested@tested.com",
+                                         password="tested")
+
+        search.remove_index()
+        self.addCleanup(search.remove_index)
+
+        self.bowtie = models.Post.objects.create(title="Aligning reads with bowtie", author=self.owner,
+                                                 content="Bowtie aligns fastq reads", tag_val="bowtie,fastq",
+                                                 type=models.Post.QUESTION)
+        self.errors = models.Post.objects.create(title="Bowtie fails on fastq reads", author=self.owner,
+                                                 content="Running bowtie gives an error", tag_val="bowtie",
+                                                 type=models.Post.QUESTION)
+        self.heatmap = models.Post.objects.create(title="Plotting heatmaps in R", author=self.owner,
+                                                  content="How to cluster a heatmap", tag_val="plotting",
+                                                  type=models.Post.TUTORIAL)
+        self.answer = models.Post.objects.create(title="Answer", author=self.owner, parent=self.bowtie,
+                                                 content="Use bowtie2 instead", type=models.Post.ANSWER)
+
+    def backends(self):
+        for name in backends.BACKENDS:
+            backend = backends.get_backend(name)
+            backend.rebuild()
+            yield name, backend
+
+    def uids(self, page):
+        return {hit['uid'] for hit in page}
+
+    def test_search(self):
+        """
+        Test matching titles, tags and handles.
+        """
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                found = backend.search("bowtie", cache=False)
+                self.assertEqual(self.uids(found), {self.bowtie.uid, self.errors.uid, self.answer.uid})
+                self.assertEqual(found.total, 3)
+
+                found = backend.search("plotting", cache=False)
+                self.assertEqual(self.uids(found), {self.heatmap.uid})
+
+                found = backend.search("conformance", cache=False)
+                self.assertEqual(found.total, 4, "Posts not found by the author name.")
+
+                self.assertEqual(backend.search("missingword", cache=False).total, 0)
+
+    def test_pages(self):
+        """
+        Test pages are ordered by the last edit date and hold the stored fields.
+        """
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                first = backend.search("bowtie", page=1, per_page=2, cache=False)
+                last = backend.search("bowtie", page=5, per_page=2, cache=False)
+
+                self.assertEqual((first.pagenum, first.pagecount, len(first)), (1, 2, 2))
+                self.assertEqual((last.pagenum, len(last)), (2, 1), "Out of range page not clamped.")
+
+                dates = [hit['lastedit_date'] for hit in first]
+                self.assertEqual(dates, sorted(dates, reverse=True))
+                self.assertTrue(all(hit['title'] and hit['url'] for hit in first))
+
+    def test_facets(self):
+        """
+        Test facet counts and filters.
+        """
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                facets = backend.facets("bowtie")
+                self.assertEqual(dict(facets['type']), {models.Post.QUESTION: 2, models.Post.ANSWER: 1})
+                self.assertEqual(dict(facets['tags'])['bowtie'], 2)
+                self.assertEqual(dict(facets['created']), {'week': 3})
+
+                filters = dict(type=models.Post.QUESTION, tag="fastq", created="week")
+                found = backend.search("bowtie", filters=filters, cache=False)
+                self.assertEqual(self.uids(found), {self.bowtie.uid})
+
+    def test_delete(self):
+        """
+        Test removed posts are no longer found.
+        """
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                backend.delete([self.errors.uid])
+                found = backend.search("bowtie", cache=False)
+                self.assertNotIn(self.errors.uid, self.uids(found))
+
+    def test_incremental(self):
+        """
+        Test the incremental indexer writes to every backend.
+        """
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                post = models.Post.objects.create(title="Samtools sort is slow", author=self.owner,
+                                                  content="Sorting bam files", type=models.Post.QUESTION)
+                search.IncrementalIndexer(commit_size=1, backend=backend).poll()
+
+                found = backend.search("samtools", cache=False)
+                self.assertIn(post.uid, self.uids(found))
+
+    def test_more_like_this(self):
+        """
+        Test similar threads are top level posts other than the post itself.
+        """
+        for name, backend in self.backends():
+            with self.subTest(backend=name):
+                similar = [result.uid for result in backend.more_like_this(self.bowtie.uid)]
+                self.assertIn(self.errors.uid, similar)
+                self.assertNotIn(self.bowtie.uid, similar)
+                self.assertNotIn(self.answer.uid, similar)
+
+    def test_database_match(self):
+        """
+        Test fields without a column and terms with quotes make valid database queries.
+        """
+        backend = backends.get_backend("database")
+        backend.rebuild()
+
+        found = backend.search("bowtie", fields=["uid"], cache=False)
+        self.assertEqual(found.total, 3, "Fields without a column do not search all columns.")
+        self.assertEqual(backend.ranked(['say "bowtie"'], fields=["title"], limit=10), [])
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+
+from biostar.forum import models, embeds, util
+from biostar.forum.templatetags import forum_tags
+from biostar.utils import markdown
+from biostar.accounts.models import User
+
+logger = logging.getLogger('engine')
+
+CORPUS = os.path.join(os.path.dirname(__file__), "data", "render_corpus.json")
+
+
+class MarkdownTest(TestCase):
+    """
+    Rendering post bodies: links and mentions, cached renders, parser reuse, embeds and sanitizing.
+    """
+
+    def setUp(self):
+        logger.setLevel(logging.WARNING)
+        self.owner = User.objects.create(username=f"test", email="tested@tested.com", password="tested")
+        self.post = models.Post.objects.create(title="Test", author=self.owner, content="Test",
+                                               type=models.Post.QUESTION)
+
+    def test_markdown_links(self):
+        """
+        Test links and mentions are read with one query per kind.
+        """
+        for idx in range(5):
+            User.objects.create(username=f"mention{idx}", first_name="Mention", email=f"mention{idx}@tested.com")
+        users = list(User.objects.filter(first_name="Mention").select_related("profile"))
+        answer = models.Post.objects.create(title="Test", author=self.owner, content="Answer",
+                                            type=models.Post.ANSWER, parent=self.post)
+
+        site = f"http://{settings.SITE_DOMAIN}{markdown.PORT}"
+        mentions = ' '.join(f"@{user.username}" for user in users)
+        links = '\n\n'.join(f"{site}/p/{uid}/" for uid in (self.post.uid, answer.uid, "missing"))
+        profile = f"{site}/accounts/profile/{users[0].profile.uid}/"
+        text = f"{mentions}\n\n{links}\n\n{profile}\n\n{site}/p/{self.post.uid}/#{answer.uid}"
+
+        # Three lookups, then the subscriptions are read, inserted, read back and counted.
+        answer = models.Post.objects.select_related("parent__root").get(pk=answer.pk)
+        with self.assertNumQueries(7):
+            html = markdown.parse(text, post=answer)
+
+        self.assertIn(users[4].profile.name, html)
+        self.assertIn("Invalid post uid: missing", html)
+        self.assertIn(f"USER: {users[0].profile.name}", html)
+        self.assertEqual(html.count(f">{answer.title}</a>"), 2)
+
+        subs = models.Subscription.objects.filter(post=self.post, user__in=users)
+        self.assertEqual(subs.count(), 5)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.subs_count, 6)
+
+        # Users already subscribed are left alone.
+        with self.assertNumQueries(4):
+            markdown.parse(text, post=answer)
+
+    def test_render_cache(self):
+        """
+        Test bodies are rendered only when they change and rerendered in bulk.
+        """
+        # Saves that keep the content keep the html.
+        post = models.Post.objects.get(pk=self.post.pk)
+        post.html = "<p>Kept</p>"
+        post.save()
+        self.assertEqual(post.html, "<p>Kept</p>")
+
+        post.content = "Changed *content*"
+        post.save()
+        self.assertIn("<em>content</em>", post.html)
+
+        # Rerendering runs the pipeline of the save.
+        self.assertEqual(markdown.render_post((post.pk, post.content)), (post.pk, post.html))
+
+        # Template markdown is cached by the hash of the text.
+        html = forum_tags.render_markdown("Cached **markdown**")
+        self.assertEqual(cache.get(markdown.render_key("Cached **markdown**", True, True)), html)
+
+        models.Post.objects.filter(pk=post.pk).update(html="<p>Stale</p>")
+        self.assertEqual(markdown.rerender(workers=1), 1)
+        post.refresh_from_db()
+        self.assertIn("<em>content</em>", post.html)
+        self.assertEqual(markdown.rerender(workers=1), 0)
+
+    def test_parser_reuse(self):
+        """
+        Test each thread reuses its parser and renders the same html as a new one.
+        """
+        self.assertIs(markdown.get_parser(), markdown.get_parser())
+        self.assertIsNot(markdown.get_parser(escape=False), markdown.get_parser())
+
+        text = f"**Bold** @{self.owner.username}\n\n    code\n\n[link](http://example.com)"
+        self.assertEqual(markdown.parse(text), markdown.parse(text, parser=markdown.make_parser()))
+
+        # The root of a text is not kept for the next one.
+        markdown.parse(text, post=self.post)
+        self.assertIsNone(markdown.get_parser().inline.root)
+
+        # A failing parser that was passed in does not discard the cached one.
+        cached, broken = markdown.get_parser(), markdown.make_parser()
+        broken.inline.renderer = None
+        with self.assertRaises(AttributeError):
+            markdown.parse(text, parser=broken)
+        self.assertIs(markdown.get_parser(), cached)
+
+        fresh, reused = markdown.benchmark([text], rounds=1)
+        self.assertTrue(fresh > 0 and reused > 0)
+
+    def test_embeds(self):
+        """
+        Test embeds are fetched after saving and cached, failures included.
+        """
+        fetched = []
+
+        class OEmbed(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = parse_qs(urlparse(self.path).query)['url'][0]
+                fetched.append(url)
+                self.send_response(200 if url in available else 404)
+                self.end_headers()
+                if url in available:
+                    self.wfile.write(json.dumps(dict(html=f"<blockquote>Tweet {url[-1]}</blockquote>")).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), OEmbed)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        found, missing = "https://twitter.com/biostars/status/1", "https://twitter.com/biostars/status/2"
+        available = {found}
+        with self.settings(TWITTER_OEMBED_URL=f"http://127.0.0.1:{server.server_port}/oembed"):
+            # Posts are saved with placeholders, the task fills in the embeds.
+            post = models.Post.objects.create(title="Embeds", author=self.owner, type=models.Post.QUESTION,
+                                              content=f"{found}\n\n{missing}")
+            self.assertIn(embeds.placeholder(found), post.html)
+
+            post.refresh_from_db()
+            self.assertIn("<blockquote>Tweet 1</blockquote>", post.html)
+            self.assertIn(embeds.placeholder(missing), post.html)
+            self.assertEqual(sorted(fetched), [found, missing])
+
+            # Known embeds are rendered directly and failures are not fetched again.
+            post.content = f"{found}\n\n{missing}\n\nEdited"
+            post.save()
+            self.assertIn("<blockquote>Tweet 1</blockquote>", post.html)
+            self.assertEqual(len(fetched), 2)
+            self.assertEqual(models.Embed.objects.get(url=missing).html, '')
+
+            # Failures are retried and embeds refreshed once their entries expire.
+            available.add(missing)
+            self.assertEqual(embeds.refresh_posts(), 0)
+            models.Embed.objects.update(expires=util.now())
+            self.assertEqual(embeds.refresh_posts(), 1)
+            post.refresh_from_db()
+            self.assertIn("<blockquote>Tweet 2</blockquote>", post.html)
+            self.assertEqual(len(fetched), 4)
+
+    def test_single_pass_render(self):
+        """
+        Test sanitizing once renders the html the posts rendered to when they were
+        cleaned on save and sanitized again in the parser.
+        """
+        # Bodies with the html they rendered to before sanitizing moved into one pass.
+        with open(CORPUS) as fp:
+            corpus = json.load(fp)
+
+        for row in corpus:
+            with self.subTest(text=row['text']):
+                self.assertEqual(markdown.parse(markdown.sanitize(row['text']), sanatize=False), row['html'])
+
+        # Inline html that skipped sanitizing is escaped unless it is allowed.
+        html = markdown.parse('<a href="java&#115;cript:x">a</a> <b onclick="x">b</b> <i>i</i>', sanatize=False)
+        self.assertIn("&lt;a href", html)
+        self.assertIn("&lt;b onclick", html)
+        self.assertIn("<i>i</i>", html)
@@ -1,13 +1,13 @@
 import logging
 import os
-import shutil
 from django.core import management
 from django.urls import reverse
 from django.test import TestCase, override_settings
 from django.conf import settings
-from biostar.forum import models, views, search, tasks
+from django.core.cache import cache
+from biostar.forum import models, views, search, tasks, auth, ajax, similar, pageviews, sketch, ledger, counters, graph, util
 from biostar.utils.helpers import fake_request
-from biostar.accounts.models import User
+from biostar.accounts.models import User, Profile
 
 logger = logging.getLogger('engine')
 
@@ -127,6 +127,344 @@ class PostTest(TestCase):
         self.assertEqual(response.status_code, 302,
                          f"Could not redirect :\nresponse:{response}")
 
+    def test_keyset_pages(self):
+        """
+        Test cursor pages cover every post once, in order, in both directions.
+        """
+        for step in range(9):
+            models.Post.objects.create(title=f"Keyset {step}", author=self.owner, content="Test",
+                                       type=models.Post.QUESTION)
+        # Ties on the ordering field are broken by the id.
+        posts = models.Post.objects.filter(is_toplevel=True)
+        for post in posts:
+            models.Post.objects.filter(id=post.id).update(rank=post.id // 3)
+        expected = list(posts.order_by("-rank", "-id").values_list("id", flat=True))
+
+        paginator = views.KeysetPaginator("KEYSET_TEST", posts, 4)
+        page, seen, forward = paginator.get_page(), [], []
+        while True:
+            seen.extend(post.id for post in page)
+            forward.append(page)
+            if not page.has_next():
+                break
+            page = paginator.get_page(page.next_cursor)
+
+        self.assertEqual(seen, expected)
+        self.assertEqual([page.number for page in forward], [1, 2, 3])
+        self.assertEqual(paginator.num_pages, 3)
+        self.assertFalse(forward[0].has_previous())
+
+        # Walk back from the last page.
+        page = paginator.get_page(forward[-1].previous_cursor)
+        self.assertEqual(([post.id for post in page], page.number), ([post.id for post in forward[1]], 2))
+        page = paginator.get_page(page.previous_cursor)
+        self.assertEqual([post.id for post in page], [post.id for post in forward[0]])
+        self.assertFalse(page.has_previous())
+
+        # Tampered cursors start over.
+        self.assertEqual(paginator.get_page("bogus").number, 1)
+
+        url = reverse("post_list")
+        resp = self.client.get(url, data=dict(cursor=forward[1].next_cursor))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([post.id for post in resp.context['posts']], seen[8:])
+
+    def test_listing_cache(self):
+        """
+        Test anonymous listings are served from the cache until the entry expires.
+        """
+        url = reverse("post_list")
+        self.client.get(url)
+
+        # The cached listing runs no query.
+        with self.assertNumQueries(0):
+            resp = self.client.get(url)
+        self.assertContains(resp, self.post.title)
+        self.assertIsNone(resp.context['posts'])
+
+        # New posts show up once the entry expires.
+        post = models.Post.objects.create(title="Listing cache", author=self.owner, content="Test",
+                                          type=models.Post.QUESTION)
+        self.assertNotContains(self.client.get(url), post.title)
+        cache.clear()
+        self.assertContains(self.client.get(url), post.title)
+
+        # Other parameters do not end up in the links of the cached listing.
+        resp = self.client.get(url, dict(limit="all", utm_source="mail"))
+        self.assertNotContains(resp, "utm_source")
+        self.assertEqual(views.listing_params(resp.wsgi_request).urlencode(), "limit=all")
+
+        # Logged in users get their own listing.
+        self.client.force_login(self.owner)
+        resp = self.client.get(url)
+        self.assertContains(resp, post.title)
+        self.assertIsNotNone(resp.context['posts'])
+
+    def test_thread_cache(self):
+        """
+        Test threads render from the cache with the state of each user filled in.
+        """
+        answer = models.Post.objects.create(title="Test", author=self.staff_user, content="Cached answer",
+                                            type=models.Post.ANSWER, parent=self.post)
+        comment = models.Post.objects.create(title="Test", author=self.owner, content="Cached comment",
+                                             type=models.Post.COMMENT, parent=answer)
+        auth.apply_vote(post=answer, user=self.owner, vote_type=models.Vote.UP)
+        url = reverse("post_view", kwargs=dict(uid=self.post.uid))
+
+        self.client.force_login(self.owner)
+        resp = self.client.get(url)
+        html = resp.content.decode()
+        self.assertIn("Cached comment", html)
+        self.assertNotIn("overlay", html)
+        self.assertRegex(html, f'data-value="{answer.uid}" data-type="upvote"\\s+data-position="right center" data-state="1"')
+        self.assertIn(f'<div class="editable" data-value="{comment.uid}">', html)
+        self.assertNotIn(f'<div class="editable" data-value="{answer.uid}">', html)
+
+        # The owner of the question may accept the answer.
+        self.assertIn(f'data-value="{answer.uid}" data-type="accept"', html)
+
+        # The answer author sees the same cached html with their own state.
+        self.client.force_login(self.staff_user)
+        html = self.client.get(url).content.decode()
+        self.assertIn(f'<div class="editable" data-value="{answer.uid}">', html)
+        self.assertIn(f'class="moderate-post" href="#" data-value="{comment.uid}"', html)
+
+        # Changes to the thread show up.
+        models.Post.objects.create(title="Test", author=self.owner, content="Fresh comment",
+                                   type=models.Post.COMMENT, parent=answer)
+        self.assertContains(self.client.get(url), "Fresh comment")
+
+        # Versions kept in the memory of one process would not reach the other workers.
+        self.assertTrue(util.is_cache_shared())
+        with override_settings(SHARED_CACHE="default"):
+            self.assertFalse(util.is_cache_shared())
+            self.assertContains(self.client.get(url), "Fresh comment")
+
+    @override_settings(VIEW_FLUSH_SECS=3600)
+    def test_buffered_views(self):
+        """
+        Test views are counted once per address and written in one update.
+        """
+        # Drop the views buffered by other tests, their post ids may be reused.
+        pageviews.BUFFER.take()
+        pageviews.BUFFER.seen.clear()
+        other = models.Post.objects.create(title="Views", author=self.owner, content="Test",
+                                           type=models.Post.QUESTION)
+
+        self.assertTrue(pageviews.record_view(self.post.id, ip="10.0.0.1"))
+        self.assertFalse(pageviews.record_view(self.post.id, ip="10.0.0.1"), "Repeated view counted.")
+        self.assertTrue(pageviews.record_view(self.post.id, ip="10.0.0.2"))
+        self.assertTrue(pageviews.record_view(other.id, ip="10.0.0.1"))
+
+        # Repeats are dropped by the buffer, without a query.
+        with self.assertNumQueries(0):
+            self.assertFalse(pageviews.record_view(self.post.id, ip="10.0.0.1"), "Repeated view counted.")
+
+        # Only the wsgi workers flush from a thread.
+        pageviews.start_flusher()
+        self.assertIsNone(pageviews.FLUSHER_PID)
+
+        # Nothing is written until the flush.
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.view_count, 0)
+
+        self.assertEqual(pageviews.flush(), 2)
+
+        self.post.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.post.view_count, other.view_count), (2, 1))
+
+        # Flushed views are not written again.
+        self.assertEqual(pageviews.flush(), 0)
+
+        # Views are counted again once the viewer expires.
+        self.assertTrue(pageviews.record_view(other.id, ip="10.0.0.3", minutes=0))
+        self.assertTrue(pageviews.record_view(other.id, ip="10.0.0.3", minutes=0))
+        pageviews.BUFFER.take()
+
+        # Unique viewers are kept in daily and all time sketches.
+        self.assertEqual(pageviews.unique_viewers(self.post.id), 2)
+        self.assertEqual(pageviews.unique_viewers(self.post.id, days=7), 2)
+        self.assertEqual(models.ViewSketch.objects.filter(post=self.post).count(), 2)
+        self.assertEqual(pageviews.top_viewed(days=7), [self.post.id, other.id])
+
+    def test_view_sketch(self):
+        """
+        Test the unique viewer estimates of merged sketches.
+        """
+        first, second = sketch.empty(), sketch.empty()
+        for idx in range(3000):
+            sketch.add(first, f"10.0.{idx}")
+            sketch.add(second, f"10.0.{idx + 1000}")
+
+        self.assertEqual(len(first), 256)
+        self.assertAlmostEqual(sketch.estimate(first), 3000, delta=3000 * 0.2)
+        self.assertAlmostEqual(sketch.estimate(sketch.merge(first, second)), 4000, delta=4000 * 0.2)
+
+        # Adding an item again changes nothing.
+        self.assertEqual(sketch.add(bytearray(first), "10.0.1"), first)
+
+    def test_score_ledger(self):
+        """
+        Test votes increment the counts and reconciling repairs them.
+        """
+        answer = models.Post.objects.create(title="Test", author=self.staff_user, content="Ledger answer",
+                                            type=models.Post.ANSWER, parent=self.post)
+
+        auth.apply_vote(post=answer, user=self.owner, vote_type=models.Vote.UP)
+        auth.apply_vote(post=answer, user=self.owner, vote_type=models.Vote.ACCEPT)
+        auth.apply_vote(post=self.post, user=self.staff_user, vote_type=models.Vote.BOOKMARK)
+
+        # Votes on own posts do not count.
+        auth.apply_vote(post=self.post, user=self.owner, vote_type=models.Vote.UP)
+
+        answer.refresh_from_db()
+        self.post.refresh_from_db()
+        self.assertEqual((answer.vote_count, answer.accept_count), (2, 1))
+        self.assertEqual((self.post.vote_count, self.post.book_count), (1, 1))
+        self.assertEqual((self.post.thread_votecount, self.post.accept_count), (3, 1))
+
+        # Drift is found with one aggregate query for the profiles and one for the posts.
+        with self.assertNumQueries(2):
+            self.assertEqual(ledger.reconcile(), (0, 0))
+
+        # Removing a vote is recorded in the ledger too.
+        auth.apply_vote(post=answer, user=self.owner, vote_type=models.Vote.UP)
+        changes = models.ScoreChange.objects.filter(user=self.staff_user).values_list("change", flat=True)
+        self.assertEqual(sorted(changes), [-1, 1, 1])
+        self.assertEqual(models.Profile.objects.get(user=self.staff_user).score, 1)
+
+        # Drift is found and repaired.
+        models.Post.objects.filter(pk=answer.pk).update(vote_count=10)
+        models.Profile.objects.filter(user=self.owner).update(score=7)
+        self.assertEqual(ledger.reconcile(fix=True), (1, 1))
+        self.assertEqual(ledger.reconcile(), (0, 0))
+
+        answer.refresh_from_db()
+        self.assertEqual(answer.vote_count, 1)
+        correction = models.ScoreChange.objects.filter(user=self.owner, post=None).first()
+        self.assertEqual(correction.change, -6)
+
+    def test_counters(self):
+        """
+        Test thread counts follow replies and match a recount.
+        """
+        answer = models.Post.objects.create(title="Test", author=self.staff_user, content="Counted answer",
+                                            type=models.Post.ANSWER, parent=self.post)
+        other = models.Post.objects.create(title="Test", author=self.staff_user, content="Other answer",
+                                           type=models.Post.ANSWER, parent=self.post)
+        comment = models.Post.objects.create(title="Test", author=self.owner, content="Counted comment",
+                                             type=models.Post.COMMENT, parent=answer)
+        models.Post.objects.create(title="Test", author=self.staff_user, content="Nested comment",
+                                   type=models.Post.COMMENT, parent=comment)
+
+        def counts(post):
+            post.refresh_from_db()
+            return post.reply_count, post.answer_count, post.comment_count
+
+        self.assertEqual(counts(self.post), (4, 2, 2))
+        self.assertEqual(counts(answer), (1, 0, 1))
+        self.assertEqual(self.post.subs_count, 2)
+
+        # Moving the comment changes the answer counts.
+        counters.moved(comment, parent_id=other.id, post_type=models.Post.COMMENT)
+        models.Post.objects.filter(pk=comment.pk).update(parent=other)
+        self.assertEqual((counts(answer), counts(other)), ((0, 0, 0), (1, 0, 1)))
+
+        # Deleted posts are not counted.
+        request = fake_request(url=reverse('post_list'), data={}, user=self.staff_user)
+        auth.delete_post(post=other, request=request)
+        self.assertEqual(counts(self.post), (3, 1, 2))
+
+        # Unsubscribing is counted.
+        auth.create_subscription(post=self.post, user=self.owner, sub_type=models.Subscription.NO_MESSAGES)
+        self.assertEqual(counts(self.post), (3, 1, 2))
+        self.assertEqual(self.post.subs_count, 1)
+
+        # The recount agrees with the increments.
+        expected = [counts(post) for post in (self.post, answer, other, comment)]
+        models.Post.objects.update(reply_count=9, answer_count=9, comment_count=9, subs_count=9)
+        management.call_command("recount")
+        self.assertEqual([counts(post) for post in (self.post, answer, other, comment)], expected)
+        self.assertEqual(self.post.subs_count, 1)
+
+    def test_ban_counts(self):
+        """
+        Test the subscriptions of a banned user are no longer counted.
+        """
+        user = User.objects.create(username="banned", email="banned@tested.com", password="tested")
+        auth.create_subscription(post=self.post, user=user)
+        for idx in range(3):
+            models.Post.objects.create(title="Test", author=user, content=f"Answer {idx}",
+                                       type=models.Post.ANSWER, parent=self.post)
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.subs_count, self.post.answer_count), (2, 3))
+        version = auth.thread_version(self.post.id)
+
+        user.profile.state = Profile.BANNED
+        user.profile.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.subs_count, self.post.answer_count, self.post.reply_count), (1, 0, 0))
+
+        # The removed posts are queued and their thread invalidated once.
+        self.assertEqual(models.Tombstone.objects.count(), 3)
+        self.assertEqual(auth.thread_version(self.post.id), version + 1)
+
+    def test_thread_graph(self):
+        """
+        Test the thread graph is read with one query and guards moves.
+        """
+        answer = models.Post.objects.create(title="Test", author=self.owner, content="Graph answer",
+                                            type=models.Post.ANSWER, parent=self.post)
+        comment = models.Post.objects.create(title="Test", author=self.owner, content="Graph comment",
+                                             type=models.Post.COMMENT, parent=answer)
+        nested = models.Post.objects.create(title="Test", author=self.owner, content="Nested comment",
+                                            type=models.Post.COMMENT, parent=comment)
+
+        with self.assertNumQueries(1):
+            thread = graph.ThreadGraph.load(root_id=self.post.id)
+
+        self.assertEqual(len(thread), 4)
+        self.assertEqual(thread.descendants(answer.id), {comment.id, nested.id})
+        self.assertEqual(thread.ancestors(nested.id), [comment.id, answer.id, self.post.id])
+        self.assertEqual((thread.depth(self.post.id), thread.depth(nested.id)), (0, 3))
+        self.assertTrue(thread.creates_cycle(answer.id, nested.id))
+        self.assertTrue(thread.can_move(nested.id, self.post.id))
+        self.assertFalse(thread.can_move(self.post.id, answer.id))
+
+        # Posts may not be dragged below their own replies.
+        data = {'parent': nested.uid, 'uid': answer.uid}
+        request = fake_request(url=reverse('drag_and_drop'), data=data, user=self.owner)
+        response = ajax.drag_and_drop(request)
+        self.assertIn(b"Can not move post here", response.content)
+
+    def test_tag_sync(self):
+        """
+        Test only the tags that changed are written.
+        """
+        post = models.Post.objects.create(title="Tagged", author=self.owner, content="Tagged post",
+                                          tag_val="bowtie,fastq", type=models.Post.QUESTION)
+        through = models.Post.tags.through
+
+        def rows():
+            return dict(through.objects.filter(object_id=post.id).values_list("tag__name", "id"))
+
+        before = rows()
+        self.assertEqual(set(before), {"bowtie", "fastq"})
+
+        # Edits that keep the tags do not touch them.
+        post = models.Post.objects.get(pk=post.pk)
+        post.content = "Edited content"
+        with self.assertNumQueries(0):
+            auth.sync_tags(post)
+
+        post.tag_val = "fastq,samtools"
+        post.save()
+        after = rows()
+        self.assertEqual(set(after), {"fastq", "samtools"})
+        self.assertEqual(after["fastq"], before["fastq"])
+        self.assertEqual(list(post.tags.order_by("name").values_list("name", flat=True)), ["fastq", "samtools"])
+
 
 @override_settings(INDEX_DIR=TEST_INDEX_DIR, INDEX_NAME=TEST_INDEX_NAME, DATABASE_NAME=TEST_DATABASE_NAME)
 class PostSearchTest(TestCase):
@@ -135,8 +473,8 @@ class PostSearchTest(TestCase):
         self.owner = User.objects.create(username=f"test", email="tested@tested.com", password="tested")
 
         # Delete test search index on each start up.
-        if os.path.exists(TEST_INDEX_DIR):
-            shutil.rmtree(TEST_INDEX_DIR)
+        search.remove_index()
+        self.addCleanup(search.remove_index)
 
         # Create some posts to index.
         self.limit = 10
@@ -180,4 +518,222 @@ class PostSearchTest(TestCase):
 
         search.print_info()
 
-        self.assertTrue(len(whoosh_search), f"Whoosh search returned no results. At least {self.limit} expected")
\ No newline at end of file
+        self.assertTrue(len(whoosh_search), f"Whoosh search returned no results. At least {self.limit} expected")
+
+    def test_searcher_pool(self):
+        """
+        Test searchers are reused until the index changes.
+        """
+        first = search.POOL.acquire()
+        search.POOL.release(first)
+        second = search.POOL.acquire()
+        search.POOL.release(second)
+
+        self.assertIs(first, second, "Searcher was not reused between searches.")
+
+        # Commit a new post to the index.
+        models.Post.objects.create(title="Test post new", author=self.owner, content="Test post new",
+                                   type=models.Post.QUESTION)
+        search.crawl(reindex=True, limit=1000)
+
+        third = search.POOL.acquire()
+        search.POOL.release(third)
+
+        self.assertIsNot(first, third, "Searcher was not refreshed after a commit.")
+        self.assertTrue(first.is_closed, "Stale searcher was not closed.")
+
+    def test_incremental_indexer(self):
+        """
+        Test new posts become searchable after a poll.
+        """
+        post = models.Post.objects.create(title="Incremental indexing", author=self.owner,
+                                          content="Incremental indexing", type=models.Post.QUESTION)
+
+        indexer = search.IncrementalIndexer(batch_size=100, commit_size=1)
+        added = indexer.poll()
+        post.refresh_from_db()
+
+        self.assertEqual(added, 1, "Only the new post should be indexed.")
+        self.assertTrue(post.indexed, "Post not flagged as indexed.")
+        self.assertEqual(search.read_checkpoint(), post.id, "Checkpoint not saved.")
+        self.assertTrue(len(search.preform_search("Incremental")), "New post is not searchable.")
+
+        # The index is only locked while committing, other writers run between polls.
+        post.save()
+        indexer = search.IncrementalIndexer(batch_size=100, commit_size=100)
+        self.assertEqual(indexer.poll(), 1)
+        search.init_index().writer().commit()
+        indexer.commit()
+        post.refresh_from_db()
+        self.assertTrue(post.indexed, "Edited post not flagged as indexed.")
+
+        # Nothing is left to read once the posts are committed.
+        self.assertEqual(indexer.poll(), 0)
+
+    def test_rebuild_index(self):
+        """
+        Test rebuilding the index replaces the existing documents.
+        """
+        models.Post.objects.update(indexed=False)
+        total, rate = search.rebuild_index(procs=1)
+
+        searcher = search.POOL.acquire()
+        doc_count = searcher.doc_count()
+        search.POOL.release(searcher)
+
+        self.assertEqual(total, self.limit, "Not all posts were rebuilt.")
+        self.assertEqual(doc_count, self.limit, "Index contains stale documents.")
+        self.assertFalse(models.Post.objects.filter(indexed=False).exists(), "Posts not flagged as indexed.")
+
+    def test_build_documents(self):
+        """
+        Test chunked documents match the ones built one post at a time.
+        """
+        posts = models.Post.objects.order_by("id")
+        collector = search.DocumentCollector()
+        for post in posts:
+            search.add_index(post=post, writer=collector)
+
+        docs = list(search.stream_documents(posts, size=3))
+
+        self.assertEqual(collector.docs, docs, "Chunked documents differ from single post documents.")
+
+    def test_remove_deleted(self):
+        """
+        Test deleted and spam posts are removed from the index.
+        """
+        deleted, spam = models.Post.objects.order_by("id")[:2]
+        models.Post.objects.filter(pk=deleted.pk).update(status=models.Post.DELETED)
+        auth.add_tombstones(models.Post.objects.filter(pk=deleted.pk))
+        auth.delete_posts(models.Post.objects.filter(pk=spam.pk))
+
+        indexer = search.IncrementalIndexer(batch_size=100, commit_size=1)
+        removed = indexer.poll()
+
+        searcher = search.POOL.acquire()
+        doc_count = searcher.doc_count()
+        search.POOL.release(searcher)
+
+        self.assertEqual(removed, 2, "Tombstones not drained.")
+        self.assertEqual(doc_count, self.limit - 2, "Removed posts are still in the index.")
+        self.assertFalse(models.Tombstone.objects.exists(), "Tombstones not cleared after commit.")
+
+        # Crawling does not bring the deleted post back.
+        search.crawl(reindex=True, limit=1000)
+        searcher = search.POOL.acquire()
+        doc_count = searcher.doc_count()
+        search.POOL.release(searcher)
+
+        self.assertEqual(doc_count, self.limit - 2, "Crawl indexed a deleted post.")
+
+    def test_search_cache(self):
+        """
+        Test repeated searches are served from the cache until the index changes.
+        """
+        first = search.cached_search("test post", page=1)
+        stats = search.cache_stats()
+        second = search.cached_search(" test  post ", page=1)
+
+        self.assertEqual(search.normalize_query("test  AND\tthe"), "test AND the")
+        self.assertNotEqual(search.normalize_query("the tag"), search.normalize_query("tag"))
+        self.assertEqual([hit['uid'] for hit in first], [hit['uid'] for hit in second])
+        self.assertEqual(search.cache_stats()['hits'], stats['hits'] + 1, "Search was not served from the cache.")
+
+        # A commit to the index invalidates the cached results.
+        models.Post.objects.create(title="Test post new", author=self.owner, content="Test post new",
+                                   type=models.Post.QUESTION)
+        search.IncrementalIndexer(commit_size=1).poll()
+        third = search.cached_search("test", page=1)
+
+        self.assertEqual(third.total, first.total + 1, "Stale results served after a commit.")
+
+    def test_similar_posts(self):
+        """
+        Test precomputed similar posts favour threads sharing rare terms.
+        """
+        first = models.Post.objects.create(title="Aligning reads with bowtie", author=self.owner,
+                                           content="Bowtie alignment of fastq reads", type=models.Post.QUESTION)
+        second = models.Post.objects.create(title="Bowtie fails on fastq reads", author=self.owner,
+                                            content="Running bowtie gives an error", type=models.Post.QUESTION)
+        third = models.Post.objects.create(title="Plotting heatmaps in R", author=self.owner,
+                                           content="How to cluster a heatmap", type=models.Post.QUESTION)
+
+        total = similar.compute_similar(top=5)
+        found = [res.uid for res in ajax.get_similar(first)]
+
+        self.assertEqual(total, models.Post.objects.filter(is_toplevel=True).count())
+        self.assertEqual(found[0], second.uid, "Closest thread is not ranked first.")
+        self.assertNotIn(third.uid, found, "Unrelated thread listed as similar.")
+
+        # Only threads edited since the last run are recomputed.
+        self.assertEqual(similar.compute_similar(top=5, incremental=True), 0)
+
+        # A new thread is also listed by its neighbours, only the new thread is analyzed.
+        tokenize, analyzed = similar.tokenize, []
+        similar.tokenize = lambda text: analyzed.append(text) or tokenize(text)
+        self.addCleanup(setattr, similar, "tokenize", tokenize)
+
+        fourth = models.Post.objects.create(title="Clustering a heatmap in R", author=self.owner,
+                                            content="Heatmap clustering", type=models.Post.QUESTION)
+        updated = similar.compute_similar(top=5, incremental=True)
+        found = [res.uid for res in ajax.get_similar(third)]
+
+        self.assertEqual(updated, 2, "Neighbours of the new thread were not updated.")
+        self.assertIn(fourth.uid, found, "Neighbour does not list the new thread.")
+        self.assertEqual(len(analyzed), 3, "Threads that did not change were analyzed again.")
+
+        # Removed threads are dropped from the lists of their neighbours.
+        fourth.status = models.Post.DELETED
+        fourth.save()
+        similar.compute_similar(top=5, incremental=True)
+        found = [res.uid for res in ajax.get_similar(third)]
+
+        self.assertNotIn(fourth.uid, found, "Removed thread is still listed.")
+        self.assertFalse(models.TermWeight.objects.filter(post=fourth).exists())
+
+    def test_slim_schema(self):
+        """
+        Test a slim index returns the same ranked results, read from the database.
+        """
+        full = search.cached_search("test", page=1)
+
+        # Migrating to the slim schema swaps in a new index.
+        search.rebuild_index(procs=1, slim=True)
+        searcher = search.POOL.acquire()
+        slim = search.is_slim(searcher.schema)
+        search.POOL.release(searcher)
+
+        hits = search.cached_search("test", page=1)
+        cached = search.cached_search("test", page=1)
+
+        self.assertTrue(slim, "Index not migrated to the slim schema.")
+        self.assertTrue(os.path.islink(settings.INDEX_DIR), "Live index is not swapped through a link.")
+        self.assertEqual([hit['uid'] for hit in hits], [hit['uid'] for hit in full])
+        self.assertEqual([hit['title'] for hit in cached], [hit['title'] for hit in full])
+
+    def test_search_facets(self):
+        """
+        Test facet counts are returned with the results and filters narrow them.
+        """
+        models.Post.objects.create(title="Test forum post", author=self.owner, content="Test forum post",
+                                   type=models.Post.FORUM, tag_val="forum")
+        search.IncrementalIndexer(commit_size=1).poll()
+
+        results = search.cached_search("test", page=1)
+        facets = dict(results.facets['type'])
+
+        self.assertEqual(sum(facets.values()), results.total, "Type counts do not add up.")
+        self.assertEqual(facets[models.Post.FORUM], 1)
+        self.assertEqual(dict(results.facets['tags'])['forum'], 1)
+        self.assertEqual(dict(results.facets['created'])['week'], results.total)
+
+        filters = search.parse_filters(dict(type=str(models.Post.FORUM), created="week", tag="forum"))
+        narrowed = search.cached_search("test", page=1, filters=filters)
+
+        self.assertEqual(narrowed.total, 1, "Filters did not narrow the results.")
+
+        url = reverse('post_search')
+        request = fake_request(url=url, data=dict(query="test", tag="forum"), method="GET", user=self.owner)
+        response = views.post_search(request=request)
+        self.assertEqual(response.status_code, 200)
+
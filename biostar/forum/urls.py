@@ -46,6 +46,7 @@ urlpatterns = [
     path('similar/posts/<str:uid>/', ajax.similar_posts, name='similar_posts'),
     path('ajax/report/spam/<str:post_uid>/', ajax.report_spam, name='report_spam'),
     path('most/recent/users/', ajax.most_recent_users, name='most_recent_users'),
+    path('ajax/complete/', ajax.complete, name='ajax_complete'),
 
     path('moderate/<str:uid>/', views.post_moderate, name="post_moderate"),
 
@@ -4,6 +4,9 @@ import logging
 import uuid
 from itertools import islice, count
 from datetime import datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.utils.timezone import utc
 
 
@@ -15,6 +18,21 @@ def now():
     return datetime.utcnow().replace(tzinfo=utc)
 
 
+def shared_cache():
+    """
+    The cache seen by all processes, see the SHARED_CACHE setting.
+    """
+    return caches[settings.SHARED_CACHE]
+
+
+def is_cache_shared():
+    """
+    A cache kept in the memory of a process is not seen by the other workers.
+    Content that other workers invalidate must not be cached with it.
+    """
+    return not isinstance(shared_cache(), LocMemCache)
+
+
 def get_uuid(limit=32):
     return str(uuid.uuid4())[:limit]
 
@@ -1,3 +1,5 @@
+import copy
+import hashlib
 import logging
 from datetime import timedelta
 from functools import wraps
@@ -10,14 +12,18 @@ from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.core import signing
 from django.core.paginator import Paginator
-from django.db.models import Count, Q
+from django.db.models import Count, Q, Case, When, Value, IntegerField
 from taggit.models import Tag
+from django.http import QueryDict
 from django.shortcuts import render, redirect, reverse
 from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 
 from biostar.accounts.models import Profile
-from . import forms, auth, tasks, util, search, const
+from . import forms, auth, tasks, util, search, const, backends, pageviews
 from .const import *
 from .models import Post, Vote, Badge
 
@@ -115,14 +121,22 @@ def get_posts(user, show="latest", tag="", order="rank", limit=None):
     if tag:
         query = query.filter(tags__name=tag.lower())
 
+    days = LIMIT_MAP.get(limit, 0)
+
     # Apply post ordering.
-    if ORDER_MAPPER.get(order):
+    if order == VIEWERS:
+        # Most unique viewers within the time limit, read from the view sketches.
+        ids = pageviews.top_viewed(days=days or None)
+        position = Case(*[When(id=pid, then=Value(idx)) for idx, pid in enumerate(ids)], output_field=IntegerField())
+        query = query.filter(id__in=ids).order_by(position)
+        # The time limit applies to the views instead of the edits.
+        days = 0
+    elif ORDER_MAPPER.get(order):
         ordering = ORDER_MAPPER.get(order)
         query = query.order_by(ordering)
     else:
         query = query.order_by("-rank")
 
-    days = LIMIT_MAP.get(limit, 0)
     # Apply time limit if required.
     if days:
         delta = util.now() - timedelta(days=days)
@@ -147,10 +161,11 @@ def post_search(request):
     if not query:
         return redirect(reverse('post_list'))
 
-    results = search.preform_whoosh_search(query=query, page=page, per_page=settings.SEARCH_RESULTS_PER_PAGE)
+    # Narrow the results to the selected facets.
+    filters = search.parse_filters(request.GET)
 
-    if isinstance(results, list) or not len(results):
-        results = search.SearchResult()
+    backend = backends.get_backend()
+    results = backend.search(query=query, page=page, per_page=settings.SEARCH_RESULTS_PER_PAGE, filters=filters)
 
     total = results.total
     template_name = "widgets/search_results.html"
@@ -185,6 +200,106 @@ class CachedPaginator(Paginator):
         return value
 
 
+# Orderings that may be paged with a cursor.
+KEYSET_ORDERS = dict(
+    rank="rank",
+    views="view_count",
+    replies="reply_count",
+    votes="thread_votecount",
+)
+
+
+class KeysetPage(list):
+    """
+    A page of objects that behaves like a Django page in the templates.
+    """
+
+    def __init__(self, objs, paginator, number, previous_cursor=None, next_cursor=None):
+        super(KeysetPage, self).__init__(objs)
+        self.paginator = paginator
+        self.number = number
+        self.previous_cursor = previous_cursor
+        self.next_cursor = next_cursor
+
+    def has_previous(self):
+        return bool(self.previous_cursor)
+
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    @property
+    def object_list(self):
+        return self
+
+
+class KeysetPaginator(CachedPaginator):
+    """
+    Paginates by seeking past the (value, id) of the last object seen.
+    Every page is a range scan on the ordering field no matter how deep it is.
+    The cursors are signed so that they can be passed around as opaque strings.
+    """
+    SALT = "keyset"
+
+    def __init__(self, count_key, object_list, per_page, field="rank"):
+        self.field = field
+        object_list = object_list.order_by(f"-{field}", "-id")
+        super(KeysetPaginator, self).__init__(count_key, object_list, per_page)
+
+    def encode(self, obj, number, forward=True):
+        value = getattr(obj, self.field)
+        return signing.dumps([value, obj.id, number, forward], salt=self.SALT, compress=True)
+
+    def decode(self, cursor):
+        try:
+            value, pk, number, forward = signing.loads(cursor, salt=self.SALT)
+            return value, int(pk), max(int(number), 1), bool(forward)
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+
+    def get_page(self, cursor=None):
+        """
+        Returns the page that the cursor points to, the first page when it is missing or invalid.
+        """
+        field, size = self.field, self.per_page
+        state = self.decode(cursor) if cursor else None
+
+        if state is None:
+            value, pk, number, forward = None, None, 1, True
+        else:
+            value, pk, number, forward = state
+
+        if forward:
+            query = self.object_list
+            if state:
+                # The first condition bounds the range scan on the ordering field.
+                query = query.filter(Q(**{f"{field}__lte": value}),
+                                     Q(**{f"{field}__lt": value}) | Q(id__lt=pk))
+        else:
+            query = self.object_list.order_by(field, "id")
+            query = query.filter(Q(**{f"{field}__gte": value}),
+                                 Q(**{f"{field}__gt": value}) | Q(id__gt=pk))
+
+        # Read one more object to know whether there is a page beyond this one.
+        objs = list(query[:size + 1])
+        more = len(objs) > size
+        objs = objs[:size]
+
+        if not forward:
+            objs.reverse()
+
+        first, last = (objs[0], objs[-1]) if objs else (None, None)
+
+        # Moving back there is always a page after, moving forward there is one before unless on the first page.
+        has_next = more if forward else bool(objs)
+        has_previous = (state is not None and bool(objs)) if forward else more
+
+        next_cursor = self.encode(last, number + 1) if has_next else None
+        previous_cursor = self.encode(first, number - 1, forward=False) if has_previous and number > 1 else None
+
+        return KeysetPage(objs, paginator=self, number=number, previous_cursor=previous_cursor,
+                          next_cursor=next_cursor)
+
+
 def pages(request, doc):
     # Get all files in the directory root.
     dir_list = os.listdir(os.path.abspath(settings.DOCS_ROOT))
@@ -203,6 +318,51 @@ def pages(request, doc):
     return render(request, 'pages.html', context=context)
 
 
+# The parameters that select a listing. Cached listings are rendered with these only.
+LISTING_PARAMS = ["type", "tag", "order", "limit", "page", "cursor"]
+
+
+def listing_params(request):
+    """
+    Returns the listing parameters of a request in a fixed order, other parameters are dropped.
+    """
+    params = QueryDict(mutable=True)
+    for name in LISTING_PARAMS:
+        if name in request.GET:
+            params[name] = request.GET[name]
+    return params
+
+
+def listing_cache_key(show, params):
+    value = f"{show}|{params.urlencode()}"
+    digest = hashlib.md5(value.encode("utf-8")).hexdigest()
+    return f"LISTING-{digest}"
+
+
+def paginate_posts(request, show, tag, order, limit, cache_key, enable_pages):
+    """
+    Returns the page of posts selected by the GET parameters.
+    """
+    # Get posts available to users.
+    posts = get_posts(user=request.user, show=show, tag=tag, order=order, limit=limit)
+
+    if not enable_pages:
+        # Show top 100 posts without pages.
+        return posts[:100]
+
+    cache_key = cache_key or generate_cache_key(limit, tag, show)
+    field = KEYSET_ORDERS.get(order)
+    # Page numbers are kept working for existing links, new links carry a cursor.
+    if field and request.GET.get('page') is None:
+        paginator = KeysetPaginator(cache_key, posts, settings.POSTS_PER_PAGE, field=field)
+        return paginator.get_page(request.GET.get('cursor'))
+
+    # Create the paginator
+    paginator = CachedPaginator(cache_key, posts, settings.POSTS_PER_PAGE)
+    # Apply the post paging.
+    return paginator.get_page(request.GET.get('page', 1))
+
+
 @ensure_csrf_cookie
 def post_list(request, show=None, cache_key='', extra_context=dict()):
     """
@@ -212,7 +372,6 @@ def post_list(request, show=None, cache_key='', extra_context=dict()):
     user = request.user
 
     # Parse the GET parameters for filtering information
-    page = request.GET.get('page', 1)
     order = request.GET.get("order", "rank")
     tag = request.GET.get("tag", "")
     show = show or request.GET.get("type", "")
@@ -220,31 +379,41 @@ def post_list(request, show=None, cache_key='', extra_context=dict()):
 
     # Pages are enable when showing 'all' ordered by 'rank'
     cond1 = limit == 'all' and order == 'rank'
-    # Pages are also enabled when a page number is provided.
-    cond2 = request.GET.get('page') is not None
+    # Pages are also enabled when a page number or a cursor is provided.
+    cond2 = request.GET.get('page') is not None or request.GET.get('cursor') is not None
 
     enable_pages = cond1 or cond2
 
-    # Get posts available to users.
-    posts = get_posts(user=user, show=show, tag=tag, order=order, limit=limit)
-
-    if enable_pages:
-        # Show top 100 posts without pages.
-        cache_key = cache_key or generate_cache_key(limit, tag, show)
-        # Create the paginator
-        paginator = CachedPaginator(cache_key, posts, settings.POSTS_PER_PAGE)
-        # Apply the post paging.
-        posts = paginator.get_page(page)
-    else:
-        posts = posts[:100]
-
     # Set the active tab.
     tab = tag or show or "latest"
 
     # Fill in context.
-    context = dict(posts=posts, tab=tab, enable_pages=enable_pages,
-                   tag=tag, order=order, type=show, limit=limit)
+    context = dict(tab=tab, enable_pages=enable_pages, tag=tag, order=order, type=show, limit=limit)
     context.update(extra_context)
+
+    # Anonymous users are all shown the same listing, changes show up once the entry expires.
+    key, listing_request = None, request
+    if user.is_anonymous and not extra_context:
+        params = listing_params(request)
+        key = listing_cache_key(show, params)
+
+        # The links of a cached listing must not carry the other parameters of the first visitor.
+        listing_request = copy.copy(request)
+        listing_request.GET = params
+
+    listing = cache.get(key) if key else None
+
+    if listing is None:
+        posts = paginate_posts(listing_request, show=show, tag=tag, order=order, limit=limit, cache_key=cache_key,
+                               enable_pages=enable_pages)
+        listing = render_to_string("widgets/listing_page.html", context=dict(context, posts=posts),
+                                   request=listing_request)
+        if key:
+            cache.set(key, listing, settings.LISTING_CACHE_SECS)
+    else:
+        posts = None
+
+    context.update(posts=posts, listing=mark_safe(listing))
     # Render the page.
     return render(request, template_name="post_list.html", context=context)
 
@@ -416,12 +585,12 @@ def post_view(request, uid):
             return redirect(answer.get_absolute_url())
         messages.error(request, form.errors)
 
-    # Build the comment tree .
-    root, comment_tree, answers, thread = auth.post_tree(user=request.user, root=post.root)
+    # Fill in the cached answers and comments for this user.
+    root, answers_html = auth.cached_thread(user=request.user, root=post.root, request=request)
 
     users_str = auth.get_users_str()
 
-    context = dict(post=root, tree=comment_tree, form=form, answers=answers, users_str=users_str)
+    context = dict(post=root, tree={}, form=form, answers_html=mark_safe(answers_html), users_str=users_str)
 
     return render(request, "post_view.html", context=context)
 
@@ -7,6 +7,7 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.11/howto/deployment/wsgi/
 """
 
+import atexit
 import os
 
 from django.core.wsgi import get_wsgi_application
@@ -14,3 +15,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "biostar.forum.settings")
 
 application = get_wsgi_application()
+
+# Write the post views buffered by each worker while it is idle and when it stops.
+from biostar.forum import pageviews
+
+pageviews.FLUSH_THREAD = True
+atexit.register(pageviews.flush)
@@ -1,17 +1,22 @@
 """
 Markdown parser to render the Biostar style markdown.
 """
+import hashlib
 import re
+from html import unescape
+import threading
+import time
+from multiprocessing import Pool
 
 import mistune
-import requests
 from django.shortcuts import reverse
 from django.db.models import F
 import bleach
+from django import db
 from django.conf import settings
 from mistune import Renderer, InlineLexer, InlineGrammar
 
-from biostar.forum import auth
+from biostar.forum import auth, embeds
 from biostar.forum.models import Post, Subscription
 from biostar.accounts.models import Profile, User
 
@@ -48,6 +53,12 @@ http://test.biostars.org/p/p371285/
 
 '''
 
+# Change when the rendering rules change, renders cached by earlier versions are then ignored.
+RENDER_VERSION = 2
+
+# The parsers of each thread, built once and reused for every text.
+PARSERS = threading.local()
+
 # Shortcut to re.compile
 rec = re.compile
 SITE_URL = f"{settings.SITE_DOMAIN}{settings.HTTP_PORT}"
@@ -64,9 +75,21 @@ POST_ANCHOR = rec(fr"^http(s)?://{settings.SITE_DOMAIN}{PORT}/p/\w+/\#(?P<uid>(\
 # These characters are allowed in handles: _  .  -
 MENTINONED_USERS = rec(r"(\@(?P<handle>[\w_.'-]+))")
 
+# Every post uid, anchors included, and every profile uid in a text.
+POST_UIDS = rec(fr"http(s)?://{settings.SITE_DOMAIN}{PORT}/p/(?P<uid>\w+)(/\#(?P<anchor>\w+))?")
+USER_UIDS = rec(fr"http(s)?://{settings.SITE_DOMAIN}{PORT}/accounts/profile/(?P<uid>[\w_.-]+)")
+
+# The html kept when sanitizing posts, and let through by the renderer.
+ALLOWED_TAGS = bleach.ALLOWED_TAGS
 ALLOWED_ATTRIBUTES = {
-    'a': ['href', 'title', 'name'],
+    'a': ['href', 'title'],
 }
+ALLOWED_PROTOCOLS = bleach.ALLOWED_PROTOCOLS
+
+# Tags and their attributes as written by the sanitizer.
+HTML_TAG = rec(r"<(?P<close>/)?(?P<tag>[a-zA-Z][\w-]*)(?P<attrs>(?:\s+[\w:-]+(?:=\"[^\"<>]*\")?)*)\s*/?>")
+HTML_ATTR = rec(r"(?P<name>[\w:-]+)(?:=\"(?P<value>[^\"]*)\")?")
+URL_SCHEME = rec(r"^(?P<scheme>[a-zA-Z][\w+.-]*):")
 
 # Youtube pattern.
 YOUTUBE_PATTERN1 = rec(r"^http(s)?://www.youtube.com/watch\?v=(?P<uid>([\w-]+))(/)?")
@@ -85,22 +108,86 @@ GIST_HTML = '<script src="https://gist.github.com/%s.js"></script>'
 TWITTER_PATTERN = rec(r"http(s)?://(www)?.?twitter.com/\w+/status(es)?/(?P<uid>([\d]+))")
 
 
-def get_tweet(tweet_id):
+class Lookup(object):
     """
-    Get the HTML code with the embedded tweet.
-    It requires an API call at https://api.twitter.com/1/statuses/oembed.json as documented here:
-    https://dev.twitter.com/docs/embedded-tweets - section "Embedded Tweets for Developers"
-    https://dev.twitter.com/docs/api/1/get/statuses/oembed
-    Params:
-    tweet_id -- a tweet's numeric id like 2311234267 for the tweet at
-    https://twitter.com/Linux/status/2311234267
+    The users, posts, profiles and embeds a text links to, each kind read with one query.
     """
-    try:
-        response = requests.get("https://api.twitter.com/1/statuses/oembed.json?id={}".format(
-            tweet_id))
-        return response.json()['html']
-    except:
-        return ''
+
+    def __init__(self, text=''):
+        handles = {m.group("handle") for m in MENTINONED_USERS.finditer(text)}
+        post_uids = set()
+        for m in POST_UIDS.finditer(text):
+            post_uids.update(uid for uid in m.group("uid", "anchor") if uid)
+        profile_uids = {m.group("uid") for m in USER_UIDS.finditer(text)}
+
+        users = User.objects.filter(username__in=handles).select_related("profile") if handles else []
+        self.users = {user.username: user for user in users}
+
+        posts = Post.objects.filter(uid__in=post_uids) if post_uids else Post.objects.none()
+        self.titles = dict(posts.values_list("uid", "title"))
+
+        profiles = Profile.objects.filter(uid__in=profile_uids) if profile_uids else Profile.objects.none()
+        self.names = dict(profiles.values_list("uid", "name"))
+
+        urls = {m.group(0) for m in TWITTER_PATTERN.finditer(text)}
+        self.embeds = embeds.cached(urls) if urls else {}
+
+        # The users mentioned in the rendered html.
+        self.mentioned = []
+
+
+def sanitize(text):
+    """
+    Removes the html that is not allowed. Post bodies are sanitized once, when they are saved.
+    """
+    return bleach.clean(text, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, protocols=ALLOWED_PROTOCOLS)
+
+
+def is_allowed(tag):
+    """
+    True when a tag and its attributes are allowed.
+    """
+    name = tag.group("tag").lower()
+    if name not in ALLOWED_TAGS:
+        return False
+
+    for attr in HTML_ATTR.finditer(tag.group("attrs")):
+        if attr.group("name").lower() not in ALLOWED_ATTRIBUTES.get(name, []):
+            return False
+        # Entities and spaces may hide the scheme of a link.
+        value = re.sub(r"[\x00-\x20]", "", unescape(attr.group("value") or ''))
+        scheme = URL_SCHEME.match(value)
+        if attr.group("name").lower() == "href" and scheme and scheme.group("scheme").lower() not in ALLOWED_PROTOCOLS:
+            return False
+
+    return True
+
+
+def is_safe(fragment):
+    """
+    True when every tag of an html fragment is allowed and no other markup is present.
+    """
+    pos = 0
+    while True:
+        start = fragment.find("<", pos)
+        if start < 0:
+            return True
+        tag = HTML_TAG.match(fragment, start)
+        if not tag or not is_allowed(tag):
+            return False
+        pos = tag.end()
+
+
+class BiostarRenderer(Renderer):
+    """
+    Lets through the inline html that the sanitizer allows, any other inline html is escaped.
+    The checks are turned on by the whitelist option.
+    """
+
+    def inline_html(self, html):
+        if self.options.get('whitelist') and not is_safe(html):
+            return mistune.escape(html)
+        return super(BiostarRenderer, self).inline_html(html)
 
 
 class MonkeyPatch(InlineLexer):
@@ -128,11 +215,20 @@ class BiostarInlineGrammer(InlineGrammar):
 class BiostarInlineLexer(MonkeyPatch):
     grammar_class = BiostarInlineGrammer
 
-    def __init__(self, root=None, *args, **kwargs):
+    def __init__(self, root=None, lookup=None, *args, **kwargs):
         self.root = root
+        self.lookup = lookup or Lookup()
 
         super(BiostarInlineLexer, self).__init__(*args, **kwargs)
 
+    def reset(self, root=None, lookup=None):
+        """
+        Starts on a new text, the rules and the renderer are kept.
+        """
+        self.root = root
+        self.lookup = lookup or Lookup()
+        self._in_link = self._in_footnote = False
+
     def enable_post_link(self):
         self.rules.post_link = POST_TOPLEVEL
         self.default_rules.insert(0, 'post_link')
@@ -144,16 +240,13 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_mention_link(self, m):
 
         handle = m.group("handle")
-        # Query user and get the link
-        #print(handle)
-        user = User.objects.filter(username=handle).first()
+        # Get the link of the user.
+        user = self.lookup.users.get(handle)
         if user:
             profile = reverse("user_profile", kwargs=dict(uid=user.profile.uid))
             link = f'<a href="{profile}">{user.profile.name}</a>'
-            # Subscribe mentioned users to post.
-            if self.root:
-                # Create user subscription if it does not already exist.
-                auth.create_subscription(post=self.root, user=user, delete_exisiting=False)
+            # Mentioned users are subscribed to the post after rendering.
+            self.lookup.mentioned.append(user)
         else:
             link = m.group(0)
 
@@ -161,9 +254,9 @@ class BiostarInlineLexer(MonkeyPatch):
 
     def output_post_link(self, m):
         uid = m.group("uid")
-        post = Post.objects.filter(uid=uid).first() or Post(title=f"Invalid post uid: {uid}")
+        title = self.lookup.titles.get(uid, f"Invalid post uid: {uid}")
         link = m.group(0)
-        return f'<a href="{link}">{post.title}</a>'
+        return f'<a href="{link}">{title}</a>'
 
     def enable_anchor_link(self):
         self.rules.anchor_link = POST_ANCHOR
@@ -172,8 +265,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_anchor_link(self, m):
         uid = m.group("uid")
         alt, link = f"{uid}", m.group(0)
-        post = Post.objects.filter(uid=uid).first()
-        title = post.title if post else "Post not found"
+        title = self.lookup.titles.get(uid, "Post not found")
         return f'<a href="{link}">{title}</a>'
 
     def enable_user_link(self):
@@ -183,8 +275,7 @@ class BiostarInlineLexer(MonkeyPatch):
     def output_user_link(self, m):
         uid = m.group("uid")
         link = m.group(0)
-        profile = Profile.objects.filter(uid=uid).first()
-        name = profile.name if profile else f"Invalid user uid: {uid}"
+        name = self.lookup.names.get(uid, f"Invalid user uid: {uid}")
 
         return f'<a href="{link}">USER: {name}</a>'
 
@@ -217,8 +308,10 @@ class BiostarInlineLexer(MonkeyPatch):
         self.default_rules.insert(1, 'twitter_link')
 
     def output_twitter_link(self, m):
-        uid = m.group("uid")
-        return get_tweet(uid)
+        url = m.group(0)
+        # Embeds that are not known yet are fetched after the post is saved.
+        html = self.lookup.embeds.get(url)
+        return embeds.region(url, html) if html else embeds.placeholder(url)
 
     def enable_gist_link(self):
         self.rules.gist_link = GIST_PATTERN
@@ -237,18 +330,14 @@ class BiostarInlineLexer(MonkeyPatch):
         return f'<a href="{link}">{link}</a>'
 
 
-def parse(text, post=None, sanatize=True, escape=True):
+def make_parser(escape=True):
     """
-    Parses markdown into html.
-    Expands certain patterns into HTML.
+    Builds the markdown parser with the Biostar inline rules.
     """
-    # Resolve the root if exists.
-    root = post.parent.root if (post and post.parent) else None
-    inline = BiostarInlineLexer(renderer=Renderer(), root=root)
+    inline = BiostarInlineLexer(renderer=BiostarRenderer(whitelist=escape))
     inline.enable_post_link()
     inline.enable_mention_link()
     inline.enable_anchor_link()
-    inline.enable_anchor_link()
     inline.enable_user_link()
 
     inline.enable_youtube_link1()
@@ -258,13 +347,128 @@ def parse(text, post=None, sanatize=True, escape=True):
     inline.enable_twitter_link()
 
     markdown = mistune.Markdown(escape=escape, hard_wrap=True, inline=inline)
+    return markdown
+
+
+def get_parser(escape=True):
+    """
+    Returns the parser of the current thread, it is built on first use.
+    """
+    parsers = getattr(PARSERS, "parsers", None)
+    if parsers is None:
+        parsers = PARSERS.parsers = {}
+
+    if escape not in parsers:
+        parsers[escape] = make_parser(escape=escape)
+
+    return parsers[escape]
+
+
+def parse(text, post=None, sanatize=True, escape=True, parser=None):
+    """
+    Parses markdown into html.
+    Expands certain patterns into HTML.
+    """
+    # Resolve the root if exists.
+    root = post.parent.root if (post and post.parent) else None
+
     if sanatize:
-        text = bleach.clean(text)
-    html = markdown(text)
+        text = sanitize(text)
+
+    # Read everything the text links to up front.
+    lookup = Lookup(text)
+
+    markdown = parser or get_parser(escape=escape)
+    markdown.inline.reset(root=root, lookup=lookup)
+    try:
+        html = markdown(text)
+    except Exception:
+        # The cached parser of the thread is built again when it failed half way.
+        if parser is None:
+            getattr(PARSERS, "parsers", {}).pop(escape, None)
+        raise
+    finally:
+        markdown.inline.reset()
+
+    # Subscribe the mentioned users to the thread.
+    if root and lookup.mentioned:
+        auth.bulk_subscribe(post=root, users=lookup.mentioned)
 
     return html
 
 
+def benchmark(texts, rounds=3):
+    """
+    Times rendering the texts with a new parser for each text and with the reused parser.
+    Returns the best renders per second of each.
+    """
+
+    def rate(make):
+        best = 0
+        for step in range(rounds):
+            start = time.perf_counter()
+            for text in texts:
+                parse(text, parser=make())
+            best = max(best, len(texts) / max(time.perf_counter() - start, 1e-9))
+        return best
+
+    return rate(make_parser), rate(get_parser)
+
+
+def render_key(text, *flags):
+    """
+    Cache key of a render, from the hash of the text, the renderer version and the render flags.
+    """
+    digest = hashlib.md5(text.encode("utf-8", errors="replace")).hexdigest()
+    flags = '-'.join(str(int(flag)) for flag in flags)
+    return f"MARKDOWN-{RENDER_VERSION}-{flags}-{digest}"
+
+
+def render_post(item):
+    """
+    Renders the body of a post, runs in the worker processes of rerender().
+    Bodies are stored sanitized, they are rendered as Post.save renders them.
+    """
+    pk, content = item
+    return pk, parse(content, sanatize=False)
+
+
+def rerender(workers=None, batch_size=500):
+    """
+    Renders the body of every post again, in a pool of worker processes unless workers is 1.
+    Only changed posts are written. Returns the number of posts that changed.
+    """
+    ids = list(Post.objects.order_by("pk").values_list("pk", flat=True))
+
+    # The workers open their own database connections.
+    pool = None
+    if workers != 1:
+        db.connections.close_all()
+        pool = Pool(processes=workers)
+    mapper = pool.imap if pool else map
+
+    changed = 0
+    try:
+        for start in range(0, len(ids), batch_size):
+            rows = Post.objects.filter(pk__in=ids[start:start + batch_size])
+            rows = {pk: (content, html, root_id) for pk, content, html, root_id in
+                    rows.values_list("pk", "content", "html", "root_id")}
+
+            results = mapper(render_post, [(pk, row[0]) for pk, row in rows.items()])
+            posts = [Post(pk=pk, html=html) for pk, html in results if html != rows[pk][1]]
+            Post.objects.bulk_update(posts, ["html"])
+
+            # Cached threads show the new html.
+            auth.bump_thread(*(rows[post.pk][2] for post in posts))
+            changed += len(posts)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return changed
+
+
 def test():
     html = parse(TEST_INPUT2)
     return html
@@ -77,7 +77,12 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    }
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': join(MEDIA_ROOT, '..', 'cache'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
 }
 
 try: